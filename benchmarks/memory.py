@@ -0,0 +1,67 @@
+import gc
+import resource
+import subprocess
+import sys
+from entities import *
+
+
+class Account(Entity):
+    id = IntegerField(group=PRIMARY)
+    iban = IntegerField(group=SECONDARY)
+    balance = FloatField(default=0.0)
+
+
+class CompactAccount(Entity):
+    __compact__ = True
+    id = IntegerField(group=PRIMARY)
+    iban = IntegerField(group=SECONDARY)
+    balance = FloatField(default=0.0)
+
+
+LAYOUTS = dict(dict=Account, compact=CompactAccount)
+
+
+def layout_size(entity):
+    # The instance itself plus the dicts it owns; field values are shared
+    # small objects in both layouts and are not counted.
+    size = sys.getsizeof(entity)
+    for referent in gc.get_referents(entity):
+        if isinstance(referent, dict):
+            size += sys.getsizeof(referent)
+            if '_values' in referent:
+                size += sys.getsizeof(referent['_values'])
+    return size
+
+
+def resident_size(layout, count):
+    # Runs in a fresh interpreter so that both layouts start from the same
+    # baseline.
+    output = subprocess.check_output([
+        sys.executable, '-m', 'benchmarks.memory', '--resident', layout,
+        str(count)
+    ])
+    return float(output)
+
+
+def measure_resident(layout, count):
+    cls = LAYOUTS[layout]
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    entities = [cls(index, index, 0.0) for index in xrange(count)]
+    after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    assert len(entities) == count
+    return (after - before) * 1024.0 / count
+
+
+def main(count=200000):
+    print '%-8s %16s %16s' % ('layout', 'layout bytes', 'resident bytes')
+    for layout, cls in sorted(LAYOUTS.iteritems()):
+        entity = cls(1, 111, 10.0)
+        print '%-8s %16d %16.1f' % (layout, layout_size(entity),
+                                    resident_size(layout, count))
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--resident']:
+        print measure_resident(sys.argv[2], int(sys.argv[3]))
+    else:
+        main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,53 @@
+import sys
+import time
+from entities import *
+
+
+class Account(Entity):
+    id = IntegerField(group=PRIMARY)
+    iban = IntegerField(group=SECONDARY)
+    balance = FloatField(default=0.0)
+
+
+def rate(function, count):
+    start = time.time()
+    function()
+    return count / (time.time() - start)
+
+
+def main(count=10000000, sample=1000000):
+    # Lookups and updates touch a sample of the entries; the repository
+    # itself holds all of them.
+    sample = min(sample, count)
+    accounts = [Account(index, index, 0.0) for index in xrange(count)]
+    repository = EntityRepository(Account)
+    print 'entries: %d' % count
+    print '%-16s %16.0f' % ('insert/s', rate(
+        lambda: repository.insert_many(accounts), count
+    ))
+
+    step = count // sample
+    keys = [(index,) for index in xrange(0, count, step)][:sample]
+    print '%-16s %16.0f' % ('get/s', rate(
+        lambda: [repository.get(key) for key in keys], sample
+    ))
+    print '%-16s %16.0f' % ('find/s', rate(
+        lambda: [repository.find(key, SECONDARY) for key in keys], sample
+    ))
+
+    chosen = accounts[::step][:sample]
+
+    def update_grouped():
+        for account in chosen:
+            account.iban += count
+
+    def update_plain():
+        for account in chosen:
+            account.balance += 1.0
+
+    print '%-16s %16.0f' % ('update/s', rate(update_grouped, sample))
+    print '%-16s %16.0f' % ('plain update/s', rate(update_plain, sample))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
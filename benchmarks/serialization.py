@@ -0,0 +1,54 @@
+import sys
+import timeit
+from entities import *
+from entities import json
+
+
+class Account(Entity):
+    id = IntegerField(group=PRIMARY)
+    iban = IntegerField(group=SECONDARY)
+    balance = FloatField(default=0.0)
+
+
+class Name(Entity):
+    first_name = StringField(group=SECONDARY)
+    last_name = StringField(group=SECONDARY)
+
+
+class Customer(Entity):
+    id = IntegerField(group=PRIMARY)
+    name = EntityField(Name, group=SECONDARY)
+    accounts = ListField(ReferenceField(Account), default=list)
+
+
+def make_customers(count):
+    return [Customer(index, Name(u'first %d' % index, u'last %d' % index),
+                     [Account(index * 10 + offset, index, 1.0)
+                      for offset in xrange(3)])
+            for index in xrange(count)]
+
+
+def make_accounts(count):
+    return [Account(index, index * 10, float(index))
+            for index in xrange(count)]
+
+
+def rate(function, count, repeat=3):
+    return count / min(timeit.repeat(function, number=1, repeat=repeat))
+
+
+def main(count=20000):
+    print 'backend: %s' % json.backend.__name__
+    print '%-10s %16s %16s' % ('schema', 'encode/s', 'decode/s')
+    for name, entities, cls in [('Account', make_accounts(count), Account),
+                                ('Customer', make_customers(count), Customer)]:
+        texts = [json.dumps(entity) for entity in entities]
+        encode = rate(lambda: [json.dumps(entity) for entity in entities],
+                      count)
+        decode = rate(lambda: [json.loads(text, cls) for text in texts],
+                      count)
+        print '%-10s %16.0f %16.0f' % (name, encode, decode)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
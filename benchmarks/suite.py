@@ -0,0 +1,353 @@
+import argparse
+import json as _json
+import platform
+import resource
+import subprocess
+import sys
+import timeit
+from entities import *
+from entities import bson, json
+
+
+# Every case builds synthetic schemas from its parameters, so that the cost
+# of each hot path can be followed as the schemas grow.
+FIELD_COUNTS = (4, 16, 64)
+DEPTHS = (1, 4, 16)
+SIZES = (10, 1000)
+FAN_OUTS = (10, 1000)
+FORMATS = [('json', json.dumps, json.loads, json.read_key),
+           ('bson', bson.encode, bson.decode, bson.read_key)]
+
+
+def make_class(name, fields, base=Entity):
+    return type(base)(name, (base,), fields)
+
+
+def flat_class(field_count):
+    # The first half of the fields make up the primary key.
+    fields = dict(('f%d' % index,
+                   IntegerField(group=PRIMARY if index < field_count // 2
+                                else None))
+                  for index in xrange(field_count))
+    return make_class('Flat%d' % field_count, fields)
+
+
+def chain_classes(depth):
+    cls = make_class('Level0', dict(id=IntegerField(group=PRIMARY)))
+    for level in xrange(1, depth + 1):
+        cls = make_class('Level%d' % level, dict(
+            id=IntegerField(group=PRIMARY),
+            child=EntityField(cls, group=PRIMARY),
+        ))
+    return cls
+
+
+def make_chain(cls, index):
+    if 'child' not in cls._fields:
+        return cls(index)
+    return cls(index, make_chain(cls.child.base_class, index))
+
+
+def collection_class(kind, size):
+    field_class = dict(list=ListField, dict=DictField, set=SetField)[kind]
+    return make_class('%s%d' % (kind.title(), size), dict(
+        id=IntegerField(group=PRIMARY),
+        items=field_class(IntegerField(), group=PRIMARY),
+    ))
+
+
+def blob_class(kind, size):
+    # Collections that are not part of the key, which projections skip.
+    return make_class('%sBlob%d' % (kind.title(), size), dict(
+        id=IntegerField(group=PRIMARY),
+        items=dict(list=ListField, dict=DictField)[kind](IntegerField()),
+    ))
+
+
+def make_items(kind, size):
+    if kind == 'list':
+        return range(size)
+    elif kind == 'dict':
+        return dict(('k%d' % index, index) for index in xrange(size))
+    else:
+        return set(xrange(size))
+
+
+def reference_classes():
+    target = make_class('Target', dict(
+        id=IntegerField(group=PRIMARY),
+        name=StringField(group=SECONDARY),
+    ))
+    source = make_class('Source', dict(
+        id=IntegerField(group=PRIMARY),
+        targets=ListField(ReferenceField(target, SECONDARY), group=PRIMARY),
+    ))
+    return source, target
+
+
+def setup_flat(field_count, count):
+    cls = flat_class(field_count)
+    values = range(field_count)
+    return cls, [cls(*values) for _ in xrange(count)]
+
+
+def case_construct(field_count, count):
+    cls = flat_class(field_count)
+    values = range(field_count)
+    return lambda: [cls(*values) for _ in xrange(count)]
+
+
+def case_get(field_count, count):
+    cls, entities = setup_flat(field_count, count)
+    names = list(cls._fields)
+
+    def run():
+        for entity in entities:
+            for name in names:
+                getattr(entity, name)
+    return run
+
+
+def case_validate_fields(field_count, count):
+    cls, entities = setup_flat(field_count, count)
+    return lambda: [entity.validate() for entity in entities]
+
+
+def case_keyify_fields(field_count, count):
+    cls, entities = setup_flat(field_count, count)
+    return lambda: [entity.keyify() for entity in entities]
+
+
+def setup_chain(depth, count):
+    cls = chain_classes(depth)
+    return [make_chain(cls, index) for index in xrange(count)]
+
+
+def case_validate_depth(depth, count):
+    entities = setup_chain(depth, count)
+    return lambda: [entity.validate() for entity in entities]
+
+
+def case_keyify_depth(depth, count):
+    entities = setup_chain(depth, count)
+    return lambda: [entity.keyify() for entity in entities]
+
+
+def setup_collection(kind, size, count):
+    cls = collection_class(kind, size)
+    return [cls(index, make_items(kind, size)) for index in xrange(count)]
+
+
+def case_validate_collection(kind, size, count):
+    entities = setup_collection(kind, size, count)
+    return lambda: [entity.validate() for entity in entities]
+
+
+def case_keyify_collection(kind, size, count):
+    entities = setup_collection(kind, size, count)
+    return lambda: [entity.keyify() for entity in entities]
+
+
+def setup_references(fan_out, count):
+    source, target = reference_classes()
+    targets = [target(index, u'target %d' % index)
+               for index in xrange(fan_out)]
+    return [source(index, targets) for index in xrange(count)]
+
+
+def case_validate_references(fan_out, count):
+    entities = setup_references(fan_out, count)
+    return lambda: [entity.validate() for entity in entities]
+
+
+def case_keyify_references(fan_out, count):
+    entities = setup_references(fan_out, count)
+    return lambda: [entity.keyify() for entity in entities]
+
+
+def case_fingerprint_depth(depth, count):
+    entities = setup_chain(depth, count)
+    return lambda: [entity.fingerprint() for entity in entities]
+
+
+def case_encode(encode, decode, depth, count):
+    entities = setup_chain(depth, count)
+    return lambda: [encode(entity) for entity in entities]
+
+
+def case_decode(encode, decode, depth, count):
+    entities = setup_chain(depth, count)
+    cls = type(entities[0])
+    data = [encode(entity) for entity in entities]
+    return lambda: [decode(item, cls) for item in data]
+
+
+def setup_blobs(encode, kind, size, count):
+    cls = blob_class(kind, size)
+    return cls, [encode(cls(index, make_items(kind, size)))
+                 for index in xrange(count)]
+
+
+def case_decode_blob(encode, decode, read_key, kind, size, count):
+    cls, data = setup_blobs(encode, kind, size, count)
+    return lambda: [decode(item, cls).keyify() for item in data]
+
+
+def case_read_key_blob(encode, decode, read_key, kind, size, count):
+    cls, data = setup_blobs(encode, kind, size, count)
+    return lambda: [read_key(item, cls) for item in data]
+
+
+def cases():
+    # Yields (name, function, arguments, entity count) for every case.
+    for field_count in FIELD_COUNTS:
+        count = 256000 // field_count
+        for kind, function in [('construct', case_construct),
+                               ('get', case_get),
+                               ('validate', case_validate_fields),
+                               ('keyify', case_keyify_fields)]:
+            yield ('%s/fields=%d' % (kind, field_count), function,
+                   (field_count,), count)
+
+    for depth in DEPTHS:
+        count = 64000 // depth
+        yield ('validate/depth=%d' % depth, case_validate_depth,
+               (depth,), count)
+        yield ('keyify/depth=%d' % depth, case_keyify_depth, (depth,), count)
+        yield ('fingerprint/depth=%d' % depth, case_fingerprint_depth,
+               (depth,), count)
+        for name, encode, decode, read_key in FORMATS:
+            yield ('%s.encode/depth=%d' % (name, depth), case_encode,
+                   (encode, decode, depth), count)
+            yield ('%s.decode/depth=%d' % (name, depth), case_decode,
+                   (encode, decode, depth), count)
+
+    for kind in ('list', 'dict', 'set'):
+        for size in SIZES:
+            count = 256000 // size
+            yield ('validate/%s=%d' % (kind, size), case_validate_collection,
+                   (kind, size), count)
+            yield ('keyify/%s=%d' % (kind, size), case_keyify_collection,
+                   (kind, size), count)
+            if kind == 'set':
+                continue
+            # Full decodes against key-only scans of the same data.
+            for name, encode, decode, read_key in FORMATS:
+                arguments = (encode, decode, read_key, kind, size)
+                yield ('%s.decode/%s=%d' % (name, kind, size),
+                       case_decode_blob, arguments, count // 4)
+                yield ('%s.read_key/%s=%d' % (name, kind, size),
+                       case_read_key_blob, arguments, count // 4)
+
+    for fan_out in FAN_OUTS:
+        count = 256000 // fan_out
+        yield ('validate/fan_out=%d' % fan_out, case_validate_references,
+               (fan_out,), count)
+        yield ('keyify/fan_out=%d' % fan_out, case_keyify_references,
+               (fan_out,), count)
+
+
+def measure(name, scale=1.0, repeat=3):
+    # Runs a single case in this interpreter. Time is the best time per
+    # entity, and peak memory the growth of the resident size while the
+    # case was set up and run.
+    for case, function, args, count in cases():
+        if case == name:
+            break
+    else:
+        raise KeyError(name)
+
+    count = max(1, int(count * scale))
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    run = function(*(args + (count,)))
+    seconds = min(timeit.repeat(run, number=1, repeat=repeat))
+    after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return dict(time=seconds / count, peak_memory=(after - before) * 1024,
+                count=count)
+
+
+def run_all(pattern=None, scale=1.0, repeat=3):
+    # Every case runs in a fresh interpreter, so that they do not share
+    # peak memory or warmed-up state.
+    results = dict()
+    for name, function, args, count in cases():
+        if pattern is not None and pattern not in name:
+            continue
+        output = subprocess.check_output([
+            sys.executable, '-m', 'benchmarks.suite', '--case', name,
+            '--scale', str(scale), '--repeat', str(repeat)
+        ])
+        results[name] = _json.loads(output)
+        print >> sys.stderr, '%-28s %12.3f us %12d KB' % (
+            name, results[name]['time'] * 1e6,
+            results[name]['peak_memory'] // 1024
+        )
+    return dict(python=platform.python_version(),
+                json_backend=json.backend.__name__, results=results)
+
+
+def compare(report, baseline, threshold=0.1):
+    # Returns (name, metric, old, new) for every measurement that grew by
+    # more than the threshold. Cases that are missing on either side, or
+    # that were run at a different scale, are skipped. Memory has to grow by
+    # a page at least, since resident sizes are only counted in pages.
+    regressions = []
+    page = resource.getpagesize()
+    for name, result in sorted(report['results'].iteritems()):
+        old = baseline['results'].get(name)
+        if old is None or old['count'] != result['count']:
+            continue
+        for metric, least in (('time', 0), ('peak_memory', page)):
+            if result[metric] > old[metric] * (1 + threshold) \
+                    and result[metric] - old[metric] >= least \
+                    and result[metric] > 0:
+                regressions.append((name, metric, old[metric],
+                                    result[metric]))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m benchmarks.suite',
+        description='Measures time and peak memory of entity operations.'
+    )
+    parser.add_argument('--output', help='write the JSON report here')
+    parser.add_argument('--compare', metavar='BASELINE',
+                        help='flag regressions against a saved report')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='relative growth that counts as a regression')
+    parser.add_argument('--filter', help='only run cases containing this')
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help='multiplies the number of entities per case')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--case', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.case is not None:
+        print _json.dumps(measure(args.case, args.scale, args.repeat))
+        return 0
+
+    report = run_all(args.filter, args.scale, args.repeat)
+    text = _json.dumps(report, indent=2, sort_keys=True)
+    if args.output is None:
+        print text
+    else:
+        with open(args.output, 'w') as fileobj:
+            fileobj.write(text + '\n')
+
+    if args.compare is not None:
+        with open(args.compare) as fileobj:
+            baseline = _json.load(fileobj)
+        regressions = compare(report, baseline, args.threshold)
+        for name, metric, old, new in regressions:
+            print >> sys.stderr, 'REGRESSION %s %s: %g -> %g (%.2fx)' % (
+                name, metric, old, new,
+                float(new) / old if old else float('inf')
+            )
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,3 +1,11 @@
 from basic import *
 from entity import *
 from field import *
+from table import *
+from repository import *
+from loader import *
+from parallel import *
+from patch import *
+from checks import *
+from streams import *
+from sharding import *
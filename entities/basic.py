@@ -1,8 +1,23 @@
+from collections import namedtuple
+
+
 PRIMARY = 0
 SECONDARY = 1
 
 
+# A plain, picklable summary of a single validation error.
+ErrorRecord = namedtuple('ErrorRecord', 'path value reason')
+
+
 class ValidationError(Exception):
+    # Number of errors this one stands for, and whether validation stopped
+    # at an error limit before it could find all of them.
+    count = 1
+    truncated = False
+    # Fields and positions that lead from where the error is raised to the
+    # value, outermost first. Containers add theirs to copies of the error,
+    # since the same error is raised again for every container of a value.
+    location = ()
 
     def __init__(self, field, value, reason):
         self.field = field
@@ -14,12 +29,36 @@ class ValidationError(Exception):
                                    self.field, self.value, self.reason)
 
     def __str__(self):
-        return '%s = %r (%s)' % (self.field.full_name(), self.value,
-                                 self.reason)
+        return '%s = %r (%s)' % (self.path(), self.value, self.reason)
 
     def __unicode__(self):
-        return u'%s = %r (%s)' % (self.field.full_name(), self.value,
-                                  self.reason)
+        return u'%s = %r (%s)' % (self.path(), self.value, self.reason)
+
+    def located(self, field, position=None):
+        error = Exception.__new__(type(self))
+        error.__dict__.update(self.__dict__)
+        error.location = ((field, position),) + self.location
+        return error
+
+    def path(self, location=()):
+        location += self.location
+        if not location:
+            return self.field.full_name()
+
+        parts = []
+        previous = None
+        for field, position in location + ((self.field, None),):
+            if field is not previous and field.container is None \
+                    and field.name is not None:
+                parts.append('.' + field.name)
+            if position is not None:
+                parts.append('[%r]' % (position,))
+            previous = field
+        return ''.join(parts).lstrip('.')
+
+    def flatten(self, location=()):
+        return [ErrorRecord(self.path(location), repr(self.value),
+                            self.reason)]
 
 
 class MultipleErrors(ValidationError):
@@ -27,9 +66,60 @@ class MultipleErrors(ValidationError):
     def __init__(self, field, value, errors):
         super(MultipleErrors, self).__init__(field, value, 'multiple errors')
         self.errors = errors
+        self.count = sum(error.count for error in errors)
 
     def __str__(self):
-        return '\n'.join(str(error) for error in self.errors)
+        lines = ['%s = %s (%s)' % record for record in self.flatten()]
+        if self.truncated:
+            lines.append('(stopped after %d errors)' % self.count)
+        return '\n'.join(lines)
 
     def __unicode__(self):
-        return u'\n'.join(unicode(error) for error in self.errors)
+        lines = [u'%s = %s (%s)' % record for record in self.flatten()]
+        if self.truncated:
+            lines.append(u'(stopped after %d errors)' % self.count)
+        return u'\n'.join(lines)
+
+    def flatten(self, location=()):
+        location += self.location
+        return [record for error in self.errors
+                for record in error.flatten(location)]
+
+
+class ErrorLimit(object):
+    # Counts the errors found during one validation. Once the limit is
+    # reached, validation goes on until one more error turns up, which is
+    # dropped, so that truncated tells whether errors were left out. Every
+    # level stops collecting after that.
+
+    def __init__(self, max_errors):
+        if max_errors < 1:
+            raise ValueError('max_errors must be positive')
+        self.max_errors = max_errors
+        self.count = 0
+        self.truncated = False
+
+    @property
+    def reached(self):
+        return self.count >= self.max_errors
+
+    # Returns whether the error is kept.
+    def add(self, error):
+        if self.reached:
+            self.truncated = True
+            return False
+        self.count += error.count
+        if self.count > self.max_errors:
+            self.truncated = True
+        return True
+
+
+class CycleError(ValueError):
+
+    def __init__(self, value):
+        super(CycleError, self).__init__(value)
+        self.value = value
+
+    def __str__(self):
+        return 'reference cycle through %s object at 0x%x' \
+            % (type(self.value).__name__, id(self.value))
@@ -0,0 +1,509 @@
+from __future__ import absolute_import
+import codecs
+import datetime
+import struct
+import pytz
+from .basic import PRIMARY
+from .codegen import CodeBuilder
+from .entity import Entity, EntityField, ReferenceField
+from .field import BooleanField, IntegerField, FloatField, DateField, \
+    TimeField, CollectionField, SetField, DictField
+from .json import encode_key, decode_key, reference_key, projection, \
+    group_names
+from .schema import compile_storage, compile_read
+
+
+DOUBLE = '\x01'
+STRING = '\x02'
+DOCUMENT = '\x03'
+ARRAY = '\x04'
+BOOLEAN = '\x08'
+DATETIME = '\x09'
+NULL = '\x0a'
+INT32 = '\x10'
+INT64 = '\x12'
+
+_int32 = struct.Struct('<i')
+_int64 = struct.Struct('<q')
+_double = struct.Struct('<d')
+
+_epoch = datetime.datetime(1970, 1, 1)
+_epoch_date = _epoch.date()
+_utc_epoch = pytz.utc.localize(_epoch)
+
+_encoders = dict()
+_decoders = dict()
+
+
+def encode(entity):
+    encoder = _encoders.get(entity.__class__)
+    if encoder is None:
+        encoder = _encoders[entity.__class__] = _compile_encoder(
+            entity.__class__
+        )
+    return encoder(entity)
+
+
+def decode(data, entity_class, only=None):
+    # Accepts any object that exposes a buffer (str, bytearray, buffer or
+    # memoryview). Everything is read in place through a single memoryview.
+    # With only, fields are projected like json.decode() does, and the
+    # elements of the other fields are skipped without being read.
+    if not isinstance(data, memoryview):
+        data = memoryview(data)
+    names, group = projection(entity_class, only)
+    return _decoder(entity_class, names, group)(data, 0)[0]
+
+
+def read_key(data, entity_class, group=PRIMARY):
+    return decode(data, entity_class, only=group).keyify(group)
+
+
+def _decoder(entity_class, names=None, group=None):
+    decoder = _decoders.get((entity_class, names, group))
+    if decoder is None:
+        decoder = _decoders[entity_class, names, group] = _compile_decoder(
+            entity_class, names, group
+        )
+    return decoder
+
+
+# Encoding
+
+def _pack_document(parts):
+    body = ''.join(parts)
+    return _int32.pack(len(body) + 5) + body + '\x00'
+
+
+def _cstring(key):
+    if isinstance(key, unicode):
+        key = key.encode('utf-8')
+    return key + '\x00'
+
+
+def _encode_int(key, value):
+    if -0x80000000 <= value <= 0x7fffffff:
+        return INT32 + key + _int32.pack(value)
+    else:
+        return INT64 + key + _int64.pack(value)
+
+
+def _encode_string(key, value):
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return STRING + key + _int32.pack(len(value) + 1) + value + '\x00'
+
+
+def _millis(value):
+    # BSON datetimes are UTC milliseconds; naive values are taken as UTC.
+    if isinstance(value, datetime.datetime):
+        if value.tzinfo is not None:
+            value = value.astimezone(pytz.utc).replace(tzinfo=None)
+        delta = value - _epoch
+        return (delta.days * 86400000 + delta.seconds * 1000 +
+                delta.microseconds // 1000)
+    else:
+        return (value - _epoch_date).days * 86400000
+
+
+def _encode_time(key, value):
+    return DATETIME + key + _int64.pack(_millis(value))
+
+
+def _encode_array(items):
+    return _pack_document([_encode_any('%d\x00' % index, item)
+                           for index, item in enumerate(items)])
+
+
+def _encode_any(key, value):
+    if value is None:
+        return NULL + key
+    elif isinstance(value, bool):
+        return BOOLEAN + key + ('\x01' if value else '\x00')
+    elif isinstance(value, (int, long)):
+        return _encode_int(key, value)
+    elif isinstance(value, float):
+        return DOUBLE + key + _double.pack(value)
+    elif isinstance(value, basestring):
+        return _encode_string(key, value)
+    elif isinstance(value, (datetime.date, datetime.datetime)):
+        return _encode_time(key, value)
+    elif isinstance(value, dict):
+        return DOCUMENT + key + _pack_document([
+            _encode_any(_cstring(name), item)
+            for name, item in value.iteritems()
+        ])
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        return ARRAY + key + _encode_array(value)
+    elif isinstance(value, Entity):
+        return DOCUMENT + key + encode(value)
+    else:
+        raise TypeError('cannot encode %r as BSON' % value)
+
+
+def _compile_encoder(cls):
+    gen = CodeBuilder('<%s bson encoder>' % cls.__name__)
+    with gen.block('def encode(self):'):
+        compile_storage(gen, cls)
+        items = []
+        for name, field in cls._fields.iteritems():
+            value = gen.local('value')
+            compile_read(gen, cls, name, value)
+            items.append(_encode(gen, field, repr(_cstring(name)), value))
+        gen.emit('return %s([%s])', gen.const(_pack_document, 'pack'),
+                 ', '.join(items))
+    return gen.build('encode')
+
+
+def _encode(gen, field, key, value):
+    # Returns an expression that encodes the given variable as an element
+    # named by the key expression.
+    if isinstance(field, BooleanField):
+        expr = "%s + %s + ('\\x01' if %s else '\\x00')" % (
+            repr(BOOLEAN), key, value
+        )
+    elif isinstance(field, IntegerField):
+        expr = '%s(%s, %s)' % (gen.const(_encode_int, 'encode_int'),
+                               key, value)
+    elif isinstance(field, FloatField):
+        expr = '%r + %s + %s(%s)' % (DOUBLE, key,
+                                     gen.const(_double.pack, 'pack_double'),
+                                     value)
+    elif isinstance(field, (DateField, TimeField)):
+        expr = '%s(%s, %s)' % (gen.const(_encode_time, 'encode_time'),
+                               key, value)
+    elif isinstance(field, EntityField):
+        expr = '%r + %s + %s(%s)' % (DOCUMENT, key,
+                                     gen.const(encode, 'encode'), value)
+    elif isinstance(field, ReferenceField):
+        # Keys are written exactly as the JSON module writes them, so both
+        # formats share decode_key().
+        expr = '%r + %s + %s(%s(%s))' % (
+            ARRAY, key, gen.const(_encode_array, 'encode_array'),
+            gen.const(encode_key, 'encode_key'), reference_key(field, value)
+        )
+    elif isinstance(field, CollectionField):
+        kind = DOCUMENT if isinstance(field, DictField) else ARRAY
+        expr = '%r + %s + %s(%s)' % (
+            kind, key, gen.const(_compile_collection_encoder(field), 'encode'),
+            value
+        )
+    else:
+        return '%s(%s, %s)' % (gen.const(_encode_any, 'encode_any'),
+                               key, value)
+
+    return '(%r + %s if %s is None else %s)' % (NULL, key, value, expr)
+
+
+def _compile_collection_encoder(field):
+    gen = CodeBuilder('<%s bson encoder>' % field.full_name())
+    with gen.block('def encode(value):'):
+        if isinstance(field, DictField):
+            items = 'value.iteritems()'
+            key = '%s(key)' % gen.const(_cstring, 'cstring')
+        else:
+            items = 'enumerate(value)'
+            key = "'%d\\x00' % key"
+
+        if field.item_field is None:
+            expr = '%s(%s, item)' % (gen.const(_encode_any, 'encode_any'),
+                                     key)
+        else:
+            expr = _encode(gen, field.item_field, key, 'item')
+        if field.recursive:
+            kind = DOCUMENT if isinstance(field, DictField) else ARRAY
+            expr = '%r + %s + encode(item) if isinstance(item, %s) else %s' % (
+                kind, key, gen.const(field.base_class, 'type'), expr
+            )
+
+        gen.emit('return %s([%s for key, item in %s])',
+                 gen.const(_pack_document, 'pack'), expr, items)
+    return gen.build('encode')
+
+
+# Decoding
+
+def _read_name(data, offset):
+    # Element names are short, so they are searched in small chunks rather
+    # than copying the rest of the buffer.
+    size = 32
+    while True:
+        chunk = data[offset:offset + size].tobytes()
+        end = chunk.find('\x00')
+        if end >= 0:
+            return chunk[:end], offset + end + 1
+        elif len(chunk) < size:
+            raise ValueError('unterminated element name at %d' % offset)
+        size *= 2
+
+
+def _skip_index(data, offset, index):
+    # Array elements are named after their indexes, which can be compared in
+    # place instead of searched for.
+    name = '%d\x00' % index
+    end = offset + len(name)
+    if data[offset:end] == name:
+        return end
+    else:
+        return _read_name(data, offset)[1]
+
+
+def _read_double(data, offset):
+    return _double.unpack_from(data, offset)[0], offset + 8
+
+
+def _read_string(data, offset):
+    size = _int32.unpack_from(data, offset)[0]
+    start = offset + 4
+    return codecs.utf_8_decode(data[start:start + size - 1])[0], start + size
+
+
+def _read_document(data, offset):
+    end = offset + _int32.unpack_from(data, offset)[0] - 1
+    offset += 4
+    value = dict()
+    while offset < end:
+        kind = data[offset]
+        name, offset = _read_name(data, offset + 1)
+        value[name.decode('utf-8')], offset = _read_any(data, offset, kind)
+    return value, end + 1
+
+
+def _read_array(data, offset):
+    end = offset + _int32.unpack_from(data, offset)[0] - 1
+    offset += 4
+    value = []
+    while offset < end:
+        kind = data[offset]
+        offset = _skip_index(data, offset + 1, len(value))
+        item, offset = _read_any(data, offset, kind)
+        value.append(item)
+    return value, end + 1
+
+
+def _read_boolean(data, offset):
+    return data[offset] != '\x00', offset + 1
+
+
+def _read_time(data, offset):
+    millis = _int64.unpack_from(data, offset)[0]
+    return (_utc_epoch + datetime.timedelta(milliseconds=millis),
+            offset + 8)
+
+
+def _read_null(data, offset):
+    return None, offset
+
+
+def _read_int32(data, offset):
+    return _int32.unpack_from(data, offset)[0], offset + 4
+
+
+def _read_int64(data, offset):
+    return _int64.unpack_from(data, offset)[0], offset + 8
+
+
+_readers = {
+    DOUBLE: _read_double,
+    STRING: _read_string,
+    DOCUMENT: _read_document,
+    ARRAY: _read_array,
+    BOOLEAN: _read_boolean,
+    DATETIME: _read_time,
+    NULL: _read_null,
+    INT32: _read_int32,
+    INT64: _read_int64,
+}
+
+
+def _read_any(data, offset, kind):
+    reader = _readers.get(kind)
+    if reader is None:
+        raise ValueError('unsupported BSON type 0x%02x' % ord(kind))
+    return reader(data, offset)
+
+
+_sizes = {
+    DOUBLE: 8,
+    BOOLEAN: 1,
+    DATETIME: 8,
+    NULL: 0,
+    INT32: 4,
+    INT64: 8,
+}
+
+
+def _skip(data, offset, kind):
+    # Returns the offset after the element without reading its value.
+    # Documents and arrays start with their size, and strings with theirs
+    # less the size field.
+    size = _sizes.get(kind)
+    if size is not None:
+        return offset + size
+    elif kind == DOCUMENT or kind == ARRAY:
+        return offset + _int32.unpack_from(data, offset)[0]
+    elif kind == STRING:
+        return offset + 4 + _int32.unpack_from(data, offset)[0]
+    raise ValueError('unsupported BSON type 0x%02x' % ord(kind))
+
+
+def _reader(field, group=None):
+    # Returns a function that reads the value of an element of the given
+    # kind. Elements of unexpected kinds (nulls in particular) are read by
+    # their kind alone. Entities are read to the fields of the group, if
+    # there is one.
+    if isinstance(field, EntityField):
+        expected = DOCUMENT
+        names = None if group is None \
+            else group_names(field.base_class, group)
+
+        def read(data, offset):
+            return _decoder(field.base_class, names, group)(data, offset)
+    elif isinstance(field, ReferenceField):
+        expected = ARRAY
+
+        def read(data, offset):
+            key, offset = _read_array(data, offset)
+            entity = decode_key(key, field.base_class, field.reference_group)
+            if field.lazy:
+                return entity.keyify(field.reference_group), offset
+            return entity, offset
+    elif isinstance(field, CollectionField):
+        return _collection_reader(field, group)
+    elif isinstance(field, TimeField):
+        return _read_any
+    elif isinstance(field, DateField):
+        expected = DATETIME
+
+        def read(data, offset):
+            millis = _int64.unpack_from(data, offset)[0]
+            value = _epoch + datetime.timedelta(milliseconds=millis)
+            return value.date(), offset + 8
+    else:
+        return _read_any
+
+    def read_field(data, offset, kind):
+        if kind == expected:
+            return read(data, offset)
+        else:
+            return _read_any(data, offset, kind)
+    return read_field
+
+
+def _collection_reader(field, group=None):
+    if isinstance(field, DictField):
+        expected = DOCUMENT
+    else:
+        expected = ARRAY
+    if field.item_field is None:
+        read_item = _read_any
+    else:
+        read_item = _reader(field.item_field, group)
+
+    def read(data, offset, kind):
+        if kind != expected:
+            return _read_any(data, offset, kind)
+
+        end = offset + _int32.unpack_from(data, offset)[0] - 1
+        offset += 4
+        items = dict() if expected == DOCUMENT else []
+        while offset < end:
+            kind = data[offset]
+            if expected == DOCUMENT:
+                name, offset = _read_name(data, offset + 1)
+            else:
+                offset = _skip_index(data, offset + 1, len(items))
+            if field.recursive and kind == expected:
+                item, offset = read(data, offset, kind)
+            else:
+                item, offset = read_item(data, offset, kind)
+            if expected == DOCUMENT:
+                items[name.decode('utf-8')] = item
+            else:
+                items.append(item)
+
+        if isinstance(field, SetField):
+            items = set(items)
+        return items, end + 1
+    return read
+
+
+def _compile_decoder(cls, names=None, group=None):
+    gen = CodeBuilder('<%s bson decoder>' % cls.__name__)
+    gen.namespace.update(read_name=_read_name, read_any=_read_any,
+                         skip=_skip)
+    fields = [(name, field) for name, field in cls._fields.iteritems()
+              if names is None or name in names]
+    with gen.block('def decode(data, offset):'):
+        gen.emit('end = offset + %s(data, offset)[0] - 1',
+                 gen.const(_int32.unpack_from, 'unpack_int32'))
+        gen.emit('offset += 4')
+        gen.emit('values = dict()')
+
+        # Elements are expected in field order, which lets their names be
+        # compared in place. Whatever is left is handled by the loop below.
+        # Projections return as soon as they have all their fields.
+        for name, field in cls._fields.iteritems():
+            if not fields:
+                break
+            element = _cstring(name)
+            with gen.block('if offset < end and data[offset + 1:offset + %d] '
+                           '== %r:', len(element) + 1, element):
+                if names is not None and name not in names:
+                    gen.emit('offset = skip(data, offset + %d, data[offset])',
+                             len(element) + 1)
+                    continue
+                gen.emit('kind = data[offset]')
+                gen.emit('offset += %d', len(element) + 1)
+                _decode(gen, field, name, group)
+            if names is not None and name == fields[-1][0]:
+                with gen.block('if len(values) == %d:', len(fields)):
+                    gen.emit('return %s(**values), end + 1',
+                             gen.const(cls.from_trusted, 'new'))
+                break
+
+        with gen.block('while offset < end:'):
+            gen.emit('kind = data[offset]')
+            gen.emit('name, offset = read_name(data, offset + 1)')
+            keyword = 'if'
+            for name, field in fields:
+                with gen.block('%s name == %r:', keyword, name):
+                    _decode(gen, field, name, group)
+                keyword = 'elif'
+            # Unknown and unneeded elements are skipped.
+            if keyword == 'if':
+                gen.emit('offset = skip(data, offset, kind)')
+            else:
+                with gen.block('else:'):
+                    gen.emit('offset = skip(data, offset, kind)')
+        gen.emit('return %s(**values), end + 1',
+                 gen.const(cls.from_trusted, 'new'))
+    return gen.build('decode')
+
+
+def _decode(gen, field, name, group=None):
+    # Fixed-width values are unpacked in place; everything else goes
+    # through a reader function.
+    if isinstance(field, BooleanField):
+        with gen.block('if kind == %r:', BOOLEAN):
+            gen.emit("values[%r] = data[offset] != '\\x00'", name)
+            gen.emit('offset += 1')
+    elif isinstance(field, (IntegerField, FloatField)):
+        if isinstance(field, IntegerField):
+            formats = [(INT32, _int32), (INT64, _int64)]
+        else:
+            formats = [(DOUBLE, _double)]
+        keyword = 'if'
+        for kind, format in formats:
+            with gen.block('%s kind == %r:', keyword, kind):
+                gen.emit('values[%r] = %s(data, offset)[0]', name,
+                         gen.const(format.unpack_from, 'unpack'))
+                gen.emit('offset += %d', format.size)
+            keyword = 'elif'
+    else:
+        gen.emit('values[%r], offset = %s(data, offset, kind)', name,
+                 gen.const(_reader(field, group), 'read'))
+        return
+
+    with gen.block('else:'):
+        gen.emit('values[%r], offset = read_any(data, offset, kind)', name)
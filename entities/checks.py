@@ -0,0 +1,140 @@
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+from basic import ValidationError, MultipleErrors
+from entity import Entity, EntityField
+from field import CollectionField
+from parallel import validate_many
+from walk import _subclasses
+
+
+def register_check(field, function):
+    # Adds a check that needs I/O, such as looking up whether a referenced
+    # entity exists. The function receives a list of distinct keys of field
+    # values and returns, in the same order, None for the valid ones and the
+    # reason for the others.
+    field._checks += (function,)
+    return function
+
+
+def check(entity, concurrency=None):
+    # Validates the entity, then runs the checks of its fields and of the
+    # entities and collections it holds, raising MultipleErrors if any fail.
+    entity.validate()
+    errors = [error for index, error in _run([entity], concurrency)]
+    if errors:
+        raise MultipleErrors(None, entity, errors)
+
+
+def check_many(entities, concurrency=None):
+    # Validates the entities in this process, then checks the valid ones.
+    # Each check is called once for all of them, with up to concurrency
+    # checks in flight at a time. Errors are returned like validate_many()
+    # does.
+    entities = list(entities)
+    errors = validate_many(entities)
+    valid = [(index, entity) for index, entity in enumerate(entities)
+             if index not in errors]
+    for index, error in _run([entity for index, entity in valid],
+                             concurrency):
+        errors.setdefault(valid[index][0], []).extend(error.flatten())
+    return errors
+
+
+def _run(entities, concurrency):
+    # Yields (position, ValidationError) for every failed check.
+    batches = OrderedDict()
+    reaches = dict()
+    for index, entity in enumerate(entities):
+        _collect_entity(entity, index, batches, reaches, set())
+
+    calls = [(field, function, keys)
+             for field, keys in batches.iteritems()
+             for function in field._checks]
+    if concurrency is None or concurrency <= 1 or len(calls) <= 1:
+        results = map(_call, calls)
+    else:
+        pool = ThreadPool(min(concurrency, len(calls)))
+        try:
+            results = pool.map(_call, calls)
+        finally:
+            pool.close()
+            pool.join()
+
+    for (field, function, keys), reasons in zip(calls, results):
+        for (key, occurrences), reason in zip(keys.iteritems(), reasons):
+            if reason is not None:
+                for index, value in occurrences:
+                    yield index, ValidationError(field, value, reason)
+
+
+def _call((field, function, keys)):
+    reasons = list(function(list(keys)))
+    if len(reasons) != len(keys):
+        raise ValueError('%s check returned %d results for %d keys'
+                         % (field.full_name(), len(reasons), len(keys)))
+    return reasons
+
+
+def _collect_entity(entity, index, batches, reaches, seen):
+    if id(entity) in seen:
+        return
+    seen.add(id(entity))
+    for name, field in entity._fields.iteritems():
+        if _reaches(field, reaches):
+            _collect(field, entity._get_value(name), index, batches,
+                     reaches, seen)
+
+
+def _collect(field, value, index, batches, reaches, seen):
+    # Identical checks of a field are coalesced by the key of the value.
+    if value is None:
+        return
+    if field._checks:
+        keys = batches.get(field)
+        if keys is None:
+            keys = batches[field] = OrderedDict()
+        keys.setdefault(field.keyify(value), []).append((index, value))
+
+    if isinstance(field, EntityField):
+        if isinstance(value, Entity):
+            _collect_entity(value, index, batches, reaches, seen)
+    elif isinstance(field, CollectionField):
+        for item in field._items_of(value):
+            item_field = field._item_field_of(item)
+            if item_field is not None and _reaches(item_field, reaches):
+                _collect(item_field, item, index, batches, reaches, seen)
+
+
+def _reaches(field, reaches):
+    # Whether the field, or anything its values may hold, has checks.
+    # Referenced entities are checked on their own, so they are not
+    # followed.
+    result = reaches.get(field)
+    if result is not None:
+        return result
+
+    result = False
+    seen = set()
+    stack = [field]
+    while stack:
+        current = stack.pop()
+        if current in seen or reaches.get(current) is False:
+            continue
+        seen.add(current)
+        if current._checks or reaches.get(current):
+            result = True
+            break
+        elif isinstance(current, EntityField):
+            stack.extend(child for cls in _subclasses(current.base_class)
+                         for child in cls._fields.itervalues())
+        elif isinstance(current, CollectionField) \
+                and current.item_field is not None:
+            stack.append(current.item_field)
+
+    # Everything found on the way can only reach checks if this field does.
+    if result:
+        reaches[field] = True
+    else:
+        for current in seen:
+            reaches[current] = False
+    return result
@@ -0,0 +1,72 @@
+import itertools
+from contextlib import contextmanager
+from basic import ValidationError, MultipleErrors
+
+
+class CodeBuilder(object):
+
+    def __init__(self, filename='<generated>'):
+        self.filename = filename
+        self.lines = []
+        self.level = 0
+        self.namespace = dict(ValidationError=ValidationError,
+                              MultipleErrors=MultipleErrors)
+        self._consts = dict()
+        self._counter = itertools.count()
+
+    def emit(self, line, *args):
+        if args:
+            line = line % args
+        self.lines.append('    ' * self.level + line)
+
+    @contextmanager
+    def block(self, line, *args):
+        self.emit(line, *args)
+        self.level += 1
+        start = len(self.lines)
+        yield
+        if len(self.lines) == start:
+            self.emit('pass')
+        self.level -= 1
+
+    def local(self, hint='v'):
+        return '%s_%d' % (hint, self._counter.next())
+
+    def const(self, value, hint='c'):
+        name = self._consts.get(id(value))
+        if name is None:
+            name = '_%s_%d' % (hint, self._counter.next())
+            self._consts[id(value)] = name
+            self.namespace[name] = value
+        return name
+
+    def source(self):
+        return '\n'.join(self.lines) + '\n'
+
+    def build(self, name):
+        code = compile(self.source(), self.filename, 'exec')
+        exec code in self.namespace
+        # Generated functions are marked, so that they can be told apart
+        # from hand-written ones.
+        function = self.namespace[name]
+        function.generated = True
+        return function
+
+
+def inlines(field, method, compiled_method):
+    # A field's compiled form can only be trusted if the class that provides
+    # the runtime method also provides its compiled counterpart.
+    for klass in type(field).__mro__:
+        if method in vars(klass):
+            return compiled_method in vars(klass)
+    return False
+
+
+def compile_validate(gen, field, value, errors):
+    if inlines(field, 'validate', '_compile_validate'):
+        field._compile_validate(gen, value, errors)
+    else:
+        with gen.block('try:'):
+            gen.emit('%s.validate(%s)', gen.const(field, 'field'), value)
+        with gen.block('except ValidationError, ex:'):
+            gen.emit('%s.append(ex)', errors)
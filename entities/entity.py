@@ -1,17 +1,33 @@
-from basic import PRIMARY, MultipleErrors, ValidationError
-from field import Field
+import sys
+import weakref
+from basic import PRIMARY, ErrorLimit, MultipleErrors, ValidationError
+from codegen import inlines
+from field import Field, CollectionField, DictField, DateField, TimeField, \
+    decode_date, decode_time
 from schema import Schema
+from sharding import key_fingerprint
+from walk import _dependencies, _walk, _missing
+import walk
 
 
 class Entity(object):
     __metaclass__ = Schema
+    __compact__ = False
+    __cache_keys__ = False
+    __interned__ = False
 
-    # noinspection PyArgumentList
-    def __new__(cls, *args, **kwargs):
-        self = super(Entity, cls).__new__(cls, *args, **kwargs)
-        self._values = dict()
-        return self
+    _frozen = False
+    _keys = None
+    _containers = None
+    _dirty = -1
+    # Fields whose lazy items have been resolved, by mask.
+    _resolved = 0
+    _loader = None
+    _raw = None
+    _shared = None
 
+    # Schema replaces this with a compiled equivalent in every subclass that
+    # does not define its own constructor.
     def __init__(self, *args, **kwargs):
         # Check positional arguments.
         if len(args) > len(self._fields):
@@ -31,19 +47,246 @@ class Entity(object):
         # Initialize values.
         for index, (name, field) in enumerate(self._fields.iteritems()):
             if index < len(args):
-                self._values[name] = args[index]
+                field.__set__(self, args[index])
             elif name in kwargs:
-                self._values[name] = kwargs[name]
+                field.__set__(self, kwargs[name])
+
+    @classmethod
+    def from_trusted(cls, **values):
+        self = cls.__new__(cls)
+        self._values = values
+        return self
+
+    # Keeps the mapping as it is and converts the value of each field when
+    # it is first read.
+    @classmethod
+    def from_raw(cls, raw):
+        if cls.__interned__:
+            # Interning needs every value, so nothing is left for later.
+            return cls.from_trusted(**dict(
+                (name, field.from_raw(raw[name]))
+                for name, field in cls._fields.iteritems() if name in raw
+            ))
+        self = cls.from_trusted()
+        self._raw = raw
+        return self
 
     def _get_value(self, name):
         if name in self._values:
             return self._values[name]
+
+        shared = self._shared
+        raw = self._raw
+        if shared is not None and name in shared:
+            value = self._unshare(name)
+        elif raw is not None and name in raw:
+            value = self._fields[name].from_raw(raw[name])
         else:
             value = self._fields[name].make_default()
-            self._values[name] = value
-            return value
+        self._values[name] = value
+        return value
+
+    # Shallow copies share every value with this entity. Deep copies share
+    # scalars and referenced entities, but copy the collections and the
+    # nested entities, each of them once.
+    def copy(self, deep=False):
+        if self.__interned__:
+            return self
+        elif deep:
+            copies = _Copies()
+            copy = copies(self)
+            copies.fill()
+            return copy
+        else:
+            return self._copy()
+
+    # Snapshots share nested entities and collections with this entity
+    # until either of them reads one through its field, which gives that
+    # entity a copy of its own. Values read before taking the snapshot must
+    # not be changed in place afterwards, since they remain shared.
+    def snapshot(self):
+        if self.__interned__:
+            return self
+
+        snapshot = self._copy()
+        values = self._stored()
+        for field in self._copied_fields:
+            name = field.name
+            value = values.get(name)
+            if value is None:
+                continue
+
+            # Shared values are kept in cells of [value, sharers], and the
+            # last entity to read one takes the value itself.
+            cell = [value, 2]
+            for entity in (self, snapshot):
+                if field.slot is None:
+                    del entity._values[name]
+                else:
+                    field.slot.__delete__(entity)
+                if entity._shared is None:
+                    entity._shared = dict()
+                entity._shared[name] = cell
+        return snapshot
+
+    def _copy(self):
+        copy = type(self).from_trusted()
+        self._fill_copy(copy, None)
+        return copy
+
+    def _fill_copy(self, copy, copies):
+        values = self._stored()
+        shared = self._shared
+        if shared is not None:
+            if copies is None:
+                for cell in shared.itervalues():
+                    cell[1] += 1
+                copy._shared = dict(shared)
+            else:
+                values = dict(values)
+                for name, cell in shared.iteritems():
+                    values.setdefault(name, cell[0])
+
+        values = dict(values)
+        if copies is not None:
+            for field in self._copied_fields:
+                value = values.get(field.name)
+                if value is not None:
+                    values[field.name] = field._copy(value, copies)
+        if not self.__compact__:
+            copy._values = values
+        else:
+            for name, value in values.iteritems():
+                self._fields[name].slot.__set__(copy, value)
+        copy._raw = self._raw
+
+    # Returns the values that were set or read so far, by field name.
+    # Cached keys and containers only mean something in this process, and
+    # the weak references to the containers cannot be pickled anyway.
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('_keys', None)
+        state.pop('_containers', None)
+        return state
+
+    def _stored(self):
+        if not self.__compact__:
+            return self._values
+        values = dict()
+        for name, field in self._fields.iteritems():
+            try:
+                values[name] = field.slot.__get__(self)
+            except AttributeError:
+                pass
+        return values
+
+    def _unshare(self, name):
+        shared = self._shared
+        cell = shared.pop(name)
+        if not shared:
+            self._shared = None
+
+        field = self._fields[name]
+        if cell[1] > 1:
+            cell[1] -= 1
+            value = field._copy(cell[0], _snapshot)
+        else:
+            value = cell[0]
+        # The value is equal to the shared one, but changes to it have to
+        # reach the containers of this entity from now on.
+        if field.group is not None and (self._keys is not None or
+                                        self._containers is not None):
+            self._invalidate_keys()
+        return value
+
+    # With fail_fast or max_errors, validation stops once that many errors
+    # are found. Such runs always validate every field from scratch.
+    def validate(self, incremental=False, fail_fast=False, max_errors=None):
+        if fail_fast:
+            max_errors = 1
+
+        if max_errors is not None:
+            limit = ErrorLimit(max_errors)
+            try:
+                self._validate_limited(limit)
+            except ValidationError, ex:
+                ex.truncated = limit.truncated
+                raise
+        elif incremental and self._dirty != -1:
+            results = _walk.revalidated
+            if results is not None:
+                memo = (id(self), None, None)
+                if walk.remembered(results, memo):
+                    return
+                try:
+                    self._validate_incremental()
+                except ValidationError, ex:
+                    results[memo] = ex
+                    raise
+                results[memo] = None
+            elif self._nested_fields and self._is_deep():
+                walk.revalidate(walk.entity_node(self))
+            else:
+                self._validate_incremental()
+        elif not self._nested_fields:
+            self._validate()
+        elif _walk.results is not None:
+            # Entities that are not part of the walk are validated when their
+            # container asks for them, and remembered like the rest.
+            results = _walk.results
+            memo = (id(self), None, None)
+            error = results.get(memo, _missing)
+            if error is _missing:
+                try:
+                    self._validate()
+                except ValidationError, ex:
+                    results[memo] = ex
+                    raise
+                results[memo] = None
+            elif error is not None:
+                raise error
+        else:
+            # Entities that hold entities which hold others are validated by
+            # a walk, so that each of them is validated once, and without
+            # recursion if they can nest arbitrarily deep.
+            deep = self._deep
+            if deep is None:
+                deep = walk.needs_walk(type(self), False)
+            if deep:
+                walk.validate(walk.entity_node(self))
+            elif self._shares:
+                walk.validate(walk.entity_node(self), ordered=False)
+            else:
+                self._validate()
 
-    def validate(self):
+        if self._dirty:
+            self._dirty = 0
+
+    def _is_deep(self):
+        deep = self._deep
+        if deep is None:
+            deep = walk.needs_walk(type(self), False)
+        return deep
+
+    def _validate_incremental(self):
+        errors = []
+        dirty = self._dirty
+        for name, field in self._fields.iteritems():
+            try:
+                if dirty & field.mask:
+                    field.validate(self._get_value(name))
+                else:
+                    field.revalidate(self._get_value(name))
+            except ValidationError, ex:
+                errors.append(ex)
+
+        if len(errors) == 1:
+            raise errors[0]
+        elif len(errors) > 1:
+            raise MultipleErrors(None, self, errors)
+
+    # Schema replaces this with a compiled equivalent in every subclass.
+    def _validate(self):
         errors = []
         for name, field in self._fields.iteritems():
             try:
@@ -56,13 +299,165 @@ class Entity(object):
         elif len(errors) > 1:
             raise MultipleErrors(None, self, errors)
 
+    # Entities that can nest arbitrarily deep are validated by a walk here
+    # too. Within one, errors found earlier are collected even once errors
+    # are left out, since they were counted already.
+    def _validate_limited(self, limit):
+        results = _walk.results
+        if not self._nested_fields:
+            pass
+        elif results is not None:
+            memo = (id(self), None, None)
+            if walk.remembered(results, memo):
+                return
+        elif self._is_deep():
+            walk.validate(walk.entity_node(self), limit=limit)
+            return
+
+        errors = []
+        for name, field in self._fields.iteritems():
+            try:
+                field._validate_limited(self._get_value(name), limit)
+            except ValidationError, ex:
+                errors.append(ex)
+                if limit.truncated and results is None:
+                    break
+
+        if len(errors) == 1:
+            error = errors[0]
+        elif len(errors) > 1:
+            error = MultipleErrors(None, self, errors)
+        else:
+            error = None
+        if results is not None and self._nested_fields:
+            results[memo] = error
+        if error is not None:
+            raise error
+
     def keyify(self, group=PRIMARY, child_group=None):
         if child_group is None:
             child_group = group
 
+        stack = _dependencies.stack
+        if group in self._nested_groups:
+            # Keys of entities that can nest arbitrarily deep are computed by
+            # a walk, like validation.
+            deep = self._deep_keys
+            if deep is None:
+                deep = walk.needs_walk(type(self), True)
+            if deep:
+                results = _walk.results
+                if results is None:
+                    node = walk.entity_node(self, group, child_group)
+                    return walk.keyify(node)
+                key = results.get((id(self), group, child_group), _missing)
+                if key is not _missing:
+                    if stack:
+                        stack[-1].append(self)
+                    return key
+
+        if stack:
+            stack[-1].append(self)
+        elif not self.__cache_keys__:
+            return tuple(field.keyify(self._get_value(field.name), child_group)
+                         for field in self._groups[group])
+
+        if self._keys is not None and (group, child_group) in self._keys:
+            return self._keys[group, child_group]
+
+        dependencies = []
+        stack.append(dependencies)
+        try:
+            key = self._keyify(group, child_group)
+        finally:
+            stack.pop()
+
+        for dependency in dependencies:
+            dependency._add_container(self)
+        if self.__cache_keys__:
+            if self._keys is None:
+                self._keys = dict()
+            self._keys[group, child_group] = key
+        return key
+
+    def _keyify(self, group, child_group):
         return tuple(field.keyify(self._get_value(field.name), child_group)
                      for field in self._groups[group])
 
+    # Unlike hash() of the key, fingerprints are the same in every process
+    # and interpreter run.
+    def fingerprint(self, group=PRIMARY, bits=64):
+        return key_fingerprint(self.keyify(group), bits)
+
+    def _children(self, group=None, child_group=None):
+        if group is None:
+            fields = self._nested_fields
+        elif self._keys is not None and (group, child_group) in self._keys:
+            return ()
+        else:
+            fields = self._nested_groups[group]
+
+        nodes = []
+        for field in fields:
+            nodes.extend(field._children(self._get_value(field.name),
+                                         child_group))
+        return nodes
+
+    # Returns the canonical instance with the same values as this one, which
+    # becomes it if there is none yet. Canonical instances cannot be changed.
+    # Schema replaces this with a compiled equivalent in every interned
+    # subclass.
+    def _intern(self):
+        key = tuple(field._intern_key(self._get_value(name))
+                    for name, field in self._fields.iteritems())
+        interned = self._interned.get(key)
+        if interned is None:
+            self._key = key
+            self._hash = hash(key)
+            self._frozen = True
+            interned = self._interned.setdefault(key, self)
+        return interned
+
+    def _add_container(self, container):
+        containers = self._containers
+        if containers is None:
+            containers = self._containers = set()
+        # References drop out of the set once their containers are gone.
+        containers.add(weakref.ref(container, containers.discard))
+
+    def _invalidate_keys(self):
+        if self._keys is not None:
+            self._keys = None
+        containers = self._containers
+        if containers is not None:
+            self._containers = None
+            # Containers have to register again after this, so all of them
+            # are notified even if one fails.
+            failure = None
+            for container in list(containers):
+                container = container()
+                if container is not None:
+                    try:
+                        container._invalidate_keys()
+                    except Exception:
+                        if failure is None:
+                            failure = sys.exc_info()
+            if failure is not None:
+                raise failure[0], failure[1], failure[2]
+
+    def touch(self, *names):
+        if names:
+            for name in names:
+                mask = self._fields[name].mask
+                self._dirty |= mask
+                if self._resolved & mask:
+                    self._resolved &= ~mask
+        else:
+            self._dirty = -1
+            if self._resolved:
+                self._resolved = 0
+        self._invalidate_keys()
+
     def __repr__(self):
         fields = self._groups.get(PRIMARY)
         if fields is None:
@@ -85,7 +480,47 @@ class EntityField(Field):
         super(EntityField, self).validate(value)
 
         if value is not None:
-            value.validate()
+            try:
+                value.validate()
+            except ValidationError, ex:
+                raise ex.located(self)
+
+    def revalidate(self, value):
+        if not isinstance(value, Entity):
+            # Such as items put in collections in place.
+            self.validate(value)
+            return
+        try:
+            value.validate(incremental=True)
+        except ValidationError, ex:
+            raise ex.located(self)
+
+    def _compile_validate(self, gen, value, errors):
+        super(EntityField, self)._compile_validate(gen, value, errors)
+        with gen.block('else:'):
+            with gen.block('try:'):
+                gen.emit('%s.validate()', value)
+            with gen.block('except ValidationError, ex:'):
+                gen.emit('%s.append(ex.located(%s))',
+                         errors, gen.const(self, 'field'))
+
+    def _validate_limited(self, value, limit):
+        if not inlines(self, 'validate', '_validate_limited'):
+            return super(EntityField, self)._validate_limited(value, limit)
+
+        if not limit.truncated:
+            try:
+                super(EntityField, self).validate(value)
+            except ValidationError, ex:
+                if limit.add(ex):
+                    raise
+                return
+
+        if isinstance(value, Entity):
+            try:
+                value._validate_limited(limit)
+            except ValidationError, ex:
+                raise ex.located(self)
 
     def keyify(self, value, group=PRIMARY):
         if value is None:
@@ -93,21 +528,180 @@ class EntityField(Field):
         else:
             return value.keyify(group)
 
+    def _targets(self, keys):
+        return [self.base_class]
+
+    # Interned entities only hold interned entities, which stand for
+    # themselves.
+    def _intern_key(self, value):
+        return value
+
+    _copied = True
+
+    def _copy(self, value, copy_entity):
+        if isinstance(value, Entity) and not value.__interned__:
+            return copy_entity(value)
+        return value
+
+    # Entities that cannot nest arbitrarily deep are processed by their
+    # containers, so only the others become part of the walk.
+    def _children(self, value, group=None):
+        if not isinstance(value, Entity):
+            return ()
+        elif group is None:
+            if walk.needs_walk(type(value), False):
+                return [walk.entity_node(value)]
+        elif group in value._nested_groups \
+                and walk.needs_walk(type(value), True):
+            return [walk.entity_node(value, group, group)]
+        return ()
+
+    def from_raw(self, value):
+        if isinstance(value, dict):
+            return self.base_class.from_raw(value)
+        else:
+            return value
+
 
 class ReferenceField(Field):
     base_class = Entity
 
+    # Lazy references may hold the key of the referenced entity instead of
+    # the entity itself. Keys are resolved through the loader registered for
+    # the entity class when the field is read.
     def __init__(self, entity_class, reference_group=PRIMARY,
-                 default=None, null=True, group=None):
+                 default=None, null=True, group=None, lazy=False):
         super(ReferenceField, self).__init__(default, null, group)
         self.base_class = entity_class
         self.reference_group = reference_group
+        self.lazy = lazy
 
     def make_empty(self):
         return None
 
+    def validate(self, value):
+        if not (self.lazy and isinstance(value, tuple)):
+            super(ReferenceField, self).validate(value)
+
+    def _compile_validate(self, gen, value, errors):
+        if self.lazy:
+            with gen.block('if not isinstance(%s, tuple):', value):
+                super(ReferenceField, self)._compile_validate(gen, value,
+                                                              errors)
+        else:
+            super(ReferenceField, self)._compile_validate(gen, value, errors)
+
     def keyify(self, value, group=PRIMARY):
         if value is None:
             return None
+        elif self.lazy and isinstance(value, tuple):
+            return value
         else:
             return value.keyify(self.reference_group, group)
+
+    # References are only followed for keys.
+    def _targets(self, keys):
+        return [self.base_class] if keys else ()
+
+    def _children(self, value, group=None):
+        reference_group = self.reference_group
+        if group is not None and isinstance(value, Entity) \
+                and reference_group in value._nested_groups \
+                and walk.needs_walk(type(value), True):
+            return [walk.entity_node(value, reference_group, group)]
+        return ()
+
+    def from_raw(self, value):
+        if not isinstance(value, list):
+            return value
+        value = decode_key(value, self.base_class, self.reference_group)
+        if self.lazy:
+            return value.keyify(self.reference_group)
+        else:
+            return value
+
+    def resolve_many(self, keys):
+        loader = self.base_class._loader
+        if loader is None:
+            raise LookupError('no loader registered for %s'
+                              % self.base_class.__name__)
+        return loader.load_many(keys, self.reference_group)
+
+    def __get__(self, instance, owner):
+        value = super(ReferenceField, self).__get__(instance, owner)
+        if self.lazy and isinstance(value, tuple):
+            value = self.resolve_many([value])[0]
+            # Resolving does not change the value as far as keys and
+            # validation are concerned, so the entity is stored in place.
+            if self.slot is None:
+                instance._values[self.name] = value
+            else:
+                self.slot.__set__(instance, value)
+            if instance._keys is not None:
+                instance._invalidate_keys()
+        return value
+
+
+# Deep copies keep the entities copied so far by the id of the original, so
+# that shared entities stay shared and cycles end. Entities are copied from
+# a stack rather than by recursion, so that they can nest any depth: each
+# copy is made empty when its entity is met, and filled once its turn comes.
+class _Copies(dict):
+
+    def __init__(self):
+        super(_Copies, self).__init__()
+        self.pending = []
+
+    def __call__(self, entity):
+        copy = self.get(id(entity))
+        if copy is None:
+            copy = self[id(entity)] = type(entity).from_trusted()
+            self.pending.append(entity)
+        return copy
+
+    def fill(self):
+        pending = self.pending
+        while pending:
+            entity = pending.pop()
+            entity._fill_copy(self[id(entity)], self)
+
+
+def _snapshot(entity):
+    return entity.snapshot()
+
+
+def decode_key(data, entity_class, group, child_group=None):
+    # Builds a stub entity that has only the fields of the key group set.
+    if child_group is None:
+        child_group = group
+
+    values = dict()
+    for field, item in zip(entity_class._groups[group], data):
+        values[field.name] = _decode_key_item(field, item, child_group)
+    return entity_class.from_trusted(**values)
+
+
+def _decode_key_item(field, data, group):
+    if data is None:
+        return None
+    elif isinstance(field, EntityField):
+        return decode_key(data, field.base_class, group)
+    elif isinstance(field, ReferenceField):
+        return decode_key(data, field.base_class, field.reference_group,
+                          group)
+    elif isinstance(field, DictField):
+        if field.item_field is None:
+            return dict(data)
+        return dict((key, _decode_key_item(field.item_field, item, group))
+                    for key, item in data)
+    elif isinstance(field, CollectionField):
+        if field.item_field is not None:
+            data = [_decode_key_item(field.item_field, item, group)
+                    for item in data]
+        return field.base_class(data)
+    elif isinstance(field, TimeField):
+        return decode_time(data)
+    elif isinstance(field, DateField):
+        return decode_date(data)
+    else:
+        return data
@@ -1,7 +1,13 @@
+import copy
 import itertools
 import datetime
+import re
+import sys
 import pytz
 from basic import PRIMARY, ValidationError, MultipleErrors
+from codegen import compile_validate, inlines
+from walk import _walk, _missing
+import walk
 
 
 _field_count = itertools.count()
@@ -9,6 +15,7 @@ _field_count = itertools.count()
 
 class Field(object):
     base_class = None
+    lazy = False
 
     def __init__(self, default=None, null=True, group=None):
         global _field_count
@@ -18,6 +25,8 @@ class Field(object):
         self.default = default
         self.null = null
         self.group = group
+        self.slot = None
+        self.mask = 0
 
     def make_default(self):
         if self.default is None:
@@ -56,19 +65,116 @@ class Field(object):
                     and not isinstance(value, self.base_class):
                 raise ValidationError(self, value, 'invalid type')
 
+    # Validates like validate(), but counts errors against an ErrorLimit.
+    # Fields that hold other values override this to stop early once errors
+    # are left out. Values are no longer checked after that.
+    def _validate_limited(self, value, limit):
+        if limit.truncated:
+            return
+        try:
+            self.validate(value)
+        except ValidationError, ex:
+            if limit.add(ex):
+                raise
+
+    # noinspection PyUnusedLocal
+    def revalidate(self, value):
+        pass
+
+    def _compile_validate(self, gen, value, errors):
+        field = gen.const(self, 'field')
+        with gen.block('if %s is None:', value):
+            if not self.null:
+                gen.emit("%s.append(ValidationError(%s, %s, 'null value'))",
+                         errors, field, value)
+        if self.base_class is not None:
+            with gen.block('elif not isinstance(%s, %s):',
+                           value, gen.const(self.base_class, 'type')):
+                gen.emit("%s.append(ValidationError(%s, %s, 'invalid type'))",
+                         errors, field, value)
+
     # noinspection PyUnusedLocal
     def keyify(self, value, group=PRIMARY):
         return value
 
+    # Interned entities are looked up by these keys of all their values.
+    # Values are keyed along with their types, since equal values of other
+    # types (1, 1.0 and True) must not share an instance.
+    def _intern_key(self, value):
+        return type(value), self.keyify(value)
+
+    # Checks that need I/O, added by register_check().
+    _checks = ()
+
+    # Copies a value for a copy of the entity that holds it. Fields whose
+    # values cannot change in place share them, and the others pass the
+    # entities they hold to copy_entity.
+    _copied = False
+
+    # noinspection PyUnusedLocal
+    def _copy(self, value, copy_entity):
+        return value
+
+    # Fields that may hold entities return their classes, or None if they
+    # hold recursive collections, and yield walk nodes for the values that
+    # need one. The group is None while validating.
+    # noinspection PyUnusedLocal
+    def _targets(self, keys):
+        return ()
+
+    # noinspection PyUnusedLocal
+    def _children(self, value, group=None):
+        return ()
+
+    # Converts a value from the plain form that JSON decoding produces.
+    def from_raw(self, value):
+        return value
+
     # noinspection PyUnusedLocal
     def __get__(self, instance, owner):
         if instance is None:
             return self
-        else:
+        elif self.slot is None:
             return instance._get_value(self.name)
+        else:
+            try:
+                return self.slot.__get__(instance, owner)
+            except AttributeError:
+                return instance._get_value(self.name)
 
     def __set__(self, instance, value):
-        instance._values[self.name] = value
+        if instance._frozen:
+            raise AttributeError('%s entities are interned and cannot be '
+                                 'changed' % type(instance).__name__)
+
+        # Only grouped fields take part in keys.
+        keyed = self.group is not None and (instance._keys is not None or
+                                            instance._containers is not None)
+        if keyed:
+            # Read as stored, without resolving lazy keys.
+            old = Field.__get__(self, instance, None)
+
+        self._store(instance, value)
+        if not instance._dirty & self.mask:
+            instance._dirty |= self.mask
+
+        if keyed:
+            try:
+                instance._invalidate_keys()
+            except Exception:
+                # Containers may refuse the new keys (repositories do for
+                # duplicate primary keys). The old value is put back, and
+                # they are told again so that they index it as before.
+                failure = sys.exc_info()
+                self._store(instance, old)
+                instance._invalidate_keys()
+                raise failure[0], failure[1], failure[2]
+
+    def _store(self, instance, value):
+        if self.slot is None:
+            instance._values[self.name] = value
+        else:
+            self.slot.__set__(instance, value)
 
     def __repr__(self):
         return '%s(name=%r)' % (self.__class__.__name__, self.name)
@@ -81,6 +187,13 @@ class DynamicField(Field):
         super(DynamicField, self).__init__(default, null, group)
         self.base_class = base_class
 
+    # Nothing is known about dynamic values, so they are copied in full.
+    _copied = True
+
+    # noinspection PyUnusedLocal
+    def _copy(self, value, copy_entity):
+        return copy.deepcopy(value)
+
 
 class BooleanField(Field):
     base_class = bool
@@ -101,12 +214,54 @@ class StringField(Field):
         return u''
 
 
+def decode_date(text):
+    return datetime.date(int(text[0:4]), int(text[5:7]), int(text[8:10]))
+
+
+_time_pattern = re.compile(
+    r'(\d{4})-(\d\d)-(\d\d)T(\d\d):(\d\d):(\d\d)(?:\.(\d{1,6}))?'
+    r'(?:(Z)|([+-])(\d\d):(\d\d))?$'
+)
+
+
+def decode_time(text):
+    match = _time_pattern.match(text)
+    if match is None:
+        raise ValueError('invalid time %r' % text)
+
+    (year, month, day, hour, minute, second, fraction,
+     utc, sign, offset_hours, offset_minutes) = match.groups()
+    if fraction is None:
+        microsecond = 0
+    else:
+        microsecond = int(fraction.ljust(6, '0'))
+
+    if utc is not None:
+        tzinfo = pytz.utc
+    elif sign is not None:
+        offset = int(offset_hours) * 60 + int(offset_minutes)
+        if sign == '-':
+            offset = -offset
+        tzinfo = pytz.utc if offset == 0 else pytz.FixedOffset(offset)
+    else:
+        tzinfo = None
+
+    return datetime.datetime(int(year), int(month), int(day), int(hour),
+                             int(minute), int(second), microsecond, tzinfo)
+
+
 class DateField(Field):
     base_class = datetime.date
 
     def make_empty(self):
         return pytz.utc.localize(datetime.datetime.utcnow()).date()
 
+    def from_raw(self, value):
+        if isinstance(value, basestring):
+            return decode_date(value)
+        else:
+            return value
+
 
 class TimeField(Field):
     base_class = datetime.datetime
@@ -114,9 +269,16 @@ class TimeField(Field):
     def make_empty(self):
         return pytz.utc.localize(datetime.datetime.utcnow())
 
+    def from_raw(self, value):
+        if isinstance(value, basestring):
+            return decode_time(value)
+        else:
+            return value
+
 
 class CollectionField(Field):
     key_class = tuple
+    raw_class = list
 
     def __init__(self, item_field=None, recursive=False,
                  default=None, null=True, group=None):
@@ -132,6 +294,10 @@ class CollectionField(Field):
     def _items_of(self, value):
         return value
 
+    # Pairs of items with their positions, which error paths report.
+    def _positions_of(self, value):
+        return enumerate(self._items_of(value))
+
     def _item_field_of(self, item):
         if self.recursive and isinstance(item, self.base_class):
             return self
@@ -139,22 +305,196 @@ class CollectionField(Field):
             return self.item_field
 
     def validate(self, value):
+        # Nested collections of recursive fields are processed by a walk
+        # instead of recursion.
+        if self.recursive:
+            results = _walk.results
+            if results is None:
+                if isinstance(value, self.base_class):
+                    walk.validate(walk.collection_node(self, value))
+                    return
+            else:
+                error = results.get((id(self), id(value), None), _missing)
+                if error is None:
+                    return
+                elif error is not _missing:
+                    raise error
+
         super(CollectionField, self).validate(value)
 
         # Validate items.
         if value is not None and self.item_field is not None:
-            errors = []
-            for item in self._items_of(value):
-                try:
-                    self._item_field_of(item).validate(item)
-                except ValidationError, ex:
-                    errors.append(ex)
+            errors = self._item_errors(value)
             if len(errors) == 1:
                 raise errors[0]
             elif len(errors) > 1:
                 raise MultipleErrors(self, value, errors)
 
+    def _item_errors(self, value):
+        errors = []
+        for position, item in self._positions_of(value):
+            try:
+                self._item_field_of(item).validate(item)
+            except ValidationError, ex:
+                errors.append(ex.located(self, position))
+        return errors
+
+    def _validate_limited(self, value, limit):
+        if not inlines(self, 'validate', '_validate_limited'):
+            return super(CollectionField, self)._validate_limited(value,
+                                                                  limit)
+
+        # Recursive collections are walked like in validate().
+        results = _walk.results
+        memo = None
+        if self.recursive and isinstance(value, self.base_class):
+            memo = (id(self), id(value), None)
+            if results is None:
+                walk.validate(walk.collection_node(self, value),
+                              limit=limit)
+                return
+            elif walk.remembered(results, memo):
+                return
+
+        if not limit.truncated:
+            try:
+                super(CollectionField, self).validate(value)
+            except ValidationError, ex:
+                if limit.add(ex):
+                    raise
+                return
+
+        if isinstance(value, self.base_class) \
+                and self.item_field is not None:
+            errors = []
+            if not self.recursive and \
+                    type(self.item_field)._validate_limited == \
+                    Field._validate_limited:
+                # Plain items are validated directly and only errors are
+                # counted.
+                validate = self.item_field.validate
+                for position, item in self._positions_of(value):
+                    if limit.truncated:
+                        break
+                    try:
+                        validate(item)
+                    except ValidationError, ex:
+                        if limit.add(ex):
+                            errors.append(ex.located(self, position))
+            else:
+                for position, item in self._positions_of(value):
+                    try:
+                        self._item_field_of(item)._validate_limited(item,
+                                                                    limit)
+                    except ValidationError, ex:
+                        errors.append(ex.located(self, position))
+                        if limit.truncated and results is None:
+                            break
+            if len(errors) == 1:
+                error = errors[0]
+            elif len(errors) > 1:
+                error = MultipleErrors(self, value, errors)
+            else:
+                error = None
+            if memo is not None and results is not None:
+                results[memo] = error
+            if error is not None:
+                raise error
+
+    # Items may have been changed in place without the entity knowing, so
+    # plain items are checked in full. Entities in the collection are only
+    # checked for the changes they know of.
+    def revalidate(self, value):
+        if value is None:
+            return
+        elif self.item_field is None or not self.recursive and \
+                type(self.item_field).revalidate == Field.revalidate:
+            self.validate(value)
+            return
+
+        results = _walk.revalidated
+        memo = None
+        if self.recursive and isinstance(value, self.base_class):
+            memo = (id(self), id(value), None)
+            if results is None:
+                walk.revalidate(walk.collection_node(self, value))
+                return
+            elif walk.remembered(results, memo):
+                return
+
+        errors = []
+        for position, item in self._positions_of(value):
+            field = self._item_field_of(item)
+            try:
+                if type(field).revalidate == Field.revalidate:
+                    field.validate(item)
+                else:
+                    field.revalidate(item)
+            except ValidationError, ex:
+                errors.append(ex.located(self, position))
+        if len(errors) == 1:
+            error = errors[0]
+        elif len(errors) > 1:
+            error = MultipleErrors(self, value, errors)
+        else:
+            error = None
+        if memo is not None:
+            results[memo] = error
+        if error is not None:
+            raise error
+
+    def _compile_items_of(self, gen, value):
+        return value
+
+    def _compile_validate(self, gen, value, errors):
+        super(CollectionField, self)._compile_validate(gen, value, errors)
+        if self.item_field is None:
+            return
+
+        field = gen.const(self, 'field')
+        if inlines(self, '_items_of', '_compile_items_of'):
+            items = self._compile_items_of(gen, value)
+        else:
+            items = '%s._items_of(%s)' % (field, value)
+
+        item = gen.local('item')
+        item_errors = gen.local('errors')
+        with gen.block('else:'):
+            gen.emit('%s = []', item_errors)
+            with gen.block('for %s in %s:', item, items):
+                if not inlines(self, '_item_field_of', '_compile_validate'):
+                    with gen.block('try:'):
+                        gen.emit('%s._item_field_of(%s).validate(%s)',
+                                 field, item, item)
+                    with gen.block('except ValidationError, ex:'):
+                        gen.emit('%s.append(ex)', item_errors)
+                elif self.recursive:
+                    with gen.block('if isinstance(%s, %s):', item,
+                                   gen.const(self.base_class, 'type')):
+                        with gen.block('try:'):
+                            gen.emit('%s.validate(%s)', field, item)
+                        with gen.block('except ValidationError, ex:'):
+                            gen.emit('%s.append(ex)', item_errors)
+                    with gen.block('else:'):
+                        compile_validate(gen, self.item_field, item,
+                                         item_errors)
+                else:
+                    compile_validate(gen, self.item_field, item, item_errors)
+            with gen.block('if %s:', item_errors):
+                # Items are validated again to locate their errors.
+                gen.emit('%s = %s._item_errors(%s)', item_errors, field, value)
+            with gen.block('if len(%s) == 1:', item_errors):
+                gen.emit('%s.append(%s[0])', errors, item_errors)
+            with gen.block('elif len(%s) > 1:', item_errors):
+                gen.emit('%s.append(MultipleErrors(%s, %s, %s))',
+                         errors, field, value, item_errors)
+
     def keyify(self, value, group=PRIMARY):
+        if self.recursive:
+            key = self._walk_key(value, group)
+            if key is not _missing:
+                return key
+
         if value is None:
             return None
         elif self.item_field is None:
@@ -163,6 +503,135 @@ class CollectionField(Field):
             return self.key_class(self._item_field_of(item).keyify(item, group)
                                   for item in self._items_of(value))
 
+    def _intern_key(self, value):
+        if value is None:
+            return None
+        return self.key_class(self._item_intern_key(item)
+                              for item in self._items_of(value))
+
+    def _item_intern_key(self, item):
+        field = self._item_field_of(item)
+        if field is None:
+            return type(item), item
+        return field._intern_key(item)
+
+    # Collections are copied, along with their items unless those cannot
+    # change in place.
+    _copied = True
+
+    def _copy(self, value, copy_entity):
+        if not isinstance(value, self.base_class):
+            return value
+        elif self.recursive:
+            # Nested collections are copied from a stack rather than by
+            # recursion, so that they can nest any depth. Each copy is made
+            # empty when it is met, and filled once its turn comes.
+            pending = []
+
+            def copy_item(item, copy_entity):
+                if self._item_field_of(item) is not self:
+                    return self._copy_item(item, copy_entity)
+                shell = self.base_class()
+                pending.append((item, shell))
+                return shell
+
+            root = self.base_class()
+            pending.append((value, root))
+            while pending:
+                item, shell = pending.pop()
+                items = self._copy_items(item, copy_item, copy_entity)
+                if isinstance(shell, list):
+                    shell.extend(items)
+                else:
+                    shell.update(items)
+            return root
+        elif self.item_field is None:
+            return copy.deepcopy(value)
+        elif not self.item_field._copied:
+            return self.base_class(value)
+        else:
+            return self._copy_items(value, self.item_field._copy, copy_entity)
+
+    def _copy_items(self, value, copy_item, copy_entity):
+        return self.base_class([copy_item(item, copy_entity)
+                                for item in value])
+
+    def _copy_item(self, item, copy_entity):
+        field = self._item_field_of(item)
+        if field is None:
+            return copy.deepcopy(item)
+        return field._copy(item, copy_entity)
+
+    # Keys of recursive collections come from a walk, or from the results of
+    # the walk in progress.
+    def _walk_key(self, value, group):
+        results = _walk.results
+        if results is None:
+            if isinstance(value, self.base_class):
+                return walk.keyify(walk.collection_node(self, value, group))
+            return _missing
+        else:
+            return results.get((id(self), id(value), group), _missing)
+
+    def _targets(self, keys):
+        if self.recursive:
+            return None
+        elif self.item_field is None:
+            return ()
+        else:
+            return self.item_field._targets(keys)
+
+    def _children(self, value, group=None):
+        nodes = []
+        if isinstance(value, self.base_class) \
+                and walk.field_needs_walk(self, group is not None):
+            for item in self._items_of(value):
+                field = self._item_field_of(item)
+                if field is self:
+                    nodes.append(walk.collection_node(self, item, group))
+                elif field is not None:
+                    nodes.extend(field._children(item, group))
+        return nodes
+
+    def from_raw(self, value):
+        if value is None:
+            return None
+        return self.base_class(self._item_from_raw(item) for item in value)
+
+    def _item_from_raw(self, item):
+        if self.recursive and isinstance(item, self.raw_class):
+            return self.from_raw(item)
+        elif self.item_field is None:
+            return item
+        else:
+            return self.item_field.from_raw(item)
+
+    def __get__(self, instance, owner):
+        value = super(CollectionField, self).__get__(instance, owner)
+        if self.item_field is not None and self.item_field.lazy \
+                and instance is not None and value is not None \
+                and not instance._resolved & self.mask:
+            # Keys of lazy items are resolved in one go, once per value.
+            if self._resolve_items(value) and instance._keys is not None:
+                instance._invalidate_keys()
+            instance._resolved |= self.mask
+        return value
+
+    def __set__(self, instance, value):
+        super(CollectionField, self).__set__(instance, value)
+        if instance._resolved & self.mask:
+            instance._resolved &= ~self.mask
+
+    def _resolve_items(self, value):
+        positions = [position for position, item in enumerate(value)
+                     if isinstance(item, tuple)]
+        if positions:
+            keys = [value[position] for position in positions]
+            entities = self.item_field.resolve_many(keys)
+            for position, entity in zip(positions, entities):
+                value[position] = entity
+        return positions
+
 
 class ListField(CollectionField):
     base_class = list
@@ -172,15 +641,49 @@ class SetField(CollectionField):
     base_class = set
     key_class = frozenset
 
+    def _resolve_items(self, value):
+        keys = [item for item in value if isinstance(item, tuple)]
+        if keys:
+            entities = self.item_field.resolve_many(keys)
+            value.difference_update(keys)
+            value.update(entities)
+        return keys
+
 
 class DictField(CollectionField):
     base_class = dict
     key_class = tuple
+    raw_class = dict
 
     def _items_of(self, value):
         return value.itervalues()
 
+    def _compile_items_of(self, gen, value):
+        return '%s.itervalues()' % value
+
+    def _positions_of(self, value):
+        return value.iteritems()
+
+    def _resolve_items(self, value):
+        names = [name for name, item in value.iteritems()
+                 if isinstance(item, tuple)]
+        if names:
+            keys = [value[name] for name in names]
+            value.update(zip(names, self.item_field.resolve_many(keys)))
+        return names
+
+    def from_raw(self, value):
+        if value is None:
+            return None
+        return dict((key, self._item_from_raw(item))
+                    for key, item in value.iteritems())
+
     def keyify(self, value, group=PRIMARY):
+        if self.recursive:
+            key = self._walk_key(value, group)
+            if key is not _missing:
+                return key
+
         if value is None:
             return None
         elif self.item_field is None:
@@ -190,3 +693,15 @@ class DictField(CollectionField):
                 (key, self._item_field_of(item).keyify(item, group))
                 for key, item in value.iteritems()
             ))
+
+    def _intern_key(self, value):
+        if value is None:
+            return None
+        return self.key_class(sorted(
+            (type(key), key, self._item_intern_key(item))
+            for key, item in value.iteritems()
+        ))
+
+    def _copy_items(self, value, copy_item, copy_entity):
+        return dict([(key, copy_item(item, copy_entity))
+                     for key, item in value.iteritems()])
@@ -0,0 +1,363 @@
+from __future__ import absolute_import
+import datetime
+from .basic import PRIMARY
+from .codegen import CodeBuilder
+from .entity import EntityField, ReferenceField, decode_key
+from .field import CollectionField, SetField, DictField, DateField, \
+    TimeField, decode_date, decode_time
+from .schema import compile_storage, compile_read
+
+try:
+    import simplejson as backend
+except ImportError:
+    import json as backend
+
+
+_encoders = dict()
+_decoders = dict()
+_group_names = dict()
+
+
+def encode(entity):
+    encoder = _encoders.get(entity.__class__)
+    if encoder is None:
+        encoder = _encoders[entity.__class__] = _compile_encoder(
+            entity.__class__
+        )
+    return encoder(entity)
+
+
+# With only, a key group or a collection of field names, only those fields
+# are decoded, and the others of the partial entity read as defaults.
+# Entities nested in a key group are decoded as far as their own fields in
+# that group.
+def decode(data, entity_class, only=None):
+    return _decoder(entity_class, *projection(entity_class, only))(data)
+
+
+def _decoder(entity_class, names=None, group=None):
+    decoder = _decoders.get((entity_class, names, group))
+    if decoder is None:
+        decoder = _decoders[entity_class, names, group] = _compile_decoder(
+            entity_class, names, group
+        )
+    return decoder
+
+
+def projection(entity_class, only):
+    # Returns the names of the fields to decode, and the key group that
+    # nested entities are decoded to, for the argument of decode().
+    if only is None:
+        return None, None
+    elif not isinstance(only, (list, tuple, set, frozenset)) \
+            and only in entity_class._groups:
+        return group_names(entity_class, only), only
+    elif isinstance(only, basestring):
+        # Strings that do not name a group name a single field.
+        only = [only]
+
+    names = frozenset(only)
+    unknown = names.difference(entity_class._fields)
+    if unknown:
+        raise ValueError('%s has no fields named %s' % (
+            entity_class.__name__, ', '.join(sorted(unknown))
+        ))
+    return names, None
+
+
+def group_names(entity_class, group):
+    names = _group_names.get((entity_class, group))
+    if names is None:
+        names = _group_names[entity_class, group] = frozenset(
+            field.name for field in entity_class._groups.get(group, ())
+        )
+    return names
+
+
+def dumps(entity):
+    return backend.dumps(encode(entity), separators=(',', ':'))
+
+
+def loads(text, entity_class, lazy=False, only=None):
+    if lazy:
+        raw = backend.loads(text)
+        if only is not None:
+            names = projection(entity_class, only)[0]
+            raw = dict((name, value) for name, value in raw.iteritems()
+                       if name in names)
+        return entity_class.from_raw(raw)
+    return decode(backend.loads(text), entity_class, only)
+
+
+def read_key(text, entity_class, group=PRIMARY):
+    # Returns the key of the encoded entity, decoding only the fields that
+    # make it up.
+    return loads(text, entity_class, only=group).keyify(group)
+
+
+class LineError(Exception):
+
+    def __init__(self, line, error):
+        super(LineError, self).__init__(line, error)
+        self.line = line
+        self.error = error
+
+    def __str__(self):
+        return 'line %d: %s' % (self.line, self.error)
+
+
+def iter_load(fileobj, entity_class, validate=False, on_error=None,
+              chunk_size=65536, only=None):
+    # Reads newline-delimited JSON in fixed-size chunks and yields one entity
+    # per line. Lines that cannot be decoded or validated are reported as
+    # LineError to on_error, or raised when no handler is given.
+    decode_line = _decoder(entity_class, *projection(entity_class, only))
+    number = 0
+    for line in _iter_lines(fileobj, chunk_size):
+        number += 1
+        if not line or line.isspace():
+            continue
+
+        try:
+            entity = decode_line(backend.loads(line))
+            if validate:
+                entity.validate()
+        except Exception, ex:
+            if on_error is None:
+                raise LineError(number, ex)
+            on_error(LineError(number, ex))
+        else:
+            yield entity
+
+
+def dump_stream(iterable, fileobj, chunk_size=65536):
+    # Writes one entity per line, flushing the buffer to the file object
+    # whenever it grows beyond chunk_size bytes. Returns the entity count.
+    count = 0
+    size = 0
+    buffer = []
+    for entity in iterable:
+        line = dumps(entity) + '\n'
+        buffer.append(line)
+        size += len(line)
+        count += 1
+        if size >= chunk_size:
+            fileobj.write(''.join(buffer))
+            del buffer[:]
+            size = 0
+
+    if buffer:
+        fileobj.write(''.join(buffer))
+    return count
+
+
+def _iter_lines(fileobj, chunk_size):
+    # Parts of a line that spans several chunks are joined once its end is
+    # read.
+    pieces = []
+    while True:
+        chunk = fileobj.read(chunk_size)
+        if not chunk:
+            break
+        elif '\n' not in chunk:
+            pieces.append(chunk)
+            continue
+
+        pieces.append(chunk)
+        lines = ''.join(pieces).split('\n')
+        pieces = [lines.pop()]
+        for line in lines:
+            yield line
+
+    rest = ''.join(pieces)
+    if rest:
+        yield rest
+
+
+def encode_key(key):
+    if isinstance(key, tuple):
+        return [encode_key(item) for item in key]
+    elif isinstance(key, frozenset):
+        return sorted(encode_key(item) for item in key)
+    elif isinstance(key, (datetime.date, datetime.datetime)):
+        return key.isoformat()
+    else:
+        return key
+
+
+def _compile_encoder(cls):
+    gen = CodeBuilder('<%s json encoder>' % cls.__name__)
+    with gen.block('def encode(self):'):
+        compile_storage(gen, cls)
+        items = []
+        for name, field in cls._fields.iteritems():
+            value = gen.local('value')
+            compile_read(gen, cls, name, value)
+            items.append('%r: %s' % (name, _encode(gen, field, value)))
+        gen.emit('return {%s}', ', '.join(items))
+    return gen.build('encode')
+
+
+def _compile_decoder(cls, names, group):
+    gen = CodeBuilder('<%s json decoder>' % cls.__name__)
+    with gen.block('def decode(data):'):
+        gen.emit('values = dict()')
+        for name, field in cls._fields.iteritems():
+            if names is not None and name not in names:
+                continue
+            with gen.block('if %r in data:', name):
+                value = gen.local('value')
+                gen.emit('%s = data[%r]', value, name)
+                gen.emit('values[%r] = %s', name,
+                         _decode(gen, field, value, group))
+        gen.emit('return %s(**values)', gen.const(cls.from_trusted, 'new'))
+    return gen.build('decode')
+
+
+def _encode(gen, field, value):
+    # Returns an expression that encodes the given variable.
+    if isinstance(field, EntityField):
+        expr = '%s(%s)' % (gen.const(encode, 'encode'), value)
+    elif isinstance(field, ReferenceField):
+        expr = '%s(%s)' % (gen.const(encode_key, 'encode_key'),
+                           reference_key(field, value))
+    elif isinstance(field, CollectionField):
+        expr = _encode_collection(gen, field, value)
+    elif isinstance(field, (DateField, TimeField)):
+        expr = '%s.isoformat()' % value
+    else:
+        expr = value
+
+    if expr == value:
+        return value
+    else:
+        return '(None if %s is None else %s)' % (value, expr)
+
+
+def reference_key(field, value):
+    # Returns an expression for the key of the entity referred to by the
+    # given variable, which lazy references may already hold.
+    expr = '%s.keyify(%r)' % (value, field.reference_group)
+    if field.lazy:
+        expr = '(%s if isinstance(%s, tuple) else %s)' % (value, value, expr)
+    return expr
+
+
+def _encode_collection(gen, field, value):
+    if field.recursive:
+        function = _compile_collection(field, _encode, 'encode')
+        return '%s(%s)' % (gen.const(function, 'encode'), value)
+
+    item = gen.local('item')
+    if field.item_field is None:
+        expr = item
+    else:
+        expr = _encode(gen, field.item_field, item)
+
+    if isinstance(field, DictField):
+        if expr == item:
+            return value
+        return 'dict((key, %s) for key, %s in %s.iteritems())' % (
+            expr, item, value
+        )
+    elif expr == item and not isinstance(field, SetField):
+        return value
+    else:
+        return '[%s for %s in %s]' % (expr, item, value)
+
+
+def _decode(gen, field, value, group=None):
+    # Returns an expression that decodes the given variable. Entities are
+    # decoded to the fields of the group, if there is one.
+    if isinstance(field, EntityField):
+        # Decoders are looked up when they run, since entities may nest
+        # their own class.
+        names = None if group is None \
+            else group_names(field.base_class, group)
+        expr = '%s(%s, %s, %s)(%s)' % (
+            gen.const(_decoder, 'decoder'),
+            gen.const(field.base_class, 'type'),
+            gen.const(names, 'names'), gen.const(group, 'group'), value
+        )
+    elif isinstance(field, ReferenceField):
+        expr = '%s(%s, %s, %r)' % (gen.const(decode_key, 'decode_key'),
+                                   value, gen.const(field.base_class, 'type'),
+                                   field.reference_group)
+        if field.lazy:
+            # Lazy references keep the key and leave loading to the loader.
+            expr = '%s.keyify(%r)' % (expr, field.reference_group)
+    elif isinstance(field, CollectionField):
+        expr = _decode_collection(gen, field, value, group)
+    elif isinstance(field, TimeField):
+        expr = '%s(%s)' % (gen.const(decode_time, 'decode_time'), value)
+    elif isinstance(field, DateField):
+        expr = '%s(%s)' % (gen.const(decode_date, 'decode_date'), value)
+    else:
+        expr = value
+
+    if expr == value:
+        return value
+    else:
+        return '(None if %s is None else %s)' % (value, expr)
+
+
+def _decode_collection(gen, field, value, group=None):
+    if field.recursive:
+        function = _compile_collection(
+            field, lambda gen, item_field, item: _decode(gen, item_field,
+                                                         item, group),
+            'decode'
+        )
+        return '%s(%s)' % (gen.const(function, 'decode'), value)
+
+    item = gen.local('item')
+    if field.item_field is None:
+        expr = item
+    else:
+        expr = _decode(gen, field.item_field, item, group)
+
+    if isinstance(field, DictField):
+        if expr == item:
+            return value
+        return 'dict((key, %s) for key, %s in %s.iteritems())' % (
+            expr, item, value
+        )
+    elif isinstance(field, SetField):
+        if expr == item:
+            return 'set(%s)' % value
+        return 'set(%s for %s in %s)' % (expr, item, value)
+    elif expr == item:
+        return value
+    else:
+        return '[%s for %s in %s]' % (expr, item, value)
+
+
+def _compile_collection(field, compile_item, name):
+    # Recursive collections need a real function to call into themselves.
+    # Nested collections are recognized by their type: the field's own type
+    # when encoding and the matching JSON container type when decoding.
+    gen = CodeBuilder('<%s json %sr>' % (field.full_name(), name))
+    if name == 'encode':
+        nested = field.base_class
+    elif isinstance(field, DictField):
+        nested = dict
+    else:
+        nested = list
+
+    with gen.block('def %s(value):', name):
+        if field.item_field is None:
+            expr = 'item'
+        else:
+            expr = compile_item(gen, field.item_field, 'item')
+        expr = '%s(item) if isinstance(item, %s) else %s' % (
+            name, gen.const(nested, 'type'), expr
+        )
+
+        if isinstance(field, DictField):
+            gen.emit('return dict((key, %s) for key, item in '
+                     'value.iteritems())', expr)
+        elif name == 'decode' and isinstance(field, SetField):
+            gen.emit('return set(%s for item in value)', expr)
+        else:
+            gen.emit('return [%s for item in value]', expr)
+    return gen.build(name)
@@ -0,0 +1,60 @@
+from collections import OrderedDict
+from basic import PRIMARY
+
+
+class Loader(object):
+    # Resolves keys of lazy references through a user function, keeping the
+    # most recently used entities in a bounded cache. The function receives a
+    # list of keys and a group, and returns the matching entities (or None
+    # for keys that do not exist) in the same order.
+
+    def __init__(self, function, size=1024):
+        self.function = function
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._cache = OrderedDict()
+
+    def load(self, key, group=PRIMARY):
+        return self.load_many([key], group)[0]
+
+    def load_many(self, keys, group=PRIMARY):
+        found = dict()
+        missing = []
+        for key in keys:
+            if key in found:
+                continue
+            entity = self._cache.pop((group, key), None)
+            if entity is None:
+                self.misses += 1
+                found[key] = None
+                missing.append(key)
+            else:
+                self.hits += 1
+                self._cache[group, key] = entity
+                found[key] = entity
+
+        if missing:
+            entities = list(self.function(missing, group))
+            if len(entities) != len(missing):
+                raise ValueError('loader returned %d results for %d keys'
+                                 % (len(entities), len(missing)))
+            for key, entity in zip(missing, entities):
+                if entity is None:
+                    raise KeyError(key)
+                found[key] = self._cache[group, key] = entity
+            while len(self._cache) > self.size:
+                self._cache.popitem(last=False)
+
+        return [found[key] for key in keys]
+
+    def clear(self):
+        self._cache.clear()
+
+    def __len__(self):
+        return len(self._cache)
+
+
+def register_loader(entity_class, function, size=1024):
+    loader = entity_class._loader = Loader(function, size)
+    return loader
@@ -0,0 +1,86 @@
+import itertools
+import multiprocessing
+import sys
+from basic import ValidationError
+
+
+# Worker processes get the entities from the pool initializer, which forked
+# workers inherit without pickling, so that only index ranges and errors
+# have to be pickled. Workers that the pool starts again get them the same
+# way.
+_shared = None
+
+
+def validate_many(entities, workers=None, chunksize=1000,
+                  fail_fast=False, max_errors=None):
+    # Validates the entities in chunks, in worker processes when more than
+    # one worker is asked for. Returns the errors of every invalid entity as
+    # lists of ErrorRecord, keyed by the position of the entity in the input.
+    # Error limits apply to each entity separately.
+    if fail_fast:
+        max_errors = 1
+
+    if workers is None or workers <= 1:
+        tasks = ((start, chunk, max_errors)
+                 for start, chunk in _chunks(entities, chunksize))
+        return _collect(itertools.imap(_validate_chunk, tasks))
+
+    if sys.platform == 'win32':
+        # Workers are not forked here, so the entities are pickled instead.
+        tasks = ((start, chunk, max_errors)
+                 for start, chunk in _chunks(entities, chunksize))
+        pool = multiprocessing.Pool(workers)
+    else:
+        entities = list(entities)
+        tasks = ((start, None, max_errors)
+                 for start in xrange(0, len(entities), chunksize))
+        pool = multiprocessing.Pool(workers, initializer=_share,
+                                    initargs=(entities, chunksize))
+
+    try:
+        errors = _collect(pool.imap_unordered(_validate_chunk, tasks))
+    except:
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()
+    return errors
+
+
+def _chunks(entities, chunksize):
+    iterator = iter(entities)
+    start = 0
+    while True:
+        chunk = list(itertools.islice(iterator, chunksize))
+        if not chunk:
+            break
+        yield start, chunk
+        start += len(chunk)
+
+
+def _share(entities, chunksize):
+    global _shared
+    _shared = (entities, chunksize)
+
+
+def _validate_chunk((start, entities, max_errors)):
+    if entities is None:
+        shared, chunksize = _shared
+        entities = shared[start:start + chunksize]
+
+    errors = []
+    for index, entity in enumerate(entities, start):
+        try:
+            entity.validate(max_errors=max_errors)
+        except ValidationError, ex:
+            errors.append((index, ex.flatten()))
+    return errors
+
+
+def _collect(results):
+    errors = dict()
+    for chunk in results:
+        errors.update(chunk)
+    return errors
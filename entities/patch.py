@@ -0,0 +1,238 @@
+import datetime
+from entity import Entity, EntityField, ReferenceField
+from field import CollectionField, DictField, SetField, DateField, TimeField
+
+
+# Patches map the names of changed fields to changes, and are made of lists,
+# dicts and the plain values that JSON encoding produces:
+#
+#   ['=', value]                replace the value
+#   ['e', patch]                patch the entity in place
+#   ['i', [[index, change]]]    change list items in place
+#   ['l', start, stop, items]   replace a slice of a list
+#   ['d', {key: change}, keys]  change or add dict items, then remove keys
+#   ['s', added, removed]       add and remove set items
+#
+# Identical objects are never compared further, so the cost of diffing
+# follows the size of the change rather than the size of the entities.
+#
+# Replaced values are restored by from_raw() of their field, which knows
+# only the class of the field. Entities of a subclass keep their class when
+# they are patched in place, but replacing one with ['='] restores an entity
+# of the field's class, with only the fields of that class.
+
+def diff(old, new):
+    if type(old) is not type(new):
+        raise TypeError('cannot diff %s against %s'
+                        % (type(old).__name__, type(new).__name__))
+    return _diff_entity(old, new)
+
+
+def apply_patch(entity, patch):
+    for name, change in patch.iteritems():
+        field = entity._fields[name]
+        if change[0] == '=':
+            value = field.from_raw(change[1])
+        else:
+            value = _apply(field, entity._get_value(name), change)
+        # Setting the value again marks it dirty and invalidates keys even
+        # if it was changed in place.
+        field.__set__(entity, value)
+    return entity
+
+
+def _diff_entity(old, new):
+    patch = dict()
+    for name, field in old._fields.iteritems():
+        change = _diff(field, old._get_value(name), new._get_value(name))
+        if change is not None:
+            patch[name] = change
+    return patch
+
+
+def _diff(field, old, new):
+    # Returns the change that turns the old value into the new one, or None
+    # if they are the same.
+    if old is new:
+        return None
+    elif old is None or new is None or field is None:
+        pass
+    elif isinstance(field, EntityField):
+        # Interned entities cannot be patched, and are only the same if they
+        # are identical.
+        if type(old) is type(new) and isinstance(old, Entity) \
+                and not old.__interned__:
+            patch = _diff_entity(old, new)
+            return ['e', patch] if patch else None
+    elif isinstance(field, ReferenceField):
+        if _reference_key(field, old) == _reference_key(field, new):
+            return None
+    elif isinstance(field, CollectionField):
+        if isinstance(old, field.base_class) \
+                and isinstance(new, field.base_class):
+            if isinstance(field, DictField):
+                return _diff_dict(field, old, new)
+            elif isinstance(field, SetField):
+                return _diff_set(field, old, new)
+            else:
+                return _diff_list(field, old, new)
+
+    if type(old) is type(new) and old == new:
+        return None
+    return ['=', _to_raw(field, new)]
+
+
+def _diff_item(field, old, new):
+    if old is new:
+        return None
+    return _diff(field._item_field_of(new), old, new)
+
+
+def _diff_list(field, old, new):
+    if len(old) == len(new):
+        changes = []
+        for index, (old_item, new_item) in enumerate(zip(old, new)):
+            change = _diff_item(field, old_item, new_item)
+            if change is not None:
+                changes.append([index, change])
+        return ['i', changes] if changes else None
+
+    # Items were inserted or removed, so the part between the common prefix
+    # and suffix is replaced.
+    start = 0
+    size = min(len(old), len(new))
+    while start < size \
+            and _diff_item(field, old[start], new[start]) is None:
+        start += 1
+    old_stop, new_stop = len(old), len(new)
+    while old_stop > start and new_stop > start \
+            and _diff_item(field, old[old_stop - 1],
+                           new[new_stop - 1]) is None:
+        old_stop -= 1
+        new_stop -= 1
+    return ['l', start, old_stop,
+            [_item_to_raw(field, item) for item in new[start:new_stop]]]
+
+
+def _diff_dict(field, old, new):
+    changes = dict()
+    for key, item in new.iteritems():
+        if key in old:
+            change = _diff_item(field, old[key], item)
+            if change is not None:
+                changes[key] = change
+        else:
+            changes[key] = ['=', _item_to_raw(field, item)]
+    removed = [key for key in old if key not in new]
+    if changes or removed:
+        return ['d', changes, removed]
+    return None
+
+
+def _diff_set(field, old, new):
+    if _keyed_items(field):
+        old_items = dict((_item_key(field, item), item) for item in old)
+        new_items = dict((_item_key(field, item), item) for item in new)
+        added = [item for key, item in new_items.iteritems()
+                 if key not in old_items]
+        removed = [item for key, item in old_items.iteritems()
+                   if key not in new_items]
+    else:
+        added = new - old
+        removed = old - new
+    if added or removed:
+        return ['s', [_item_to_raw(field, item) for item in added],
+                [_item_to_raw(field, item) for item in removed]]
+    return None
+
+
+def _apply(field, value, change):
+    kind = change[0]
+    if kind == 'e':
+        apply_patch(value, change[1])
+    elif kind == 'i':
+        for index, item_change in change[1]:
+            value[index] = _apply_item(field, value[index], item_change)
+    elif kind == 'l':
+        kind, start, stop, items = change
+        value[start:stop] = [field._item_from_raw(item) for item in items]
+    elif kind == 'd':
+        kind, changes, removed = change
+        for key, item_change in changes.iteritems():
+            value[key] = _apply_item(field, value.get(key), item_change)
+        for key in removed:
+            del value[key]
+    elif kind == 's':
+        kind, added, removed = change
+        if _keyed_items(field):
+            # Removed entities are built anew, so they are matched by key.
+            keys = set(_item_key(field, field._item_from_raw(item))
+                       for item in removed)
+            value.difference_update([item for item in value
+                                     if _item_key(field, item) in keys])
+        else:
+            value.difference_update(field._item_from_raw(item)
+                                    for item in removed)
+        value.update(field._item_from_raw(item) for item in added)
+    else:
+        raise ValueError('unknown change %r' % kind)
+    return value
+
+
+def _apply_item(field, item, change):
+    if change[0] == '=':
+        return field._item_from_raw(change[1])
+    return _apply(field._item_field_of(item), item, change)
+
+
+# Entities in sets are told apart by their keys, like references are,
+# rather than by identity.
+def _keyed_items(field):
+    return isinstance(field.item_field, (EntityField, ReferenceField))
+
+
+def _item_key(field, item):
+    if isinstance(field.item_field, ReferenceField):
+        return _reference_key(field.item_field, item)
+    return item.keyify()
+
+
+def _reference_key(field, value):
+    if field.lazy and isinstance(value, tuple):
+        return value
+    return value.keyify(field.reference_group)
+
+
+def _to_raw(field, value):
+    # Converts a value to the plain form that from_raw() accepts.
+    if value is None or field is None:
+        return value
+    elif isinstance(field, EntityField):
+        return dict((name, _to_raw(child, value._get_value(name)))
+                    for name, child in value._fields.iteritems())
+    elif isinstance(field, ReferenceField):
+        return _key_to_raw(_reference_key(field, value))
+    elif isinstance(field, DictField):
+        return dict((key, _item_to_raw(field, item))
+                    for key, item in value.iteritems())
+    elif isinstance(field, CollectionField):
+        return [_item_to_raw(field, item) for item in value]
+    elif isinstance(field, (DateField, TimeField)):
+        return value.isoformat()
+    else:
+        return value
+
+
+def _item_to_raw(field, item):
+    return _to_raw(field._item_field_of(item), item)
+
+
+def _key_to_raw(key):
+    if isinstance(key, tuple):
+        return [_key_to_raw(item) for item in key]
+    elif isinstance(key, frozenset):
+        return sorted(_key_to_raw(item) for item in key)
+    elif isinstance(key, (datetime.date, datetime.datetime)):
+        return key.isoformat()
+    else:
+        return key
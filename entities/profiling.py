@@ -0,0 +1,132 @@
+from __future__ import absolute_import
+import json
+import threading
+import timeit
+from .entity import Entity
+from .field import Field
+from .walk import _subclasses
+
+
+# Field methods that are counted and timed while profiling is enabled, by
+# the name they are reported under.
+OPERATIONS = dict(validate='validate', keyify='keyify',
+                  make_default='make_default', get='__get__', set='__set__')
+
+_timer = timeit.default_timer
+
+# Calls and seconds spent, by (field, operation).
+_stats = dict()
+
+# Methods that enable() replaced, as (class, name, original) tuples.
+_patched = []
+
+
+class _Active(threading.local):
+
+    def __init__(self):
+        self.calls = set()
+
+
+# Calls that are in progress, so that a method calling the one it overrides,
+# or a recursive collection validating its own items, is only counted once.
+_active = _Active()
+
+
+def enable():
+    # Replaces the field methods with instrumented ones, so that nothing is
+    # measured, or slowed down, while profiling is disabled. Classes created
+    # afterwards are only instrumented by the next enable().
+    if _patched:
+        return
+
+    for klass in set(_subclasses(Field)):
+        for operation, name in OPERATIONS.iteritems():
+            original = vars(klass).get(name)
+            if original is not None:
+                _patched.append((klass, name, original))
+                setattr(klass, name, _instrument(original, operation))
+
+    # Compiled validators check most fields inline, so entities fall back to
+    # validating every field through its methods.
+    for cls in set(_subclasses(Entity)):
+        original = vars(cls).get('_validate')
+        if getattr(original, 'generated', False):
+            _patched.append((cls, '_validate', original))
+            cls._validate = vars(Entity)['_validate']
+
+
+def disable():
+    while _patched:
+        klass, name, original = _patched.pop()
+        setattr(klass, name, original)
+
+
+def is_enabled():
+    return bool(_patched)
+
+
+def reset():
+    _stats.clear()
+
+
+def snapshot():
+    # Returns the statistics gathered so far as {field name: {operation:
+    # {'calls': count, 'time': seconds}}}. Fields are named after the entity
+    # class that holds them, followed by their full name.
+    owners = _owners()
+    result = dict()
+    for (field, operation), (calls, seconds) in _stats.items():
+        operations = result.setdefault(_label(field, owners), dict())
+        stats = operations.get(operation)
+        if stats is None:
+            operations[operation] = dict(calls=calls, time=seconds)
+        else:
+            stats['calls'] += calls
+            stats['time'] += seconds
+    return result
+
+
+def export(fileobj):
+    json.dump(snapshot(), fileobj, indent=2, sort_keys=True)
+
+
+def _instrument(function, operation):
+    def instrumented(self, *args, **kwargs):
+        calls = _active.calls
+        call = (self, operation)
+        if call in calls:
+            return function(self, *args, **kwargs)
+
+        calls.add(call)
+        start = _timer()
+        try:
+            return function(self, *args, **kwargs)
+        finally:
+            elapsed = _timer() - start
+            calls.discard(call)
+            stats = _stats.get(call)
+            if stats is None:
+                stats = _stats.setdefault(call, [0, 0.0])
+            stats[0] += 1
+            stats[1] += elapsed
+
+    instrumented.__name__ = function.__name__
+    return instrumented
+
+
+def _owners():
+    owners = dict()
+    for cls in _subclasses(Entity):
+        for field in cls._fields.itervalues():
+            owners.setdefault(field, cls)
+    return owners
+
+
+def _label(field, owners):
+    top = field
+    while top.container is not None:
+        top = top.container
+    owner = owners.get(top)
+    if owner is None:
+        return field.full_name()
+    return '%s.%s' % (owner.__name__, field.full_name())
@@ -0,0 +1,319 @@
+import datetime
+import hashlib
+import itertools
+import mmap
+import struct
+import pytz
+from basic import PRIMARY
+from field import BooleanField, IntegerField, FloatField, DateField, \
+    TimeField
+from streams import BUFFER_SIZE, _sort
+
+
+# Files start with a header, followed by fixed-width records and, if they
+# were written with an index, the sorted primary keys of the records.
+MAGIC = 'ENTREC\x00\x01'
+_header = struct.Struct('<8s20sQIQQ')
+
+# Columns are read this many records at a time.
+CHUNK_SIZE = 4096
+
+_epoch = datetime.datetime(1970, 1, 1, tzinfo=pytz.utc)
+
+
+def _encode_time(value):
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=pytz.utc)
+    delta = value - _epoch
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+
+def _decode_time(value):
+    return _epoch + datetime.timedelta(microseconds=value)
+
+
+# Struct codes and conversions of the supported fields, with subclasses
+# before their bases. Booleans, integers and floats are stored as they are.
+_codecs = [
+    (BooleanField, '?', None, None),
+    (IntegerField, 'q', None, None),
+    (FloatField, 'd', None, None),
+    (TimeField, 'q', _encode_time, _decode_time),
+    (DateField, 'i', datetime.date.toordinal, datetime.date.fromordinal),
+]
+
+
+def _codec(cls, field):
+    for field_class, code, encode, decode in _codecs:
+        if isinstance(field, field_class):
+            return code, encode, decode
+    raise TypeError('%s.%s cannot be stored in record files'
+                    % (cls.__name__, field.name))
+
+
+# Keys are packed so that they sort like the values they hold: big-endian,
+# with the sign bit of integers flipped, and every bit of negative floats.
+def _pack_integer(value):
+    return struct.pack('>Q', value + (1 << 63))
+
+
+def _pack_float(value):
+    # Negative zero is equal to zero, so it is packed the same.
+    bits, = struct.unpack('>Q', struct.pack('>d', value or 0.0))
+    if bits & (1 << 63):
+        bits ^= (1 << 64) - 1
+    else:
+        bits |= 1 << 63
+    return struct.pack('>Q', bits)
+
+
+_key_packers = dict(
+    q=(8, _pack_integer), d=(8, _pack_float),
+    i=(4, lambda value: struct.pack('>I', value)),
+)
+_key_packers['?'] = (1, lambda value: '\x01' if value else '\x00')
+
+
+class _Layout(object):
+    # The struct layout of the records of an entity class. Records start
+    # with a bit for each field that is set when its value is None.
+
+    def __init__(self, cls):
+        self.cls = cls
+        self.names = list(cls._fields)
+        self.codecs = [_codec(cls, field)
+                       for field in cls._fields.itervalues()]
+        self.flag_size = (len(self.names) + 7) // 8
+        self.record = struct.Struct(
+            '<' + 'B' * self.flag_size
+            + ''.join(code for code, encode, decode in self.codecs)
+        )
+        self.positions = dict()
+        self.offsets = dict()
+        offset = self.flag_size
+        for position, name in enumerate(self.names):
+            self.positions[name] = position
+            self.offsets[name] = offset
+            offset += struct.calcsize('<' + self.codecs[position][0])
+
+        self.key_names = [field.name
+                          for field in cls._groups.get(PRIMARY, ())]
+        self.key_codecs = [self.codecs[self.positions[name]]
+                           for name in self.key_names]
+        self.key_size = sum(1 + _key_packers[code][0]
+                            for code, encode, decode in self.key_codecs) + 8
+
+        description = ' '.join(
+            '%s:%s' % (name, code)
+            for name, (code, encode, decode) in zip(self.names, self.codecs)
+        ) + ' key:' + ','.join(self.key_names)
+        self.fingerprint = hashlib.sha1(description).digest()
+
+    def pack(self, entity):
+        flags = [0] * self.flag_size
+        values = []
+        for position, (name, (code, encode, decode)) in \
+                enumerate(zip(self.names, self.codecs)):
+            value = entity._get_value(name)
+            if value is None:
+                flags[position // 8] |= 1 << (position % 8)
+                value = 0
+            elif encode is not None:
+                value = encode(value)
+            values.append(value)
+        return self.record.pack(*(flags + values))
+
+    def pack_key(self, key):
+        parts = []
+        for (code, encode, decode), value in zip(self.key_codecs, key):
+            size, pack = _key_packers[code]
+            if value is None:
+                parts.append('\x00' * (size + 1))
+            else:
+                if encode is not None:
+                    value = encode(value)
+                parts.append('\x01' + pack(value))
+        return ''.join(parts)
+
+
+def write_records(path, cls, entities, index=False,
+                  buffer_size=BUFFER_SIZE):
+    # Writes the entities to a record file and returns their number. With
+    # an index, the primary keys of the records are sorted, spilling to
+    # temporary files like group_by(), and appended to the file.
+    layout = _Layout(cls)
+    count = [0]
+    with open(path, 'wb') as fileobj:
+        fileobj.write(_header.pack(MAGIC, layout.fingerprint, 0,
+                                   layout.record.size, 0, 0))
+
+        def write():
+            for number, entity in enumerate(entities):
+                fileobj.write(layout.pack(entity))
+                count[0] += 1
+                if index:
+                    yield (layout.pack_key(entity.keyify(PRIMARY)), number)
+
+        key_offset = key_count = 0
+        if index:
+            # Sorting takes every key before it returns the first one, so
+            # all the records are written by then.
+            keys = _sort(write(), buffer_size, None, False)
+            for key, number in keys:
+                if not key_count:
+                    key_offset = fileobj.tell()
+                fileobj.write(key + struct.pack('>Q', number))
+                key_count += 1
+            if not key_count:
+                key_offset = fileobj.tell()
+        else:
+            for _ in write():
+                pass
+
+        fileobj.seek(0)
+        fileobj.write(_header.pack(MAGIC, layout.fingerprint, count[0],
+                                   layout.record.size, key_offset,
+                                   key_count))
+    return count[0]
+
+
+class RecordFile(object):
+    # Maps a record file into memory. Records are read as entities whose
+    # values are decoded when they are first read, and which can only be
+    # read while the file is open.
+
+    def __init__(self, path, cls):
+        self.cls = cls
+        self._layout = layout = _Layout(cls)
+        self._file = open(path, 'rb')
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+        except:
+            self._file.close()
+            raise
+
+        if len(self._map) < _header.size:
+            self.close()
+            raise ValueError('%s is not a record file' % path)
+        (magic, fingerprint, self._count, record_size, self._key_offset,
+         self._key_count) = _header.unpack_from(self._map)
+        if magic != MAGIC:
+            self.close()
+            raise ValueError('%s is not a record file' % path)
+        elif fingerprint != layout.fingerprint \
+                or record_size != layout.record.size:
+            self.close()
+            raise ValueError('%s was not written for the schema of %s'
+                             % (path, cls.__name__))
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, number):
+        if number < 0:
+            number += self._count
+        if not 0 <= number < self._count:
+            raise IndexError('record number out of range')
+        return self.cls.from_raw(_Record(
+            self._layout, self._map,
+            _header.size + number * self._layout.record.size
+        ))
+
+    def __iter__(self):
+        for number in xrange(self._count):
+            yield self[number]
+
+    def column(self, name):
+        # Yields the values of one field for every record, reading chunks of
+        # records at once instead of making an object for each.
+        layout = self._layout
+        position = layout.positions[name]
+        code, encode, decode = layout.codecs[position]
+        flag_offset, bit = position // 8, 1 << (position % 8)
+        offset = layout.offsets[name]
+        size = struct.calcsize('<' + code)
+        stride = layout.record.size
+        pattern = '%dxB%dx%s%dx' % (flag_offset, offset - flag_offset - 1,
+                                    code, stride - offset - size)
+
+        chunk = struct.Struct('<' + pattern * CHUNK_SIZE)
+        for start in xrange(0, self._count, CHUNK_SIZE):
+            if self._count - start < CHUNK_SIZE:
+                chunk = struct.Struct('<' + pattern * (self._count - start))
+            values = iter(chunk.unpack_from(self._map,
+                                            _header.size + start * stride))
+            for flags, value in itertools.izip(values, values):
+                if flags & bit:
+                    yield None
+                elif decode is None:
+                    yield value
+                else:
+                    yield decode(value)
+
+    def find(self, key):
+        # Looks up the record with the primary key by binary search, and
+        # returns None if there is none.
+        if not self._key_offset:
+            raise LookupError('record file has no index')
+
+        layout = self._layout
+        packed = layout.pack_key(key)
+        size = layout.key_size
+        width = size - 8
+        low, high = 0, self._key_count
+        while low < high:
+            middle = (low + high) // 2
+            start = self._key_offset + middle * size
+            if self._map[start:start + width] < packed:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self._key_count:
+            start = self._key_offset + low * size
+            if self._map[start:start + width] == packed:
+                number, = struct.unpack_from('>Q', self._map, start + width)
+                return self[number]
+        return None
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class _Record(object):
+    # The raw mapping of a record, which decodes values from the file.
+
+    def __init__(self, layout, data, offset):
+        self.layout = layout
+        self.data = data
+        self.offset = offset
+
+    def __contains__(self, name):
+        return name in self.layout.offsets
+
+    def __getitem__(self, name):
+        layout = self.layout
+        position = layout.positions[name]
+        flags = ord(self.data[self.offset + position // 8])
+        if flags & (1 << (position % 8)):
+            return None
+        code, encode, decode = layout.codecs[position]
+        value, = struct.unpack_from('<' + code, self.data,
+                                    self.offset + layout.offsets[name])
+        if decode is not None:
+            value = decode(value)
+        return value
+
+    # Entities that are pickled take their values along rather than the
+    # file.
+    def __reduce__(self):
+        return dict, ([(name, self[name]) for name in self.layout.names],)
@@ -0,0 +1,200 @@
+from basic import PRIMARY
+from entity import EntityField, ReferenceField
+from walk import _dependencies
+from field import CollectionField
+
+
+class DuplicateKeyError(ValueError):
+
+    def __init__(self, key, entity):
+        super(DuplicateKeyError, self).__init__(key, entity)
+        self.key = key
+        self.entity = entity
+
+    def __str__(self):
+        return 'duplicate key %r' % (self.key,)
+
+
+class _Entry(object):
+    # Registers with the entity (and with everything its keys depend on) like
+    # a containing entity would, so that changing a grouped field reindexes
+    # the entity.
+    __slots__ = ('entity', 'repository', 'keys', '__weakref__')
+
+    def __init__(self, entity):
+        self.entity = entity
+        self.repository = None
+        self.keys = None
+
+    def _invalidate_keys(self):
+        if self.repository is not None:
+            self.repository._reindex(self)
+
+
+class EntityRepository(object):
+
+    def __init__(self, entity_class, entities=()):
+        self.entity_class = entity_class
+        # Keys are kept as tuples that follow the order of the groups. The
+        # primary key, if any, comes first.
+        self._groups = sorted(entity_class._groups)
+        self._indexes = [dict() for group in self._groups]
+        self._unique = PRIMARY in entity_class._groups
+        # Keys made of plain values depend on nothing but the entity itself.
+        self._flat = not any(
+            isinstance(field, (EntityField, ReferenceField, CollectionField))
+            for fields in entity_class._groups.itervalues()
+            for field in fields
+        )
+        self._entries = dict()
+        self.insert_many(entities)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __iter__(self):
+        return (entry.entity for entry in self._entries.values())
+
+    def __contains__(self, entity):
+        return id(entity) in self._entries
+
+    def get(self, key, default=None):
+        entry = self._indexes[0].get(key) if self._unique else None
+        return default if entry is None else entry.entity
+
+    def find(self, key, group=PRIMARY):
+        found = self._indexes[self._groups.index(group)].get(key)
+        if found is None:
+            return []
+        elif group == PRIMARY:
+            return [found.entity]
+        else:
+            return [entry.entity for entry in found]
+
+    def insert(self, entity):
+        self.insert_many([entity])
+
+    def insert_many(self, entities):
+        # Either all of the entities are inserted or none of them.
+        entries = []
+        primary_keys = set()
+        ids = set()
+        for entity in entities:
+            if id(entity) in ids:
+                raise ValueError('%r is inserted twice' % entity)
+            ids.add(id(entity))
+            entry = self._make_entry(entity)
+            if self._unique:
+                key = entry.keys[0]
+                if key in self._indexes[0] or key in primary_keys:
+                    raise DuplicateKeyError(key, entity)
+                primary_keys.add(key)
+            entries.append(entry)
+
+        for entry in entries:
+            self._add(entry)
+
+    def upsert(self, entity):
+        self.upsert_many([entity])
+
+    def upsert_many(self, entities):
+        # Entities replace the ones that have the same primary key.
+        for entity in entities:
+            if id(entity) in self._entries:
+                continue
+            entry = self._make_entry(entity)
+            if self._unique:
+                existing = self._indexes[0].get(entry.keys[0])
+                if existing is not None:
+                    self._remove(existing)
+            self._add(entry)
+
+    def delete(self, entity):
+        self.delete_many([entity])
+
+    def delete_many(self, entities):
+        entities = list(entities)
+        for entity in entities:
+            if id(entity) not in self._entries:
+                raise KeyError(entity)
+        for entity in entities:
+            self._remove(self._entries[id(entity)])
+
+    def _make_entry(self, entity):
+        if not isinstance(entity, self.entity_class):
+            raise TypeError('expected %s, got %r'
+                            % (self.entity_class.__name__, entity))
+        elif id(entity) in self._entries:
+            raise ValueError('%r is already in the repository' % entity)
+
+        entry = _Entry(entity)
+        entry.keys = self._keys_of(entry)
+        return entry
+
+    def _keys_of(self, entry):
+        entity = entry.entity
+        if self._flat:
+            keys = tuple(entity.keyify(group) for group in self._groups)
+            entity._add_container(entry)
+            return keys
+
+        dependencies = []
+        stack = _dependencies.stack
+        stack.append(dependencies)
+        try:
+            keys = tuple(entity.keyify(group) for group in self._groups)
+        finally:
+            stack.pop()
+
+        for dependency in dependencies:
+            dependency._add_container(entry)
+        return keys
+
+    def _link(self, entry, position, key):
+        if position == 0 and self._unique:
+            self._indexes[0][key] = entry
+        else:
+            self._indexes[position].setdefault(key, []).append(entry)
+
+    def _unlink(self, entry, position, key):
+        index = self._indexes[position]
+        if position == 0 and self._unique:
+            del index[key]
+        else:
+            entries = index[key]
+            entries.remove(entry)
+            if not entries:
+                del index[key]
+
+    def _add(self, entry):
+        entry.repository = self
+        self._entries[id(entry.entity)] = entry
+        for position, key in enumerate(entry.keys):
+            self._link(entry, position, key)
+
+    def _remove(self, entry):
+        entry.repository = None
+        del self._entries[id(entry.entity)]
+        for position, key in enumerate(entry.keys):
+            self._unlink(entry, position, key)
+
+    def _reindex(self, entry):
+        # A change that would duplicate a primary key is refused and the
+        # entity stays indexed under its old keys.
+        keys = self._keys_of(entry)
+        if keys == entry.keys:
+            return
+        elif self._unique and keys[0] != entry.keys[0] \
+                and keys[0] in self._indexes[0]:
+            raise DuplicateKeyError(keys[0], entry.entity)
+
+        for position, (old, new) in enumerate(zip(entry.keys, keys)):
+            if old != new:
+                self._unlink(entry, position, old)
+                self._link(entry, position, new)
+        entry.keys = keys
+
+    def __repr__(self):
+        return '%s(%s, <%d entities>)' % (self.__class__.__name__,
+                                          self.entity_class.__name__,
+                                          len(self._entries))
@@ -1,19 +1,52 @@
+import weakref
 from collections import OrderedDict
+from codegen import CodeBuilder, compile_validate
 from field import Field
+import walk
+
+
+_missing = object()
 
 
 class Schema(type):
 
     def __new__(mcs, name, bases, attrs):
-        cls = super(Schema, mcs).__new__(mcs, name, bases, attrs)
-
-        fields = [(name, field) for name, field in attrs.iteritems()
-                  if isinstance(field, Field)]
+        fields = [(key, value) for key, value in attrs.iteritems()
+                  if isinstance(value, Field)]
         fields.sort(key=lambda item: item[1].index)
+
+        inherited = any(getattr(base, '__compact__', False) for base in bases)
+        compact = attrs.get('__compact__', inherited)
+        interned = any(getattr(base, '__interned__', False) for base in bases)
+        if interned and not attrs.get('__interned__', True):
+            raise TypeError('subclasses of interned entities are interned')
+        interned = attrs.get('__interned__', interned)
+        if compact:
+            # Slots take the names of the fields; the fields themselves are
+            # put back in place of the member descriptors below.
+            attrs = dict((key, value) for key, value in attrs.iteritems()
+                         if not isinstance(value, Field))
+            attrs['__slots__'] = tuple(key for key, value in fields)
+            if not inherited:
+                attrs['__slots__'] += ('_dirty',)
+            if interned and not any(getattr(base, '__compact__', False) and
+                                    getattr(base, '__interned__', False)
+                                    for base in bases):
+                attrs['__slots__'] += ('_frozen', '_key', '_hash')
+                if not any(base.__weakrefoffset__ for base in bases):
+                    attrs['__slots__'] += ('__weakref__',)
+
+        if interned:
+            mcs = _InternedSchema
+        cls = super(Schema, mcs).__new__(mcs, name, bases, attrs)
         cls._fields = OrderedDict(fields)
 
-        for name, field in cls._fields.iteritems():
-            field.name = name
+        for position, (key, field) in enumerate(cls._fields.iteritems()):
+            field.name = key
+            field.mask = 1 << position
+            if compact:
+                field.slot = vars(cls)[key]
+                setattr(cls, key, field)
 
         cls._groups = dict()
         for field in cls._fields.itervalues():
@@ -24,4 +57,286 @@ class Schema(type):
                 else:
                     group_fields.append(field)
 
+        # Fields that may lead to other entities or recursive collections.
+        cls._nested_fields = [field for field in cls._fields.itervalues()
+                              if _nests(field, False)]
+        cls._nested_groups = dict()
+        for group, group_fields in cls._groups.iteritems():
+            group_fields = [field for field in group_fields
+                            if _nests(field, True)]
+            if group_fields:
+                cls._nested_groups[group] = group_fields
+        cls._deep = cls._deep_keys = cls._shares = None
+
+        # Fields whose values are copied along with the entity.
+        cls._copied_fields = [field for field in cls._fields.itervalues()
+                              if field._copied]
+        if cls._nested_fields or cls._nested_groups:
+            walk.reset()
+
+        if compact:
+            cls._get_value = _get_slot_value
+            cls.from_trusted = classmethod(_from_trusted_slots)
+            cls.__getstate__ = _get_slot_state
+            cls.__setstate__ = _set_slot_state
+
+        if interned:
+            # Interned entities can only be keyed by the entities they hold
+            # if those are interned, and therefore immutable, as well.
+            for field in cls._fields.itervalues():
+                for target in field._targets(False) or ():
+                    if not getattr(target, '__interned__', False):
+                        raise TypeError(
+                            '%s.%s holds entities that are not interned'
+                            % (name, field.name)
+                        )
+            cls._interned = weakref.WeakValueDictionary()
+            if cls.from_trusted.__func__ is not _from_trusted_interned:
+                cls._from_trusted = classmethod(cls.from_trusted.__func__)
+                cls.from_trusted = classmethod(_from_trusted_interned)
+            cls.__reduce__ = _reduce_interned
+            cls.__eq__ = _eq_interned
+            cls.__ne__ = _ne_interned
+            cls.__hash__ = _hash_interned
+            if '_intern' not in attrs:
+                cls._intern = _compile_intern(cls)
+
+        if '_validate' not in attrs:
+            cls._validate = _compile_validate(cls)
+
+        if any(isinstance(base, Schema) for base in bases):
+            if '__init__' in attrs:
+                # Hand-written constructors may assign fields before (or
+                # instead of) calling the base constructor.
+                if compact:
+                    cls.__new__ = staticmethod(_new_slots)
+                else:
+                    cls.__new__ = staticmethod(_new)
+                cls._custom_init = True
+            elif not getattr(cls, '_custom_init', False):
+                cls.__init__ = _compile_init(cls)
+
         return cls
+
+
+# Interned entity classes are created with this metaclass instead, so that
+# constructing one returns the canonical instance with the same values.
+class _InternedSchema(Schema):
+
+    def __call__(cls, *args, **kwargs):
+        self = cls.__new__(cls, *args, **kwargs)
+        self._frozen = False
+        self.__init__(*args, **kwargs)
+        return self._intern()
+
+
+def _from_trusted_interned(cls, **values):
+    return cls._from_trusted(**values)._intern()
+
+
+def _reduce_interned(self):
+    if self.__compact__:
+        state = self.__getstate__()
+    else:
+        state = self._values
+    return _unpickle_interned, (type(self), state)
+
+
+def _unpickle_interned(cls, state):
+    return cls.from_trusted(**state)
+
+
+def _eq_interned(self, other):
+    if self is other:
+        return True
+    elif type(other) is not type(self):
+        return NotImplemented
+    else:
+        return self._hash == other._hash and self._key == other._key
+
+
+def _ne_interned(self, other):
+    equal = _eq_interned(self, other)
+    if equal is NotImplemented:
+        return equal
+    return not equal
+
+
+def _hash_interned(self):
+    return self._hash
+
+
+def _nests(field, keys):
+    targets = field._targets(keys)
+    return targets is None or bool(targets)
+
+
+def _new(cls, *args, **kwargs):
+    self = object.__new__(cls)
+    self._values = dict()
+    return self
+
+
+def _new_slots(cls, *args, **kwargs):
+    self = object.__new__(cls)
+    self._dirty = -1
+    return self
+
+
+def _get_slot_value(self, name):
+    slot = self._fields[name].slot
+    try:
+        return slot.__get__(self)
+    except AttributeError:
+        shared = self._shared
+        raw = self._raw
+        if shared is not None and name in shared:
+            value = self._unshare(name)
+        elif raw is not None and name in raw:
+            value = self._fields[name].from_raw(raw[name])
+        else:
+            value = self._fields[name].make_default()
+        slot.__set__(self, value)
+        return value
+
+
+def _from_trusted_slots(cls, **values):
+    self = cls.__new__(cls)
+    self._dirty = -1
+    for name, value in values.iteritems():
+        cls._fields[name].slot.__set__(self, value)
+    return self
+
+
+def _get_slot_state(self):
+    state = dict()
+    for name, field in self._fields.iteritems():
+        try:
+            state[name] = field.slot.__get__(self)
+        except AttributeError:
+            if self._raw is not None and name in self._raw or \
+                    self._shared is not None and name in self._shared:
+                state[name] = self._get_value(name)
+    return state
+
+
+def _set_slot_state(self, state):
+    self._dirty = -1
+    for name, value in state.iteritems():
+        self._fields[name].slot.__set__(self, value)
+
+
+def compile_storage(gen, cls):
+    if any(field.slot is None for field in cls._fields.itervalues()):
+        gen.emit('values = self._values')
+
+
+def compile_read(gen, cls, name, value):
+    slot = cls._fields[name].slot
+    if slot is None:
+        gen.emit('%s = values[%r] if %r in values '
+                 'else self._get_value(%r)', value, name, name, name)
+    else:
+        with gen.block('try:'):
+            gen.emit('%s = %s(self)', value, gen.const(slot.__get__, 'get'))
+        with gen.block('except AttributeError:'):
+            gen.emit('%s = self._get_value(%r)', value, name)
+
+
+def _compile_validate(cls):
+    gen = CodeBuilder('<%s._validate>' % cls.__name__)
+    with gen.block('def _validate(self):'):
+        compile_storage(gen, cls)
+        gen.emit('errors = []')
+        for name in cls._fields:
+            value = gen.local('value')
+            compile_read(gen, cls, name, value)
+            compile_validate(gen, cls._fields[name], value, 'errors')
+        with gen.block('if len(errors) == 1:'):
+            gen.emit('raise errors[0]')
+        with gen.block('elif len(errors) > 1:'):
+            gen.emit('raise MultipleErrors(None, self, errors)')
+    return gen.build('_validate')
+
+
+def _compile_intern(cls):
+    gen = CodeBuilder('<%s._intern>' % cls.__name__)
+    with gen.block('def _intern(self):'):
+        compile_storage(gen, cls)
+        items = []
+        for name, field in cls._fields.iteritems():
+            value = gen.local('value')
+            compile_read(gen, cls, name, value)
+            # Most fields are keyed by their values and their types.
+            if type(field).keyify == Field.keyify \
+                    and type(field)._intern_key == Field._intern_key:
+                items.append('(type(%s), %s)' % (value, value))
+            else:
+                items.append('%s._intern_key(%s)'
+                             % (gen.const(field, 'field'), value))
+        gen.emit('key = (%s)', ''.join(item + ', ' for item in items))
+        # Lookups go to the references the table keeps, which is faster
+        # than asking the table itself.
+        gen.emit('ref = %s(key)', gen.const(cls._interned.data.get, 'get'))
+        with gen.block('if ref is not None:'):
+            gen.emit('interned = ref()')
+            with gen.block('if interned is not None:'):
+                gen.emit('return interned')
+        gen.emit('self._key = key')
+        gen.emit('self._hash = hash(key)')
+        gen.emit('self._frozen = True')
+        gen.emit('return %s(key, self)',
+                 gen.const(cls._interned.setdefault, 'setdefault'))
+    return gen.build('_intern')
+
+
+# Names that the generated constructor uses besides the fields.
+_init_names = {'__self', '__args', '__kwargs', '__values', '__missing'}
+
+
+def _compile_init(cls):
+    names = list(cls._fields)
+    for name in names:
+        if name in _init_names:
+            raise TypeError('%s.%s clashes with a name used by __init__()'
+                            % (cls.__name__, name))
+    params = ['%s=__missing' % name for name in names]
+    compact = getattr(cls, '__compact__', False)
+
+    gen = CodeBuilder('<%s.__init__>' % cls.__name__)
+    gen.namespace['__missing'] = _missing
+    with gen.block('def __init__(%s):',
+                   ', '.join(['__self'] + params + ['*__args', '**__kwargs'])):
+        with gen.block('if __args:'):
+            gen.emit("raise TypeError('__init__() takes at most %d arguments "
+                     "(%%d given)' %% (%d + len(__args)))",
+                     len(names), len(names))
+        with gen.block('if __kwargs:'):
+            gen.emit("raise TypeError('%r is an invalid keyword argument "
+                     "for this function' % next(iter(__kwargs)))")
+        if compact:
+            gen.emit('__self._dirty = -1')
+        else:
+            gen.emit('__values = dict()')
+        for name in names:
+            with gen.block('if %s is not __missing:', name):
+                if compact:
+                    setter = cls._fields[name].slot.__set__
+                    gen.emit('%s(__self, %s)', gen.const(setter, 'set'), name)
+                else:
+                    gen.emit('__values[%r] = %s', name, name)
+        if not compact:
+            with gen.block('if type(__self) is %s:', gen.const(cls, 'cls')):
+                gen.emit('__self._values = __values')
+            with gen.block('else:'):
+                # Subclasses with their own constructor may have set values
+                # before calling this one, which are kept.
+                gen.emit('%s(%s, __self, __values)',
+                         gen.const(_set_values, 'set'), gen.const(cls, 'cls'))
+    return gen.build('__init__')
+
+
+def _set_values(cls, self, values):
+    for name, field in cls._fields.iteritems():
+        if name in values:
+            field.__set__(self, values[name])
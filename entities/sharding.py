@@ -0,0 +1,74 @@
+import bisect
+import hashlib
+import struct
+from basic import PRIMARY
+from streams import encode_key
+
+
+def key_fingerprint(key, bits=64):
+    # Digests the encoded key, which is the same for equal keys in any
+    # process, unlike hash().
+    digest = hashlib.md5(encode_key(key)).digest()
+    if bits == 64:
+        return struct.unpack('>Q', digest[:8])[0]
+    elif bits == 128:
+        high, low = struct.unpack('>QQ', digest)
+        return high << 64 | low
+    raise ValueError('bits must be 64 or 128')
+
+
+def _jump(fingerprint, buckets):
+    # Jump consistent hashing by Lamping and Veach: growing from n to n + 1
+    # buckets only moves a 1 / (n + 1) share of the keys, all of them to the
+    # new bucket.
+    bucket, jump = -1, 0
+    while jump < buckets:
+        bucket = jump
+        fingerprint = (fingerprint * 2862933555777941757 + 1) \
+            & 0xFFFFFFFFFFFFFFFF
+        jump = int((bucket + 1) * (float(1 << 31) /
+                                   float((fingerprint >> 33) + 1)))
+    return bucket
+
+
+class Partitioner(object):
+    # Routes entities to shards by the fingerprint of a key group. Shards
+    # are a count, or a list of names that are returned instead of indexes.
+    #
+    # Jump hashing needs no memory and moves the fewest keys, but shards can
+    # only be added or removed at the end. Ring hashing places each shard on
+    # a ring many times over, so that any of them can be added or removed.
+
+    def __init__(self, shards, group=PRIMARY, method='jump', replicas=100):
+        if isinstance(shards, (int, long)):
+            shards = range(shards)
+        self.shards = list(shards)
+        if not self.shards:
+            raise ValueError('there must be at least one shard')
+        self.group = group
+        self.method = method
+        if method == 'ring':
+            ring = sorted((key_fingerprint((shard, replica)), shard)
+                          for shard in self.shards
+                          for replica in xrange(replicas))
+            self._points = [point for point, shard in ring]
+            self._owners = [shard for point, shard in ring]
+        elif method != 'jump':
+            raise ValueError('unknown method %r' % method)
+
+    def shard(self, entity):
+        return self.shard_of_key(entity.keyify(self.group))
+
+    def shard_of_key(self, key):
+        fingerprint = key_fingerprint(key)
+        if self.method == 'jump':
+            return self.shards[_jump(fingerprint, len(self.shards))]
+        index = bisect.bisect(self._points, fingerprint)
+        return self._owners[index % len(self._owners)]
+
+    def partition(self, entities):
+        # Returns the entities of each shard in lists, keyed by shard.
+        result = dict()
+        for entity in entities:
+            result.setdefault(self.shard(entity), []).append(entity)
+        return result
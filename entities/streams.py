@@ -0,0 +1,248 @@
+import cPickle
+import datetime
+import heapq
+import itertools
+import tempfile
+import pytz
+from basic import PRIMARY
+
+
+# Entities are buffered in memory up to this many at a time, and spilled to
+# temporary files in sorted runs after that. At most MERGE_WIDTH runs are
+# merged at once, and read CHUNK_SIZE records at a time at most.
+BUFFER_SIZE = 100000
+CHUNK_SIZE = 1000
+MERGE_WIDTH = 16
+
+
+def encode_key(key):
+    # Returns a string that is equal for equal keys and different for
+    # different ones, whatever the order of set items, so that keys can be
+    # sorted and compared outside this process. Nested tuples are encoded
+    # without recursion.
+    parts = []
+    append = parts.append
+    stack = [key]
+    while stack:
+        key = stack.pop()
+        # The most common types are matched exactly first.
+        kind = type(key)
+        if kind is int:
+            append('i%d;' % key)
+        elif kind is tuple or isinstance(key, tuple):
+            append('(%d:' % len(key))
+            stack.extend(key[::-1])
+        elif isinstance(key, frozenset):
+            append('{%d:' % len(key))
+            parts.extend(sorted(encode_key(item) for item in key))
+        else:
+            encode = _encoders.get(kind)
+            if encode is None:
+                encode = _encoder_of(key)
+            append(encode(key))
+    return ''.join(parts)
+
+
+def _encode_unicode(key):
+    data = key.encode('utf-8')
+    return 'u%d:%s' % (len(data), data)
+
+
+def _encode_str(key):
+    # Plain strings are equal to the unicode strings they decode to.
+    try:
+        key.decode('ascii')
+    except UnicodeDecodeError:
+        return 'b%d:%s' % (len(key), key)
+    return 'u%d:%s' % (len(key), key)
+
+
+def _encode_datetime(key):
+    # Aware datetimes are equal at the same instant in any time zone.
+    if key.tzinfo is not None:
+        key = key.astimezone(pytz.utc)
+    return 'T%s;' % key.isoformat()
+
+
+# Encoders by type, with subclasses before their bases.
+_encoder_list = [
+    (type(None), lambda key: 'n'),
+    (bool, lambda key: 't' if key else 'f'),
+    (int, lambda key: 'i%d;' % key),
+    (long, lambda key: 'i%d;' % key),
+    (float, lambda key: 'd%r;' % key),
+    (unicode, _encode_unicode),
+    (str, _encode_str),
+    (datetime.datetime, _encode_datetime),
+    (datetime.date, lambda key: 'D%s;' % key.isoformat()),
+    (datetime.time, lambda key: 'M%s;' % key.isoformat()),
+]
+_encoders = dict(_encoder_list)
+
+
+def _encoder_of(key):
+    for cls, encode in _encoder_list:
+        if isinstance(key, cls):
+            return encode
+    raise TypeError('cannot encode key %r' % (key,))
+
+
+# Results come in the order of the encoded keys, which is not the order of
+# the keys themselves. Entities that were spilled come back as copies.
+def dedup(iterable, group=PRIMARY, buffer_size=BUFFER_SIZE, directory=None):
+    # Yields the first of the entities that have the same key.
+    records = ((encode_key(entity.keyify(group)), index, entity)
+               for index, entity in enumerate(iterable))
+    last = None
+    for encoded, index, entity in _sort(records, buffer_size, directory,
+                                        True):
+        if encoded != last:
+            last = encoded
+            yield entity
+
+
+def group_by(iterable, group=PRIMARY, buffer_size=BUFFER_SIZE,
+             directory=None):
+    # Yields (key, entities) for every key. Entities keep their input order
+    # within a group.
+    last = current = None
+    entities = []
+    for encoded, index, key, entity in _sort(_keyed(iterable, group),
+                                             buffer_size, directory, False):
+        if encoded != last:
+            if entities:
+                yield current, entities
+            last = encoded
+            current = key
+            entities = []
+        entities.append(entity)
+    if entities:
+        yield current, entities
+
+
+def _keyed(iterable, group):
+    for index, entity in enumerate(iterable):
+        key = entity.keyify(group)
+        yield encode_key(key), index, key, entity
+
+
+def _sort(records, buffer_size, directory, unique):
+    # Sorts records by their encoded key and input position, which tell any
+    # two of them apart. Unique sorts only keep the first record of a key in
+    # each run, so duplicates take no room.
+    if buffer_size < 1:
+        raise ValueError('buffer_size must be positive')
+
+    # Runs are written and read in chunks small enough that a chunk of each
+    # of the runs merged at once fits in the buffer.
+    chunk_size = max(1, min(CHUNK_SIZE, buffer_size // MERGE_WIDTH))
+    levels = []
+    try:
+        buffer = dict() if unique else []
+        for record in records:
+            if unique:
+                if record[0] not in buffer:
+                    buffer[record[0]] = record
+            else:
+                buffer.append(record)
+            if len(buffer) >= buffer_size:
+                run = _spill(_sorted(buffer, unique), directory, chunk_size)
+                buffer = dict() if unique else []
+                _add_run(levels, run, directory, chunk_size, unique)
+
+        if not levels:
+            merged = _sorted(buffer, unique)
+        else:
+            # The rest of the buffer is spilled too, so that only chunks of
+            # the runs are held while they are merged.
+            if buffer:
+                run = _spill(_sorted(buffer, unique), directory, chunk_size)
+                _add_run(levels, run, directory, chunk_size, unique)
+                buffer = None
+            runs = [run for level in levels for run in level]
+            while len(runs) > MERGE_WIDTH:
+                run = _merge_runs(runs[:MERGE_WIDTH], directory, chunk_size,
+                                  unique)
+                runs = runs[MERGE_WIDTH:] + [run]
+                levels.append([run])
+            merged = _merge([_read(run) for run in runs], unique)
+        for record in merged:
+            yield record
+    finally:
+        for level in levels:
+            for run in level:
+                run.close()
+
+
+def _add_run(levels, run, directory, chunk_size, unique):
+    # Runs of the same level are about as long. Once MERGE_WIDTH of them pile
+    # up, they are merged into one of the next level, so that few files are
+    # open at any time and every record is rewritten only a few times.
+    level = 0
+    while True:
+        if level == len(levels):
+            levels.append([])
+        runs = levels[level]
+        runs.append(run)
+        if len(runs) < MERGE_WIDTH:
+            return
+        run = _merge_runs(runs, directory, chunk_size, unique)
+        levels[level] = []
+        level += 1
+
+
+def _merge_runs(runs, directory, chunk_size, unique):
+    run = _spill(_merge([_read(run) for run in runs], unique), directory,
+                 chunk_size)
+    for merged in runs:
+        merged.close()
+    return run
+
+
+def _merge(iterables, unique):
+    merged = heapq.merge(*iterables)
+    if unique:
+        return _first_of_keys(merged)
+    return merged
+
+
+def _first_of_keys(records):
+    last = None
+    for record in records:
+        if record[0] != last:
+            last = record[0]
+            yield record
+
+
+def _sorted(buffer, unique):
+    if unique:
+        return sorted(buffer.itervalues())
+    buffer.sort()
+    return buffer
+
+
+def _spill(records, directory, chunk_size):
+    # Records are pickled in chunks, so that the classes they refer to are
+    # written once per chunk rather than once per record.
+    run = tempfile.TemporaryFile(dir=directory)
+    pickler = cPickle.Pickler(run, cPickle.HIGHEST_PROTOCOL)
+    records = iter(records)
+    while True:
+        chunk = list(itertools.islice(records, chunk_size))
+        if not chunk:
+            break
+        pickler.dump(chunk)
+        pickler.clear_memo()
+    run.seek(0)
+    return run
+
+
+def _read(run):
+    unpickler = cPickle.Unpickler(run)
+    while True:
+        try:
+            chunk = unpickler.load()
+        except EOFError:
+            return
+        for record in chunk:
+            yield record
@@ -0,0 +1,250 @@
+import datetime
+from array import array
+from basic import PRIMARY, ValidationError, MultipleErrors
+from field import Field, BooleanField, IntegerField, FloatField, DateField
+
+
+class _ObjectColumn(object):
+    # Holds any values in a plain list. Fields that have no typed column, and
+    # typed columns that receive a value they cannot store, end up here.
+
+    def __init__(self, values=None):
+        self.values = [] if values is None else values
+
+    def append(self, value):
+        self.values.append(value)
+        return True
+
+    def get(self, index):
+        return self.values[index]
+
+    def set(self, index, value):
+        self.values[index] = value
+        return True
+
+    def tolist(self):
+        return list(self.values)
+
+    def validate(self, field):
+        for index, value in enumerate(self.values):
+            try:
+                field.validate(value)
+            except ValidationError, ex:
+                yield index, ex
+
+    def keyify(self, field, group):
+        return [field.keyify(value, group) for value in self.values]
+
+
+class _ArrayColumn(object):
+    # Stores values of exactly one type in a typed array, with a bitmap
+    # marking the rows that are None.
+
+    def __init__(self, typecode, types, pack=None, unpack=None):
+        self.values = array(typecode)
+        self.nulls = bytearray()
+        self.null_count = 0
+        self.types = types
+        self.pack = pack
+        self.unpack = unpack
+
+    def _store(self, index, value):
+        if value is None:
+            value = 0
+        elif type(value) not in self.types:
+            return False
+        elif self.pack is not None:
+            value = self.pack(value)
+
+        try:
+            if index == len(self.values):
+                self.values.append(value)
+            else:
+                self.values[index] = value
+        except OverflowError:
+            return False
+        return True
+
+    def _is_null(self, index):
+        return self.nulls[index >> 3] & (1 << (index & 7))
+
+    def _set_null(self, index, null):
+        if self._is_null(index):
+            if not null:
+                self.nulls[index >> 3] &= ~(1 << (index & 7))
+                self.null_count -= 1
+        elif null:
+            self.nulls[index >> 3] |= 1 << (index & 7)
+            self.null_count += 1
+
+    def append(self, value):
+        index = len(self.values)
+        if not self._store(index, value):
+            return False
+        if index & 7 == 0:
+            self.nulls.append(0)
+        self._set_null(index, value is None)
+        return True
+
+    def get(self, index):
+        if self._is_null(index):
+            return None
+        value = self.values[index]
+        return value if self.unpack is None else self.unpack(value)
+
+    def set(self, index, value):
+        if not self._store(index, value):
+            return False
+        self._set_null(index, value is None)
+        return True
+
+    def null_indexes(self):
+        if not self.null_count:
+            return
+        for position, byte in enumerate(self.nulls):
+            if byte:
+                for bit in xrange(8):
+                    if byte & (1 << bit):
+                        yield position << 3 | bit
+
+    def tolist(self):
+        values = self.values.tolist()
+        for index in self.null_indexes():
+            values[index] = None
+        if self.unpack is None:
+            return values
+        elif self.null_count:
+            return [None if value is None else self.unpack(value)
+                    for value in values]
+        else:
+            return map(self.unpack, values)
+
+    def validate(self, field):
+        # Stored values have the right type by construction, so only nulls
+        # are left to check, unless the field adds its own checks.
+        if type(field).validate.im_func is not Field.validate.im_func:
+            for item in _ObjectColumn(self.tolist()).validate(field):
+                yield item
+        elif not field.null:
+            for index in self.null_indexes():
+                yield index, ValidationError(field, None, 'null value')
+
+    def keyify(self, field, group):
+        if type(field).keyify.im_func is Field.keyify.im_func:
+            return self.tolist()
+        else:
+            return _ObjectColumn(self.tolist()).keyify(field, group)
+
+
+def _make_column(field):
+    if isinstance(field, BooleanField):
+        return _ArrayColumn('b', (bool,), int, bool)
+    elif isinstance(field, IntegerField):
+        # Longs are kept as objects, since IntegerField rejects them.
+        return _ArrayColumn('l', (int,))
+    elif isinstance(field, FloatField):
+        return _ArrayColumn('d', (float,))
+    elif isinstance(field, DateField):
+        return _ArrayColumn('i', (datetime.date,), datetime.date.toordinal,
+                            datetime.date.fromordinal)
+    else:
+        return _ObjectColumn()
+
+
+class EntityTable(object):
+
+    def __init__(self, entity_class, entities=()):
+        self.entity_class = entity_class
+        self._columns = dict(
+            (name, _make_column(field))
+            for name, field in entity_class._fields.iteritems()
+        )
+        self._length = 0
+        self.extend(entities)
+
+    def __len__(self):
+        return self._length
+
+    def _check(self, entity):
+        if not isinstance(entity, self.entity_class):
+            raise TypeError('expected %s, got %r'
+                            % (self.entity_class.__name__, entity))
+
+    def _index(self, index):
+        if index < 0:
+            index += self._length
+        if not 0 <= index < self._length:
+            raise IndexError('table index out of range')
+        return index
+
+    def append(self, entity):
+        self._check(entity)
+        for name, column in self._columns.iteritems():
+            value = entity._get_value(name)
+            if not column.append(value):
+                column = self._columns[name] = _ObjectColumn(column.tolist())
+                column.append(value)
+        self._length += 1
+
+    def extend(self, entities):
+        for entity in entities:
+            self.append(entity)
+
+    # Rows are materialized on access. Changes to them are not seen by the
+    # table until they are stored back.
+    def __getitem__(self, index):
+        index = self._index(index)
+        return self.entity_class.from_trusted(**dict(
+            (name, column.get(index))
+            for name, column in self._columns.iteritems()
+        ))
+
+    def __setitem__(self, index, entity):
+        index = self._index(index)
+        self._check(entity)
+        for name, column in self._columns.iteritems():
+            value = entity._get_value(name)
+            if not column.set(index, value):
+                column = self._columns[name] = _ObjectColumn(column.tolist())
+                column.set(index, value)
+
+    def __iter__(self):
+        for index in xrange(self._length):
+            yield self[index]
+
+    def column(self, name):
+        return self._columns[name].tolist()
+
+    def validate(self):
+        # Errors are grouped by row the same way validating each row would
+        # group them.
+        failures = dict()
+        for name, field in self.entity_class._fields.iteritems():
+            for index, ex in self._columns[name].validate(field):
+                failures.setdefault(index, []).append(ex)
+
+        errors = []
+        for index in sorted(failures):
+            if len(failures[index]) == 1:
+                errors.append(failures[index][0])
+            else:
+                errors.append(MultipleErrors(None, self[index],
+                                             failures[index]))
+
+        if len(errors) == 1:
+            raise errors[0]
+        elif len(errors) > 1:
+            raise MultipleErrors(None, self, errors)
+
+    def keyify(self, group=PRIMARY, child_group=None):
+        if child_group is None:
+            child_group = group
+
+        columns = [self._columns[field.name].keyify(field, child_group)
+                   for field in self.entity_class._groups[group]]
+        return zip(*columns)
+
+    def __repr__(self):
+        return '%s(%s, <%d rows>)' % (self.__class__.__name__,
+                                      self.entity_class.__name__,
+                                      self._length)
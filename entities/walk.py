@@ -0,0 +1,253 @@
+import threading
+import weakref
+from basic import CycleError, ValidationError
+
+
+class _Dependencies(threading.local):
+
+    def __init__(self):
+        self.stack = []
+
+
+# Entities whose keys are computed while another entity is computing a key
+# to cache report themselves here, so that changing them later invalidates
+# the cached key.
+_dependencies = _Dependencies()
+
+
+class _Walk(threading.local):
+
+    def __init__(self):
+        self.results = None
+        self.revalidated = None
+
+
+# While a walk is in progress, the results of the entities and recursive
+# collections it has processed are kept here by identity. Nested calls look
+# them up instead of descending again. Incremental walks keep theirs apart,
+# since the fields that changed are validated in full by walks of their own.
+_walk = _Walk()
+_missing = object()
+
+# Entity classes remember whether they need walks in their own _deep,
+# _deep_keys and _shares attributes, and fields here. Schema resets them
+# whenever a class that holds entities is created.
+_deep_classes = weakref.WeakSet()
+_needed = dict()
+
+
+def reset():
+    for cls in list(_deep_classes):
+        cls._deep = cls._deep_keys = cls._shares = None
+    _deep_classes.clear()
+    _needed.clear()
+
+
+def _subclasses(entity_class):
+    classes = [entity_class]
+    for cls in classes:
+        classes.extend(cls.__subclasses__())
+    return classes
+
+
+def _edges(entity_class, keys):
+    # The entity classes that entities of the class may hold, or None if
+    # they may hold recursive collections.
+    if keys:
+        fields = [field for fields in entity_class._nested_groups.values()
+                  for field in fields]
+    else:
+        fields = entity_class._nested_fields
+
+    edges = []
+    for field in fields:
+        targets = field._targets(keys)
+        if targets is None:
+            return None
+        for target in targets:
+            edges.extend(_subclasses(target))
+    return edges
+
+
+def _is_deep(entity_class, keys):
+    # Entities can only nest arbitrarily deep, or in cycles, if their class
+    # can be reached from itself or leads to recursive collections. Returns
+    # that, and whether they may hold entities that hold others in turn.
+    edges = _edges(entity_class, keys)
+    if edges is None:
+        return True, True
+    shares = False
+    done = {entity_class: False}
+    stack = [(entity_class, iter(edges))]
+    while stack:
+        cls, targets = stack[-1]
+        for target in targets:
+            state = done.get(target)
+            if state is None:
+                edges = _edges(target, keys)
+                if edges is None:
+                    return True, True
+                elif edges:
+                    shares = True
+                done[target] = False
+                stack.append((target, iter(edges)))
+                break
+            elif not state:
+                return True, True
+        else:
+            stack.pop()
+            done[cls] = True
+    return False, shares
+
+
+def needs_walk(entity_class, keys):
+    name = '_deep_keys' if keys else '_deep'
+    deep = getattr(entity_class, name)
+    if deep is None:
+        deep, shares = _is_deep(entity_class, keys)
+        setattr(entity_class, name, deep)
+        if not keys:
+            entity_class._shares = shares
+        _deep_classes.add(entity_class)
+    return deep
+
+
+def field_needs_walk(field, keys):
+    needed = _needed.get((field, keys))
+    if needed is None:
+        targets = field._targets(keys)
+        needed = targets is None or any(
+            needs_walk(cls, keys) for target in targets
+            for cls in _subclasses(target)
+        )
+        _needed[field, keys] = needed
+    return needed
+
+
+# Nodes are (key, subject, owner, args) tuples. Calling validate() or
+# keyify() on the owner with the args processes the subject, and calling
+# _children() with the same args yields the nodes the subject depends on.
+def entity_node(entity, group=None, child_group=None):
+    key = (id(entity), group, child_group)
+    if group is None:
+        return key, entity, entity, ()
+    else:
+        return key, entity, entity, (group, child_group)
+
+
+def collection_node(field, value, group=None):
+    key = (id(field), id(value), group)
+    if group is None:
+        return key, value, field, (value,)
+    else:
+        return key, value, field, (value, group)
+
+
+def _order(root):
+    # Orders the nodes reachable from the root so that every node comes
+    # after the nodes it depends on, using an explicit stack.
+    order = []
+    done = {root[0]: False}
+    stack = [(root, iter(root[2]._children(*root[3])))]
+    while stack:
+        node, children = stack[-1]
+        for child in children:
+            key = child[0]
+            state = done.get(key)
+            if state is None:
+                grandchildren = child[2]._children(*child[3])
+                if grandchildren:
+                    done[key] = False
+                    stack.append((child, iter(grandchildren)))
+                    break
+                done[key] = True
+                order.append(child)
+            elif not state:
+                raise CycleError(child[1])
+        else:
+            stack.pop()
+            done[node[0]] = True
+            order.append(node)
+    return order
+
+
+# Walks that are not ordered only remember results, and leave nesting to
+# the calls that the entities make. With an ErrorLimit, nodes are validated
+# by _validate_limited(), which checks nothing more once errors are left
+# out, but still collects the errors found by then.
+def validate(root, ordered=True, limit=None):
+    nodes = _order(root) if ordered else [root]
+    results = _walk.results = dict()
+    try:
+        for key, subject, owner, args in nodes:
+            try:
+                if limit is None:
+                    owner.validate(*args)
+                else:
+                    owner._validate_limited(*(args + (limit,)))
+            except ValidationError, ex:
+                results[key] = ex
+            else:
+                results[key] = None
+    finally:
+        _walk.results = None
+    _raise(results[root[0]])
+
+
+def revalidate(root):
+    nodes = _order(root)
+    results = _walk.revalidated = dict()
+    try:
+        for key, subject, owner, args in nodes:
+            try:
+                if subject is owner:
+                    owner.validate(incremental=True)
+                else:
+                    owner.revalidate(*args)
+            except ValidationError, ex:
+                results[key] = ex
+            else:
+                results[key] = None
+    finally:
+        _walk.revalidated = None
+    _raise(results[root[0]])
+
+
+def _raise(error):
+    if error is not None:
+        raise error
+
+
+# Looks up the result of a node in the results of the walk in progress, and
+# returns whether it was found.
+def remembered(results, key):
+    error = results.get(key, _missing)
+    if error is _missing:
+        return False
+    _raise(error)
+    return True
+
+
+def keyify(root):
+    nodes = _order(root)
+    stack = _dependencies.stack
+    # Entities only track what their keys depend on while some key is being
+    # cached, so the walk makes sure that they do if any entity caches keys.
+    tracking = not stack
+    if tracking:
+        for key, subject, owner, args in nodes:
+            if getattr(subject, '__cache_keys__', False):
+                stack.append([])
+                break
+        else:
+            tracking = False
+
+    results = _walk.results = dict()
+    try:
+        for key, subject, owner, args in nodes:
+            results[key] = owner.keyify(*args)
+    finally:
+        _walk.results = None
+        if tracking:
+            stack.pop()
+    return results[root[0]]
@@ -1,2 +1,15 @@
 from field import *
 from entity import *
+from schema import *
+from json import *
+from bson import *
+from table import *
+from repository import *
+from loader import *
+from parallel import *
+from profiling import *
+from patch import *
+from checks import *
+from streams import *
+from records import *
+from sharding import *
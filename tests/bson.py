@@ -0,0 +1,163 @@
+import struct
+import unittest
+from entities import *
+from entities.bson import encode, decode, read_key
+
+
+class Account(Entity):
+    id = IntegerField(group=PRIMARY)
+    iban = IntegerField(group=SECONDARY)
+    balance = FloatField(default=0.0)
+    active = BooleanField()
+
+
+class Name(Entity):
+    first_name = StringField(group=SECONDARY)
+    last_name = StringField(group=SECONDARY)
+
+
+class Customer(Entity):
+    id = IntegerField(group=PRIMARY)
+    name = EntityField(Name, group=SECONDARY)
+    accounts = ListField(ReferenceField(Account), default=list)
+    owner = ReferenceField(Name, reference_group=SECONDARY)
+
+
+class Collections(Entity):
+    __compact__ = True
+    items = ListField(IntegerField())
+    nested = ListField(ListField(FloatField()))
+    tree = ListField(IntegerField(), recursive=True)
+    tags = SetField(StringField())
+    scores = DictField(FloatField())
+    names = DictField(EntityField(Name))
+    untyped = ListField()
+    born = DateField()
+    seen = TimeField()
+
+
+class TestBson(unittest.TestCase):
+
+    def test_layout(self):
+        data = encode(Account(1, None, 10.0, True))
+        body = ('\x10id\x00' + struct.pack('<i', 1) +
+                '\x0aiban\x00' +
+                '\x01balance\x00' + struct.pack('<d', 10.0) +
+                '\x08active\x00\x01')
+        self.assertEqual(data, struct.pack('<i', len(body) + 5) + body +
+                         '\x00')
+
+    def test_round_trip(self):
+        entity = Account(1, 2 ** 40, -1.5, False)
+        data = encode(entity)
+        prefix = 'garbage'
+        buffers = [data, bytearray(data), buffer(data), memoryview(data),
+                   memoryview(prefix + data)[len(prefix):]]
+        for data in buffers:
+            copy = decode(data, Account)
+            self.assertIsInstance(copy, Account)
+            self.assertEqual(copy._values, entity._values)
+
+    def test_strings(self):
+        entity = Name(u'\xe7a\u011f', 'aygun')
+        copy = decode(encode(entity), Name)
+        self.assertEqual(copy.first_name, u'\xe7a\u011f')
+        self.assertEqual(copy.last_name, u'aygun')
+        self.assertIsInstance(copy.last_name, unicode)
+
+    def test_nested(self):
+        entity = Customer(1, Name('eser', 'aygun'),
+                          [Account(1, 111), Account(2, 222)],
+                          Name('foo', 'bar'))
+        copy = decode(encode(entity), Customer)
+        self.assertEqual(copy.name.keyify(SECONDARY), ('eser', 'aygun'))
+        self.assertEqual([account.keyify() for account in copy.accounts],
+                         [(1,), (2,)])
+        self.assertEqual(copy.accounts[0].iban, None)
+        self.assertEqual(copy.owner.keyify(SECONDARY), ('foo', 'bar'))
+        self.assertEqual(copy.keyify(SECONDARY), entity.keyify(SECONDARY))
+        copy.validate()
+
+        copy = decode(encode(Customer(1)), Customer)
+        self.assertEqual(copy.name, None)
+        self.assertEqual(copy.owner, None)
+        self.assertEqual(copy.accounts, [])
+
+    def test_collections(self):
+        entity = Collections(
+            [1, None, 2 ** 40], [[1.0], [2.0, None]], [1, [2, [3]]],
+            {'a', 'b'}, {'a': 1.0}, {'a': Name('eser', 'aygun'), 'b': None},
+            [1, 'x', [True, None], {'y': 2.5}], datetime.date(2015, 1, 2),
+            pytz.utc.localize(datetime.datetime(2015, 1, 2, 3, 4, 5, 6000))
+        )
+        copy = decode(encode(entity), Collections)
+        for name in Collections._fields:
+            if name != 'names':
+                self.assertEqual(getattr(copy, name), getattr(entity, name))
+        self.assertIsInstance(copy.tags, set)
+        self.assertEqual(copy.names['a'].keyify(SECONDARY), ('eser', 'aygun'))
+        self.assertEqual(copy.names['b'], None)
+        copy.validate()
+
+        copy = decode(encode(Collections()), Collections)
+        for name in Collections._fields:
+            self.assertEqual(getattr(copy, name), None)
+
+    def test_times(self):
+        # BSON keeps milliseconds and assumes naive times are in UTC.
+        entity = Collections(seen=datetime.datetime(2015, 1, 2, 3, 4, 5, 6789))
+        self.assertEqual(
+            decode(encode(entity), Collections).seen,
+            pytz.utc.localize(datetime.datetime(2015, 1, 2, 3, 4, 5, 6000))
+        )
+
+    def test_unknown_elements(self):
+        body = ('\x10id\x00' + struct.pack('<i', 1) +
+                '\x02extra\x00' + struct.pack('<i', 2) + 'x\x00' +
+                '\x01iban\x00' + struct.pack('<d', 1.5))
+        copy = decode(struct.pack('<i', len(body) + 5) + body + '\x00',
+                      Account)
+        self.assertEqual(copy._values, {'id': 1, 'iban': 1.5})
+        self.assertRaises(ValidationError, copy.validate)
+
+        body = '\x05id\x00'
+        self.assertRaises(ValueError, decode,
+                          struct.pack('<i', len(body) + 5) + body + '\x00',
+                          Account)
+
+    def test_projection(self):
+        entity = Customer(1, Name('eser', 'aygun'),
+                          [Account(1, 111), Account(2, 222)],
+                          Name('foo', 'bar'))
+        data = encode(entity)
+        copy = decode(data, Customer, only=SECONDARY)
+        self.assertEqual(copy.name.keyify(SECONDARY), ('eser', 'aygun'))
+        self.assertEqual(copy.id, None)
+        self.assertEqual(copy.accounts, [])
+        self.assertEqual(read_key(data, Customer), (1,))
+        self.assertEqual(read_key(data, Customer, SECONDARY),
+                         (('eser', 'aygun'),))
+        copy = decode(data, Customer, only=['accounts', 'owner'])
+        self.assertEqual([account.keyify() for account in copy.accounts],
+                         [(1,), (2,)])
+        self.assertEqual(copy.owner.keyify(SECONDARY), ('foo', 'bar'))
+        self.assertEqual(copy.name, None)
+        self.assertRaises(ValueError, decode, data, Customer, only=['nope'])
+
+        # Skipped elements are not read, so only their sizes must be sound.
+        entity = Collections(range(100), tree=[1, [2]], tags={'a'},
+                             scores={'a': 1.0}, untyped=[1, 'x'],
+                             born=datetime.date(2015, 1, 2))
+        copy = decode(encode(entity), Collections, only=['born'])
+        self.assertEqual(copy.born, entity.born)
+        self.assertEqual(copy.items, None)
+        body = ('\x10id\x00' + struct.pack('<i', 1) +
+                '\x02extra\x00' + struct.pack('<i', 2) + 'x\x00' +
+                '\x05iban\x00')
+        data = struct.pack('<i', len(body) + 5) + body + '\x00'
+        self.assertEqual(read_key(data, Account), (1,))
+        self.assertRaises(ValueError, decode, data, Account)
+
+
+if __name__ == '__main__':
+    unittest.main()
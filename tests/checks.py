@@ -0,0 +1,99 @@
+import threading
+import unittest
+from entities import *
+from entities.checks import check, check_many, register_check
+
+
+class Account(Entity):
+    id = IntegerField(group=PRIMARY)
+    iban = StringField()
+
+
+class Line(Entity):
+    account = ReferenceField(Account)
+
+
+class Transfer(Entity):
+    id = IntegerField(group=PRIMARY)
+    source = ReferenceField(Account)
+    lines = ListField(EntityField(Line))
+    iban = StringField()
+
+
+# Stands in for a store that is queried over the network.
+class Store(object):
+
+    def __init__(self, accounts, ibans):
+        self.accounts = set(accounts)
+        self.ibans = set(ibans)
+        self.calls = []
+        self.threads = set()
+
+    def exists(self, keys):
+        self.calls.append(('exists', keys))
+        self.threads.add(threading.current_thread())
+        return [None if key[0] in self.accounts else 'no such account'
+                for key in keys]
+
+    def unique(self, ibans):
+        self.calls.append(('unique', ibans))
+        self.threads.add(threading.current_thread())
+        return ['iban taken' if iban in self.ibans else None
+                for iban in ibans]
+
+
+class TestChecks(unittest.TestCase):
+
+    def setUp(self):
+        self.store = Store([1, 2], ['TR1'])
+        register_check(Transfer.source, self.store.exists)
+        register_check(Line.account, self.store.exists)
+        register_check(Transfer.iban, self.store.unique)
+
+    def tearDown(self):
+        del Transfer.source._checks
+        del Line.account._checks
+        del Transfer.iban._checks
+
+    def test_check(self):
+        transfer = Transfer(1, Account(1), [Line(Account(3))], 'TR2')
+        with self.assertRaises(MultipleErrors) as context:
+            check(transfer)
+        self.assertEqual(context.exception.flatten(), [
+            ErrorRecord('account', repr(Account(3)), 'no such account'),
+        ])
+
+        check(Transfer(2, Account(2), [Line(Account(1))], 'TR3'))
+        with self.assertRaises(ValidationError):
+            check(Transfer('3'))
+
+    def test_check_many(self):
+        transfers = [
+            Transfer(1, Account(1), [Line(Account(2)), Line(Account(3))]),
+            Transfer('2', Account(4)),
+            Transfer(3, Account(3), [], 'TR1'),
+            Transfer(4, Account(1), [Line(Account(1))], 'TR2'),
+        ]
+        errors = check_many(transfers, concurrency=4)
+        self.assertEqual(errors, {
+            0: [ErrorRecord('account', repr(Account(3)), 'no such account')],
+            1: [ErrorRecord('id', "'2'", 'invalid type')],
+            2: [ErrorRecord('source', repr(Account(3)), 'no such account'),
+                ErrorRecord('iban', "'TR1'", 'iban taken')],
+        })
+
+        # Identical checks are made once per field, and invalid entities
+        # are not checked at all.
+        self.assertEqual(sorted(self.store.calls), [
+            ('exists', [(1,), (3,)]),
+            ('exists', [(2,), (3,), (1,)]),
+            ('unique', ['TR1', 'TR2']),
+        ])
+        self.assertNotIn(threading.current_thread(), self.store.threads)
+
+        self.assertEqual(check_many(transfers), errors)
+        self.assertEqual(check_many([]), {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,3 +1,4 @@
+import copy
 import unittest
 from entities import *
 
@@ -17,6 +18,135 @@ class TestEntity(unittest.TestCase):
         self.assertEqual(entity.name, None)
         self.assertEqual(entity.desc, '3')
 
+        entity = Foo(name=None)
+        self.assertEqual(entity._values, {'name': None})
+
+    def test_init_errors(self):
+        class Foo(Entity):
+            id = IntegerField()
+            name = StringField()
+
+        for init in (Foo.__init__, Entity.__init__):
+            entity = Foo.__new__(Foo)
+            with self.assertRaises(TypeError) as context:
+                init(entity, 1, '2', 3)
+            self.assertEqual(str(context.exception),
+                             '__init__() takes at most 2 arguments (3 given)')
+
+            with self.assertRaises(TypeError) as context:
+                init(entity, 1, zirt=4.0)
+            self.assertEqual(
+                str(context.exception),
+                "'zirt' is an invalid keyword argument for this function"
+            )
+
+    def test_init_reserved_names(self):
+        for name in ('__self', '__args', '__kwargs'):
+            with self.assertRaises(TypeError):
+                type('Foo', (Entity,), {name: IntegerField()})
+
+        # Classes with their own constructor do not use the generated one.
+        Foo = type('Foo', (Entity,), {'__args': IntegerField(),
+                                      '__init__': Entity.__init__})
+        self.assertEqual(Foo(**{'__args': 1})._values, {'__args': 1})
+
+    def test_init_custom(self):
+        class Foo(Entity):
+            id = IntegerField()
+
+            def __init__(self, id):
+                self.id = id * 2
+
+        class Bar(Foo):
+            pass
+
+        self.assertEqual(Foo(1).id, 2)
+        self.assertEqual(Bar(2).id, 4)
+
+    def test_init_custom_subclass(self):
+        # Values set before calling a generated constructor are kept.
+        for compact in (False, True):
+            class Base(Entity):
+                __compact__ = compact
+                id = IntegerField()
+                name = StringField()
+
+            class Foo(Base):
+                def __init__(self, name, id=None):
+                    self.name = name
+                    super(Foo, self).__init__(id=id)
+
+            entity = Foo(u'x', 1)
+            self.assertEqual((entity.name, entity.id), (u'x', 1))
+            self.assertEqual(Foo(u'y').name, u'y')
+            self.assertEqual(Base(2, u'z').name, u'z')
+
+    def test_from_trusted(self):
+        class Foo(Entity):
+            id = IntegerField()
+            name = StringField(default='foo')
+
+        entity = Foo.from_trusted(id=1)
+        self.assertEqual(entity.id, 1)
+        self.assertEqual(entity.name, 'foo')
+
+    def test_from_raw(self):
+        class Foo(Entity):
+            id = IntegerField(group=PRIMARY)
+            born = DateField()
+            tags = SetField(StringField())
+
+        class Bar(Entity):
+            id = IntegerField(group=PRIMARY)
+            child = EntityField(Foo)
+            children = DictField(EntityField(Foo))
+            reference = ReferenceField(Foo)
+            tree = ListField(DateField(), recursive=True)
+            name = StringField(default='bar')
+
+        raw = {'id': 1, 'child': {'id': 2, 'born': '2015-01-02'},
+               'children': {'a': {'id': 3, 'tags': ['x']}, 'b': None},
+               'reference': [4], 'tree': ['2015-01-02', ['2015-01-03']],
+               'unknown': 1}
+        entity = Bar.from_raw(raw)
+        self.assertEqual(entity.keyify(), (1,))
+        self.assertEqual(entity._values, {'id': 1})
+
+        child = entity.child
+        self.assertIsInstance(child, Foo)
+        self.assertEqual(child._values, {})
+        self.assertEqual(child.born, datetime.date(2015, 1, 2))
+        self.assertEqual(entity.children['a']._values, {})
+        self.assertEqual(entity.children['a'].tags, {'x'})
+        self.assertEqual(entity.children['b'], None)
+        self.assertEqual(entity.reference.keyify(), (4,))
+        self.assertEqual(entity.tree, [datetime.date(2015, 1, 2),
+                                       [datetime.date(2015, 1, 3)]])
+        self.assertEqual(entity.name, 'bar')
+        entity.validate()
+
+        entity.children['a'].tags.add('y')
+        self.assertEqual(raw['children']['a']['tags'], ['x'])
+
+        entity = Bar.from_raw({'id': '1', 'child': {'born': 1}})
+        with self.assertRaises(MultipleErrors) as context:
+            entity.validate()
+        self.assertEqual([error.field for error in context.exception.errors],
+                         [Bar.id, Foo.born])
+
+    def test_from_raw_compact(self):
+        class Foo(Entity):
+            __compact__ = True
+            id = IntegerField(group=PRIMARY)
+            born = DateField()
+
+        entity = Foo.from_raw({'id': 1, 'born': '2015-01-02'})
+        self.assertEqual(entity.keyify(), (1,))
+        self.assertRaises(AttributeError, Foo.born.slot.__get__, entity)
+        self.assertEqual(entity.__getstate__(),
+                         {'id': 1, 'born': datetime.date(2015, 1, 2)})
+        self.assertEqual(entity.born, datetime.date(2015, 1, 2))
+
     def test_validate(self):
         class Foo(Entity):
             id = IntegerField()
@@ -37,6 +167,223 @@ class TestEntity(unittest.TestCase):
         entity.child.id = '2'
         self.assertRaises(MultipleErrors, entity.validate)
 
+    def test_validate_incremental(self):
+        checked = []
+
+        class CountingField(EntityField):
+
+            def validate(self, value):
+                checked.append(self.name)
+                super(CountingField, self).validate(value)
+
+        class Foo(Entity):
+            id = IntegerField()
+
+        class Bar(Entity):
+            id = IntegerField()
+            child = CountingField(Foo)
+            children = ListField(EntityField(Foo))
+            items = ListField(IntegerField())
+
+        entity = Bar(1, Foo(1), [Foo(2)], [1, 2])
+        entity.validate(incremental=True)
+        self.assertEqual(checked, ['child'])
+
+        entity.id = 2
+        entity.validate(incremental=True)
+        self.assertEqual(checked, ['child'])
+
+        entity.id = '2'
+        self.assertRaises(ValidationError, entity.validate, incremental=True)
+        entity.id = 2
+        entity.validate(incremental=True)
+
+        entity.child.id = '1'
+        self.assertRaises(ValidationError, entity.validate, incremental=True)
+        entity.child.id = 1
+
+        entity.children[0].id = '2'
+        self.assertRaises(ValidationError, entity.validate, incremental=True)
+        entity.children[0].id = 2
+        entity.validate(incremental=True)
+        self.assertEqual(checked, ['child'])
+
+        # Items changed in place are checked without touch().
+        entity.items.append('3')
+        self.assertRaises(ValidationError, entity.validate, incremental=True)
+        entity.items.pop()
+        entity.children.append(3)
+        self.assertRaises(ValidationError, entity.validate, incremental=True)
+        entity.children.pop()
+        entity.validate(incremental=True)
+        self.assertEqual(checked, ['child'])
+
+        entity.touch('child')
+        entity.validate(incremental=True)
+        self.assertEqual(checked, ['child', 'child'])
+
+        entity.validate()
+        entity.validate(incremental=True)
+        self.assertEqual(checked, ['child', 'child', 'child'])
+
+    def test_validate_limited(self):
+        class Foo(Entity):
+            id = IntegerField()
+            tags = SetField(StringField())
+
+        class Bar(Entity):
+            id = IntegerField()
+            child = EntityField(Foo)
+            children = DictField(EntityField(Foo))
+            numbers = ListField(IntegerField())
+            parent = ReferenceField(Foo)
+
+        entity = Bar('1', Foo('2', {3}), {'a': Foo(4, {5, 6})},
+                     ['7', 8, '9', '10'], 11)
+        with self.assertRaises(MultipleErrors) as context:
+            entity.validate()
+        self.assertEqual(context.exception.count, 9)
+        self.assertFalse(context.exception.truncated)
+
+        with self.assertRaises(ValidationError) as context:
+            entity.validate(fail_fast=True)
+        self.assertEqual(context.exception.value, '1')
+        self.assertTrue(context.exception.truncated)
+
+        with self.assertRaises(MultipleErrors) as context:
+            entity.validate(max_errors=6)
+        self.assertEqual(context.exception.count, 6)
+        self.assertTrue(context.exception.truncated)
+        self.assertItemsEqual([record.value for record
+                               in context.exception.flatten()],
+                              ["'1'", "'2'", '3', '5', '6', "'7'"])
+        self.assertIn('(stopped after 6 errors)', str(context.exception))
+
+        with self.assertRaises(MultipleErrors) as context:
+            entity.validate(max_errors=100)
+        self.assertEqual(context.exception.count, 9)
+        self.assertFalse(context.exception.truncated)
+
+        # Truncated means that some errors were left out.
+        with self.assertRaises(MultipleErrors) as context:
+            entity.validate(max_errors=9)
+        self.assertEqual(context.exception.count, 9)
+        self.assertFalse(context.exception.truncated)
+        self.assertNotIn('stopped', str(context.exception))
+        with self.assertRaises(MultipleErrors) as context:
+            entity.validate(max_errors=8)
+        self.assertEqual(context.exception.count, 8)
+        self.assertTrue(context.exception.truncated)
+
+        entity = Bar(1, Foo(2), numbers=['1', '2'])
+        with self.assertRaises(ValidationError) as context:
+            entity.validate(max_errors=1)
+        self.assertEqual(context.exception.value, '1')
+        self.assertTrue(context.exception.truncated)
+        entity.numbers.pop()
+        with self.assertRaises(ValidationError) as context:
+            entity.validate(fail_fast=True)
+        self.assertFalse(context.exception.truncated)
+        self.assertRaises(ValueError, entity.validate, max_errors=0)
+
+    def test_validate_deep(self):
+        class Node(Entity):
+            id = IntegerField(group=PRIMARY)
+            parent = EntityField(Entity, group=PRIMARY)
+
+        node = Node(0)
+        for index in xrange(1, 5000):
+            node = Node(index, node)
+        node.validate()
+        self.assertEqual(node.keyify()[0], 4999)
+
+        root = node
+        while root.parent is not None:
+            root = root.parent
+        root.id = '0'
+        with self.assertRaises(ValidationError) as context:
+            node.validate()
+        self.assertEqual(context.exception.value, '0')
+
+        # Limited and incremental runs walk the chain too.
+        for max_errors in (1, 3):
+            with self.assertRaises(ValidationError) as context:
+                node.validate(max_errors=max_errors)
+            self.assertEqual(context.exception.count, 1)
+            self.assertEqual([record.value for record
+                              in context.exception.flatten()], ["'0'"])
+            self.assertFalse(context.exception.truncated)
+        self.assertRaises(ValidationError, node.validate, fail_fast=True)
+        root.id = 0
+        node.validate(max_errors=2)
+        node.validate()
+        node.validate(incremental=True)
+        root.id = '0'
+        self.assertRaises(ValidationError, node.validate, incremental=True)
+        root.id = 0
+        node.validate(incremental=True)
+
+        root.parent = node
+        self.assertRaises(CycleError, node.validate)
+        self.assertRaises(CycleError, node.validate, fail_fast=True)
+        self.assertRaises(CycleError, node.validate, max_errors=3)
+        self.assertRaises(CycleError, node.validate, incremental=True)
+        self.assertRaises(CycleError, node.keyify)
+
+        loop = Node(1)
+        loop.parent = loop
+        self.assertRaises(CycleError, loop.validate, fail_fast=True)
+        self.assertRaises(CycleError, loop.validate, max_errors=3)
+
+    def test_validate_deep_collection(self):
+        class Tree(Entity):
+            items = ListField(IntegerField(), recursive=True)
+
+        value = [1]
+        for _ in xrange(5000):
+            value = [value, 2]
+        tree = Tree(value)
+        tree.validate(max_errors=3)
+        tree.validate()
+        tree.validate(incremental=True)
+
+        value[0][0][0] = '3'
+        value[1] = '4'
+        with self.assertRaises(ValidationError) as context:
+            tree.validate(fail_fast=True)
+        self.assertEqual(context.exception.count, 1)
+        self.assertTrue(context.exception.truncated)
+        with self.assertRaises(ValidationError) as context:
+            tree.validate(max_errors=3)
+        self.assertEqual(context.exception.count, 2)
+        self.assertRaises(ValidationError, tree.validate, incremental=True)
+
+        value.append(value)
+        self.assertRaises(CycleError, tree.validate, max_errors=3)
+        self.assertRaises(CycleError, tree.validate, incremental=True)
+
+    def test_validate_shared(self):
+        checked = []
+
+        class CountingField(IntegerField):
+
+            def validate(self, value):
+                checked.append(value)
+                super(CountingField, self).validate(value)
+
+        class Foo(Entity):
+            id = IntegerField()
+
+        class Bar(Entity):
+            id = CountingField()
+            child = EntityField(Foo)
+
+        class Baz(Entity):
+            children = ListField(EntityField(Bar))
+
+        Baz([Bar(1, Foo(2))] * 10).validate()
+        self.assertEqual(checked, [1])
+
     def test_keyify(self):
         class Foo(Entity):
             id = IntegerField(group=PRIMARY)
@@ -55,6 +402,245 @@ class TestEntity(unittest.TestCase):
         self.assertEqual(entity.keyify('secondary'), ('bar',))
         self.assertEqual(entity.keyify(PRIMARY, 'secondary'), (1, ('foo',)))
 
+    def test_keyify_cache(self):
+        class Foo(Entity):
+            __cache_keys__ = True
+            id = IntegerField(group=PRIMARY)
+            name = StringField(group='secondary')
+            desc = StringField()
+
+        entity = Foo(1, 'foo')
+        key = entity.keyify()
+        self.assertEqual(key, (1,))
+        self.assertIs(entity.keyify(), key)
+        self.assertEqual(entity.keyify('secondary'), ('foo',))
+
+        entity.desc = 'bar'
+        self.assertIs(entity.keyify(), key)
+
+        entity.id = 2
+        self.assertEqual(entity.keyify(), (2,))
+        self.assertEqual(entity.keyify('secondary'), ('foo',))
+
+    def test_keyify_cache_nested(self):
+        class Foo(Entity):
+            id = IntegerField(group=PRIMARY)
+            name = StringField(group='secondary')
+
+        class Bar(Entity):
+            id = IntegerField(group=PRIMARY)
+            child = EntityField(Foo, group=PRIMARY)
+
+        class Baz(Entity):
+            __cache_keys__ = True
+            bar = EntityField(Bar, group=PRIMARY)
+            refs = ListField(ReferenceField(Foo, 'secondary'), group=PRIMARY)
+            items = DictField(group=PRIMARY)
+
+        foo = Foo(1, 'foo')
+        entity = Baz(Bar(1, Foo(2, 'x')), [foo], {'a': 1})
+        self.assertEqual(entity.keyify(),
+                         ((1, (2,)), (('foo',),), (('a', 1),)))
+
+        entity.bar.child.id = 3
+        self.assertEqual(entity.keyify(),
+                         ((1, (3,)), (('foo',),), (('a', 1),)))
+
+        foo.name = 'bar'
+        self.assertEqual(entity.keyify(),
+                         ((1, (3,)), (('bar',),), (('a', 1),)))
+
+        entity.items['b'] = 2
+        self.assertEqual(entity.keyify(),
+                         ((1, (3,)), (('bar',),), (('a', 1),)))
+        entity.touch()
+        self.assertEqual(entity.keyify(),
+                         ((1, (3,)), (('bar',),), (('a', 1), ('b', 2))))
+
+        entity.refs.append(Foo(4, 'baz'))
+        entity.touch()
+        self.assertEqual(entity.keyify(),
+                         ((1, (3,)), (('bar',), ('baz',)),
+                          (('a', 1), ('b', 2))))
+
+    def test_interned(self):
+        for compact in (False, True):
+            class Name(Entity):
+                __compact__ = compact
+                __interned__ = True
+                first = StringField(group=PRIMARY)
+                last = StringField()
+
+            class Person(Entity):
+                __interned__ = True
+                name = EntityField(Name)
+                tags = ListField(StringField())
+
+            name = Name('eser', 'aygun')
+            self.assertIs(Name('eser', last='aygun'), name)
+            self.assertIs(Name.from_trusted(first='eser', last='aygun'), name)
+            self.assertIs(Name.from_raw({'first': 'eser', 'last': 'aygun'}),
+                          name)
+            self.assertIs(copy.deepcopy(name), name)
+            self.assertIsNot(Name('eser'), name)
+            self.assertNotEqual(Name('eser'), name)
+            self.assertEqual(hash(Name('eser', 'aygun')), hash(name))
+            self.assertEqual(name.keyify(), ('eser',))
+
+            person = Person(name, ['a'])
+            self.assertIs(Person(Name('eser', 'aygun'), ['a']), person)
+            self.assertIsNot(Person(Name('eser'), ['a']), person)
+            person.validate()
+
+            with self.assertRaises(AttributeError):
+                name.first = 'ali'
+            self.assertEqual(name.first, 'eser')
+
+        with self.assertRaises(TypeError):
+            class Foo(Entity):
+                __interned__ = True
+                child = EntityField(Entity)
+
+    def test_interned_types(self):
+        for compact in (False, True):
+            class Point(Entity):
+                __compact__ = compact
+                __interned__ = True
+                x = FloatField()
+                flag = BooleanField()
+                tags = ListField()
+                scores = DictField(FloatField())
+
+            point = Point(1.0, True)
+            self.assertIsNot(Point(1, True), point)
+            self.assertIsNot(Point(1.0, 1), point)
+            self.assertIs(Point(1.0, True), point)
+            self.assertIsInstance(Point(1.0, True).x, float)
+            self.assertIsNot(Point(tags=[1]), Point(tags=[1.0]))
+            self.assertIsNot(Point(scores=dict(a=1)),
+                             Point(scores=dict(a=1.0)))
+            self.assertIs(Point(scores=dict(a=1.0)),
+                          Point(scores=dict(a=1.0)))
+            Point(1.0, True).validate()
+            self.assertRaises(ValidationError, Point(1, True).validate)
+
+    def test_copy(self):
+        for compact in (False, True):
+            class Account(Entity):
+                id = IntegerField(group=PRIMARY)
+
+            class Line(Entity):
+                __compact__ = compact
+                amount = IntegerField()
+                tags = ListField(StringField())
+
+            class Order(Entity):
+                __compact__ = compact
+                id = IntegerField(group=PRIMARY)
+                account = ReferenceField(Account)
+                lines = ListField(EntityField(Line))
+                totals = DictField(EntityField(Line))
+                parent = EntityField(Entity)
+
+            account = Account(1)
+            line = Line(5, ['a'])
+            order = Order(1, account, [line, line], dict(x=line))
+
+            shallow = order.copy()
+            self.assertIsNot(shallow, order)
+            self.assertIs(shallow.lines, order.lines)
+
+            deep = order.copy(deep=True)
+            self.assertIs(deep.account, account)
+            self.assertIsNot(deep.lines, order.lines)
+            self.assertIsNot(deep.lines[0], line)
+            self.assertIsNot(deep.lines[0].tags, line.tags)
+            self.assertEqual(deep.lines[0].tags, ['a'])
+            # Shared entities stay shared.
+            self.assertIs(deep.lines[0], deep.lines[1])
+            self.assertIs(deep.totals['x'], deep.lines[0])
+
+            # Cycles are copied as cycles.
+            order.parent = order
+            deep = order.copy(deep=True)
+            self.assertIs(deep.parent, deep)
+
+        order = Order.from_raw({'id': 1, 'lines': [{'amount': 1}]})
+        deep = order.copy(deep=True)
+        self.assertIsNot(deep.lines, order.lines)
+        self.assertEqual(deep.lines[0].amount, 1)
+
+    def test_copy_deep(self):
+        class Node(Entity):
+            id = IntegerField(group=PRIMARY)
+            parent = EntityField(Entity, group=PRIMARY)
+            items = ListField(IntegerField(), recursive=True)
+
+        node = Node(0)
+        for index in xrange(1, 5000):
+            node = Node(index, node)
+        items = [1]
+        for _ in xrange(5000):
+            items = [items, 2]
+        node.items = items
+
+        copy = node.copy(deep=True)
+        original = node
+        while original is not None:
+            self.assertIsNot(copy, original)
+            self.assertEqual(copy.id, original.id)
+            copy, original = copy.parent, original.parent
+        self.assertIsNone(copy)
+
+        copy = node.copy(deep=True).items
+        while len(items) == 2:
+            self.assertIsNot(copy, items)
+            self.assertEqual(copy[1], 2)
+            copy, items = copy[0], items[0]
+        self.assertEqual(copy, [1])
+
+    def test_snapshot(self):
+        for compact in (False, True):
+            class Line(Entity):
+                __compact__ = compact
+                amount = IntegerField(group=PRIMARY)
+
+            class Order(Entity):
+                __compact__ = compact
+                __cache_keys__ = True
+                id = IntegerField(group=PRIMARY)
+                lines = ListField(EntityField(Line), group=PRIMARY)
+                main = EntityField(Line)
+
+            order = Order(1, [Line(1)], Line(2))
+            self.assertEqual(order.keyify(), (1, ((1,),)))
+            snapshot = order.snapshot()
+
+            order.lines.append(Line(3))
+            order.main.amount = 4
+            self.assertEqual(len(snapshot.lines), 1)
+            self.assertEqual(snapshot.main.amount, 2)
+            self.assertEqual(order.keyify(), (1, ((1,), (3,))))
+
+            # The snapshot takes the shared values once the order has its
+            # own copies.
+            lines = snapshot.lines
+            self.assertIs(snapshot.lines, lines)
+            lines[0].amount = 5
+            self.assertEqual(order.lines[0].amount, 1)
+
+            # Snapshots of snapshots share with both.
+            order.id = 2
+            first = order.snapshot()
+            second = first.snapshot()
+            second.lines.pop()
+            self.assertEqual(first.id, 2)
+            self.assertEqual(len(first.lines), 2)
+            self.assertEqual(len(order.lines), 2)
+            self.assertEqual(len(second.lines), 1)
+            self.assertEqual(copy.deepcopy(first).keyify(),
+                             (2, ((1,), (3,))))
+
     def test_repr(self):
         class Foo(Entity):
             id = IntegerField(0)
@@ -144,6 +144,22 @@ class TestCollectionField(unittest.TestCase):
         self.assertEqual(field.keyify(None), None)
         self.assertEqual(field.keyify([[1], [2, 3]]), ((1,), (2, 3)))
 
+    def test_recursive_deep(self):
+        field = ListField(IntegerField(), recursive=True)
+        value = [1]
+        for _ in xrange(5000):
+            value = [value, 2]
+        field.validate(value)
+        key = field.keyify(value)
+        self.assertEqual(key[1], 2)
+
+        value[0][0][0] = '3'
+        self.assertRaises(ValidationError, field.validate, value)
+
+        value.append(value)
+        self.assertRaises(CycleError, field.validate, value)
+        self.assertRaises(CycleError, field.keyify, value)
+
 
 class TestListField(unittest.TestCase):
 
@@ -0,0 +1,258 @@
+import gc
+import unittest
+import weakref
+from StringIO import StringIO
+from entities import *
+from entities.json import encode, decode, dumps, loads, encode_key, \
+    decode_key, decode_date, decode_time, iter_load, dump_stream, LineError, \
+    read_key
+
+
+class Account(Entity):
+    id = IntegerField(group=PRIMARY)
+    iban = IntegerField(group=SECONDARY)
+    balance = FloatField(default=0.0)
+
+
+class Name(Entity):
+    first_name = StringField(group=SECONDARY)
+    last_name = StringField(group=SECONDARY)
+
+
+class Customer(Entity):
+    id = IntegerField(group=PRIMARY)
+    name = EntityField(Name, group=SECONDARY)
+    accounts = ListField(ReferenceField(Account), default=list)
+    owner = ReferenceField(Name, reference_group=SECONDARY)
+
+
+class Collections(Entity):
+    __compact__ = True
+    items = ListField(IntegerField())
+    nested = ListField(ListField(FloatField()))
+    tree = ListField(IntegerField(), recursive=True)
+    tags = SetField(StringField())
+    scores = DictField(FloatField())
+    names = DictField(EntityField(Name))
+    untyped = ListField()
+    born = DateField()
+    seen = TimeField()
+
+
+class TestJson(unittest.TestCase):
+
+    def test_round_trip(self):
+        entity = Account(1, 111, 10.0)
+        self.assertEqual(encode(entity), {'id': 1, 'iban': 111,
+                                          'balance': 10.0})
+
+        copy = loads(dumps(entity), Account)
+        self.assertIsInstance(copy, Account)
+        self.assertEqual(copy._values, entity._values)
+
+    def test_nested(self):
+        entity = Customer(1, Name('eser', 'aygun'),
+                          [Account(1, 111), Account(2, 222)])
+        data = encode(entity)
+        self.assertEqual(data['name'], {'first_name': 'eser',
+                                        'last_name': 'aygun'})
+        self.assertEqual(data['accounts'], [[1], [2]])
+        self.assertEqual(data['owner'], None)
+
+        copy = loads(dumps(entity), Customer)
+        self.assertEqual(copy.name.keyify(SECONDARY), ('eser', 'aygun'))
+        self.assertEqual([account.keyify() for account in copy.accounts],
+                         [(1,), (2,)])
+        self.assertEqual(copy.accounts[0].iban, None)
+        self.assertEqual(copy.owner, None)
+        self.assertEqual(copy.keyify(SECONDARY), entity.keyify(SECONDARY))
+        copy.validate()
+
+    def test_lazy(self):
+        entity = Customer(1, Name('eser', 'aygun'), [Account(1, 111)])
+        copy = loads(dumps(entity), Customer, lazy=True)
+        self.assertEqual(copy._values, {})
+        self.assertEqual(copy.keyify(SECONDARY), entity.keyify(SECONDARY))
+        self.assertEqual(copy.accounts[0].id, 1)
+        self.assertEqual(encode(copy), encode(entity))
+
+    def test_reference_group(self):
+        entity = Customer(1, owner=Name('eser', 'aygun'))
+        self.assertEqual(encode(entity)['owner'], ['eser', 'aygun'])
+        self.assertEqual(loads(dumps(entity), Customer).owner.first_name,
+                         'eser')
+
+    def test_collections(self):
+        entity = Collections(
+            [1, 2], [[1.0], [2.0, None]], [1, [2, [3]]], {'a', 'b'},
+            {'a': 1.0}, {'a': Name('eser', 'aygun'), 'b': None}, [1, 'x'],
+            datetime.date(2015, 1, 2),
+            pytz.utc.localize(datetime.datetime(2015, 1, 2, 3, 4, 5, 6))
+        )
+        copy = loads(dumps(entity), Collections)
+        for name in Collections._fields:
+            if name != 'names':
+                self.assertEqual(getattr(copy, name), getattr(entity, name))
+        self.assertIsInstance(copy.tags, set)
+        self.assertEqual(copy.names['a'].keyify(SECONDARY), ('eser', 'aygun'))
+        self.assertEqual(copy.names['b'], None)
+        copy.validate()
+
+    def test_projection(self):
+        entity = Customer(1, Name('eser', 'aygun'), [Account(1, 111)])
+        text = dumps(entity)
+        copy = loads(text, Customer, only=SECONDARY)
+        self.assertEqual(copy._values.keys(), ['name'])
+        self.assertEqual(copy.name.keyify(SECONDARY), ('eser', 'aygun'))
+        self.assertEqual(copy.accounts, [])
+        self.assertEqual(read_key(text, Customer), (1,))
+        self.assertEqual(read_key(text, Customer, SECONDARY),
+                         (('eser', 'aygun'),))
+
+        copy = loads(text, Customer, lazy=True, only=['id', 'accounts'])
+        self.assertEqual(copy.id, 1)
+        self.assertEqual(copy.accounts[0].id, 1)
+        self.assertEqual(copy.name, None)
+        self.assertRaises(ValueError, loads, text, Customer, only=['nope'])
+        copy = loads(text, Customer, only='accounts')
+        self.assertEqual(copy._values.keys(), ['accounts'])
+        self.assertRaises(ValueError, loads, text, Customer, only='nope')
+
+        copy = decode(encode(Collections([1, 2], born=datetime.date.today())),
+                      Collections, only=['born'])
+        self.assertEqual(copy.born, datetime.date.today())
+        self.assertEqual(copy.items, None)
+
+    def test_missing_and_null(self):
+        copy = decode({'id': None, 'unknown': 1}, Customer)
+        self.assertEqual(copy._values, {'id': None})
+        self.assertEqual(copy.accounts, [])
+
+        copy = decode({'tags': None}, Collections)
+        self.assertEqual(copy.tags, None)
+
+    def test_keys(self):
+        key = (1, ('a', frozenset([2, 1])), datetime.date(2015, 1, 2))
+        self.assertEqual(encode_key(key), [1, ['a', [1, 2]], '2015-01-02'])
+
+        entity = decode_key([1, ['eser', 'aygun']], Customer, PRIMARY,
+                            SECONDARY)
+        self.assertEqual(entity.id, 1)
+        self.assertEqual(entity.name, None)
+
+        entity = decode_key(['eser', 'aygun'], Name, SECONDARY)
+        self.assertEqual(entity.last_name, 'aygun')
+
+    def test_dates(self):
+        self.assertEqual(decode_date('2015-01-02'), datetime.date(2015, 1, 2))
+        self.assertEqual(decode_time('2015-01-02T03:04:05'),
+                         datetime.datetime(2015, 1, 2, 3, 4, 5))
+        self.assertEqual(
+            decode_time('2015-01-02T03:04:05.5Z'),
+            pytz.utc.localize(datetime.datetime(2015, 1, 2, 3, 4, 5, 500000))
+        )
+        self.assertEqual(
+            decode_time('2015-01-02T05:34:05+02:30'),
+            pytz.utc.localize(datetime.datetime(2015, 1, 2, 3, 4, 5))
+        )
+        self.assertRaises(ValueError, decode_time, '2015-01-02')
+
+
+class GeneratedFile(object):
+    # Produces count lines on demand without keeping them around.
+
+    def __init__(self, count):
+        self.lines = ('{"id":%d,"iban":%d}\n' % (index, index)
+                      for index in xrange(count))
+        self.largest_read = 0
+
+    def read(self, size):
+        self.largest_read = max(self.largest_read, size)
+        chunk = []
+        length = 0
+        for line in self.lines:
+            chunk.append(line)
+            length += len(line)
+            if length >= size:
+                break
+        return ''.join(chunk)
+
+
+class NullFile(object):
+
+    def __init__(self):
+        self.largest_write = 0
+        self.size = 0
+
+    def write(self, text):
+        self.largest_write = max(self.largest_write, len(text))
+        self.size += len(text)
+
+
+class TestStream(unittest.TestCase):
+
+    def test_round_trip(self):
+        accounts = [Account(index, index * 10) for index in xrange(100)]
+        stream = StringIO()
+        self.assertEqual(dump_stream(iter(accounts), stream, chunk_size=64),
+                         100)
+
+        stream.seek(0)
+        copies = list(iter_load(stream, Account, chunk_size=50))
+        self.assertEqual([copy._values for copy in copies],
+                         [account._values for account in accounts])
+
+    def test_long_lines(self):
+        stream = StringIO('{"id":1,%s"balance":2.5}\n{"id":2}' % (' ' * 1000))
+        entities = list(iter_load(stream, Account, chunk_size=7))
+        self.assertEqual([entity.id for entity in entities], [1, 2])
+        self.assertEqual(entities[0].balance, 2.5)
+
+    def test_errors(self):
+        stream = StringIO('{"id":1}\n'
+                          '\n'
+                          '{"id":\n'
+                          '{"id":"2"}\n'
+                          '{"id":3}')
+        errors = []
+        entities = list(iter_load(stream, Account, validate=True,
+                                  on_error=errors.append))
+        self.assertEqual([entity.id for entity in entities], [1, 3])
+        self.assertEqual([error.line for error in errors], [3, 4])
+        self.assertIsInstance(errors[0].error, ValueError)
+        self.assertIsInstance(errors[1].error, ValidationError)
+        self.assertTrue(str(errors[1]).startswith('line 4: '))
+
+        stream.seek(0)
+        entities = iter_load(stream, Account)
+        self.assertEqual(next(entities).id, 1)
+        self.assertRaises(LineError, next, entities)
+
+    def test_flat_memory(self):
+        count = 50000
+        source = GeneratedFile(count)
+        alive = weakref.WeakSet()
+        samples = []
+        for index, entity in enumerate(iter_load(source, Account,
+                                                 validate=True,
+                                                 chunk_size=4096)):
+            alive.add(entity)
+            if index % 10000 == 9999:
+                gc.collect()
+                samples.append(len(gc.get_objects()))
+        del entity
+
+        self.assertEqual(index, count - 1)
+        self.assertEqual(source.largest_read, 4096)
+        self.assertLessEqual(len(alive), 1)
+        self.assertLess(max(samples) - min(samples), 100)
+
+        sink = NullFile()
+        dump_stream((Account(index, index) for index in xrange(count)), sink,
+                    chunk_size=4096)
+        self.assertLess(sink.largest_write, 4096 + 100)
+        self.assertGreater(sink.size, count * 10)
+
+
+if __name__ == '__main__':
+    unittest.main()
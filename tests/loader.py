@@ -0,0 +1,129 @@
+import unittest
+from entities import *
+from entities import json, bson
+
+
+class Account(Entity):
+    id = IntegerField(group=PRIMARY)
+    iban = IntegerField(group=SECONDARY)
+
+
+class Customer(Entity):
+    id = IntegerField(group=PRIMARY)
+    main = ReferenceField(Account, lazy=True, group=PRIMARY)
+    accounts = ListField(ReferenceField(Account, lazy=True))
+    tags = SetField(ReferenceField(Account, SECONDARY, lazy=True))
+    named = DictField(ReferenceField(Account, lazy=True))
+
+
+ACCOUNTS = dict(((index,), Account(index, index * 10))
+                for index in xrange(10))
+
+
+class TestLoader(unittest.TestCase):
+
+    def setUp(self):
+        self.calls = []
+        self.loader = register_loader(Account, self.load, size=4)
+
+    def tearDown(self):
+        Account._loader = None
+
+    def load(self, keys, group):
+        self.calls.append((list(keys), group))
+        if group == SECONDARY:
+            return [ACCOUNTS.get((key[0] // 10,)) for key in keys]
+        return [ACCOUNTS.get(key) for key in keys]
+
+    def test_resolve(self):
+        customer = Customer(1, (2,))
+        self.assertEqual(customer.keyify(), (1, (2,)))
+        customer.validate()
+        self.assertEqual(self.calls, [])
+
+        self.assertIs(customer.main, ACCOUNTS[2,])
+        self.assertIs(customer.main, ACCOUNTS[2,])
+        self.assertEqual(self.calls, [([(2,)], PRIMARY)])
+        self.assertEqual(customer.keyify(), (1, (2,)))
+        customer.validate()
+
+        self.assertIs(Customer(2, (2,)).main, ACCOUNTS[2,])
+        self.assertEqual(len(self.calls), 1)
+        self.assertEqual((self.loader.hits, self.loader.misses), (1, 1))
+
+    def test_batch(self):
+        customer = Customer(1, accounts=[(1,), ACCOUNTS[2,], (3,), (1,)],
+                            tags={(40,), (50,)}, named={'a': (6,)})
+        self.assertEqual(customer.keyify(), (1, None))
+        customer.validate()
+        self.assertEqual(self.calls, [])
+
+        self.assertEqual(customer.accounts, [ACCOUNTS[1,], ACCOUNTS[2,],
+                                             ACCOUNTS[3,], ACCOUNTS[1,]])
+        self.assertEqual(self.calls, [([(1,), (3,)], PRIMARY)])
+        self.assertEqual(customer.tags, {ACCOUNTS[4,], ACCOUNTS[5,]})
+        self.assertEqual(self.calls[1][1], SECONDARY)
+        self.assertEqual(customer.named, {'a': ACCOUNTS[6,]})
+        self.assertEqual(len(self.calls), 3)
+
+        customer.accounts
+        self.assertEqual(len(self.calls), 3)
+
+    def test_resolve_once(self):
+        customer = Customer(1, accounts=[(1,), (2,)])
+        accounts = customer.accounts
+        scans = []
+        field = Customer.accounts
+        resolve = field._resolve_items
+        field._resolve_items = lambda value: scans.append(1) or resolve(value)
+        try:
+            for index in xrange(2):
+                self.assertIs(customer.accounts[index], accounts[index])
+            self.assertEqual(scans, [])
+
+            # Keys added in place are resolved once the field is touched or
+            # assigned again.
+            customer.accounts.append((3,))
+            customer.touch('accounts')
+            self.assertIs(customer.accounts[2], ACCOUNTS[3,])
+            customer.accounts = [(4,)]
+            self.assertIs(customer.accounts[0], ACCOUNTS[4,])
+            self.assertEqual(len(scans), 2)
+        finally:
+            del field._resolve_items
+
+    def test_cache(self):
+        for index in [1, 2, 3, 4, 1, 5, 2]:
+            self.loader.load((index,))
+        self.assertEqual(len(self.loader), 4)
+        self.assertEqual((self.loader.hits, self.loader.misses), (1, 6))
+        self.assertEqual([keys for keys, group in self.calls],
+                         [[(1,)], [(2,)], [(3,)], [(4,)], [(5,)], [(2,)]])
+
+        self.loader.clear()
+        self.assertEqual(len(self.loader), 0)
+
+    def test_errors(self):
+        customer = Customer(1, (20,), [1])
+        self.assertRaises(KeyError, getattr, customer, 'main')
+        self.assertRaises(ValidationError, customer.validate)
+
+        register_loader(Account, lambda keys, group: [ACCOUNTS[1,]])
+        customer = Customer(1, None, [(1,), (2,)])
+        self.assertRaises(ValueError, getattr, customer, 'accounts')
+
+        Account._loader = None
+        self.assertRaises(LookupError, getattr, Customer(1, (2,)), 'main')
+
+    def test_serialization(self):
+        customer = Customer(1, (2,), [ACCOUNTS[3,], (4,)])
+        for module in (json, bson):
+            copy = module.decode(module.encode(customer), Customer)
+            self.assertEqual(copy._values['main'], (2,))
+            self.assertEqual(copy._values['accounts'], [(3,), (4,)])
+            self.assertIs(copy.accounts[1], ACCOUNTS[4,])
+        self.assertEqual(self.calls, [([(3,), (4,)], PRIMARY)])
+
+
+if __name__ == '__main__':
+    unittest.main()
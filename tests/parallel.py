@@ -0,0 +1,116 @@
+import functools
+import multiprocessing
+import pickle
+import unittest
+from entities import *
+from entities.parallel import validate_many
+
+
+class Item(Entity):
+    id = IntegerField(null=False)
+    tags = ListField(StringField())
+
+
+class Order(Entity):
+    id = IntegerField(group=PRIMARY)
+    items = ListField(EntityField(Item))
+
+
+def make_orders(count):
+    orders = []
+    for index in xrange(count):
+        if index % 5 == 0:
+            orders.append(Order(str(index)))
+        elif index % 7 == 0:
+            orders.append(Order(index, [Item(None, ['a', 1]), Item(1)]))
+        else:
+            orders.append(Order(index, [Item(index)]))
+    return orders
+
+
+class TestValidateMany(unittest.TestCase):
+
+    def test_flatten(self):
+        with self.assertRaises(ValidationError) as context:
+            Order('1', [Item(None, [1])]).validate()
+        records = context.exception.flatten()
+        self.assertEqual(records, [
+            ErrorRecord('id', "'1'", 'invalid type'),
+            ErrorRecord('items[0].id', 'None', 'null value'),
+            ErrorRecord('items[0].tags[0]', '1', 'invalid type'),
+        ])
+        self.assertEqual(pickle.loads(pickle.dumps(records, 2)), records)
+
+    def test_paths(self):
+        class Leaf(Entity):
+            names = DictField(StringField())
+
+        class Node(Entity):
+            id = IntegerField()
+            tree = ListField(IntegerField(), recursive=True)
+            parent = EntityField(Leaf)
+
+        node = Node(1, [[1, ['2']]], Leaf({'a': 'b', 'c': 3}))
+        expected = [
+            ErrorRecord("parent.names['c']", '3', 'invalid type'),
+            ErrorRecord('tree[0][1][0]', "'2'", 'invalid type'),
+        ]
+        with self.assertRaises(ValidationError) as context:
+            node.validate()
+        self.assertEqual(sorted(context.exception.flatten()), expected)
+        self.assertEqual(sorted(str(context.exception).splitlines()), [
+            "parent.names['c'] = 3 (invalid type)",
+            "tree[0][1][0] = '2' (invalid type)",
+        ])
+        with self.assertRaises(ValidationError) as context:
+            node.validate(max_errors=5)
+        self.assertEqual(sorted(context.exception.flatten()), expected)
+
+        # Errors of shared values are reported at every place they are in.
+        item = Item(None)
+        with self.assertRaises(ValidationError) as context:
+            Order(1, [item, Item(1), item]).validate()
+        self.assertEqual(context.exception.flatten(), [
+            ErrorRecord('items[0].id', 'None', 'null value'),
+            ErrorRecord('items[2].id', 'None', 'null value'),
+        ])
+
+    def test_serial(self):
+        errors = validate_many(make_orders(30), chunksize=4)
+        self.assertEqual(sorted(errors), [0, 5, 7, 10, 14, 15, 20, 21, 25, 28])
+        self.assertEqual(errors[5], [ErrorRecord('id', "'5'",
+                                                 'invalid type')])
+        self.assertEqual(errors[7], [
+            ErrorRecord('items[0].id', 'None', 'null value'),
+            ErrorRecord('items[0].tags[1]', '1', 'invalid type'),
+        ])
+        self.assertEqual(validate_many([]), {})
+
+        errors = validate_many(make_orders(30), fail_fast=True)
+        self.assertEqual(errors[7], [ErrorRecord('items[0].id', 'None',
+                                                 'null value')])
+
+    def test_parallel(self):
+        orders = make_orders(100)
+        self.assertEqual(validate_many(orders, workers=2, chunksize=7),
+                         validate_many(orders))
+        self.assertEqual(validate_many(iter(orders), workers=3),
+                         validate_many(orders))
+        self.assertEqual(validate_many(orders, workers=2, max_errors=1),
+                         validate_many(orders, fail_fast=True))
+
+    def test_respawned_workers(self):
+        # Workers started in place of those that finished their tasks still
+        # see the entities.
+        orders = make_orders(50)
+        pool = multiprocessing.Pool
+        multiprocessing.Pool = functools.partial(pool, maxtasksperchild=1)
+        try:
+            errors = validate_many(orders, workers=2, chunksize=5)
+        finally:
+            multiprocessing.Pool = pool
+        self.assertEqual(errors, validate_many(orders))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,144 @@
+import datetime
+import unittest
+from entities import *
+
+
+class Account(Entity):
+    id = IntegerField(group=PRIMARY)
+    balance = FloatField()
+
+
+class Name(Entity):
+    first_name = StringField()
+    last_name = StringField()
+
+
+class Customer(Entity):
+    id = IntegerField(group=PRIMARY)
+    name = EntityField(Name)
+    born = DateField()
+    accounts = ListField(EntityField(Account))
+    main = ReferenceField(Account)
+    tags = SetField(StringField())
+    notes = DictField(StringField())
+    tree = ListField(IntegerField(), recursive=True)
+
+
+def make_customer():
+    return Customer(1, Name(u'eser', u'aygun'), datetime.date(2000, 1, 1),
+                    [Account(index, 1.0) for index in xrange(5)],
+                    Account(9, 0.0), {u'a'}, {u'x': u'y'}, [1, [2, 3]])
+
+
+class TestPatch(unittest.TestCase):
+
+    def test_diff(self):
+        old, new = make_customer(), make_customer()
+        self.assertEqual(diff(old, new), {})
+        self.assertRaises(TypeError, diff, old, Account())
+
+        new.name.last_name = u'ayg\xfcn'
+        new.born = datetime.date(2001, 2, 3)
+        new.accounts[2].balance = 2.0
+        new.main = Account(10, 0.0)
+        new.tags = {u'a', u'b'}
+        new.notes = {u'z': u'w'}
+        new.tree[1].append(4)
+        self.assertEqual(diff(old, new), {
+            'name': ['e', {'last_name': ['=', u'ayg\xfcn']}],
+            'born': ['=', '2001-02-03'],
+            'accounts': ['i', [[2, ['e', {'balance': ['=', 2.0]}]]]],
+            'main': ['=', [10]],
+            'tags': ['s', [u'b'], []],
+            'notes': ['d', {u'z': ['=', u'w']}, [u'x']],
+            'tree': ['i', [[1, ['l', 2, 2, [4]]]]],
+        })
+
+    def test_diff_references(self):
+        old, new = make_customer(), make_customer()
+        new.main.balance = 5.0
+        self.assertEqual(diff(old, new), {})
+
+    def test_diff_lists(self):
+        old, new = make_customer(), make_customer()
+        new.accounts.insert(1, Account(10, 0.0))
+        self.assertEqual(diff(old, new), {
+            'accounts': ['l', 1, 1, [{'id': 10, 'balance': 0.0}]]
+        })
+
+        new.accounts[:] = old.accounts[:2]
+        self.assertEqual(diff(old, new), {'accounts': ['l', 2, 5, []]})
+
+    def test_apply_patch(self):
+        old, new = make_customer(), make_customer()
+        new.name = None
+        new.born = datetime.date(2001, 2, 3)
+        new.accounts[2].balance = 2.0
+        new.accounts.append(Account(10, 0.0))
+        new.main = Account(10, 0.0)
+        new.tags.discard(u'a')
+        new.notes[u'x'] = u'z'
+        new.tree.append([5, [6]])
+        new.tree[1][0] = 7
+
+        entity = apply_patch(old, diff(old, new))
+        self.assertIs(entity, old)
+        self.assertEqual(diff(old, new), {})
+        self.assertEqual(old.main.keyify(), (10,))
+        old.validate()
+
+    def test_apply_patch_keys(self):
+        class Foo(Entity):
+            __cache_keys__ = True
+            id = IntegerField(group=PRIMARY)
+            items = ListField(IntegerField(), group=PRIMARY)
+
+        old, new = Foo(1, [1, 2]), Foo(1, [1, 3])
+        self.assertEqual(old.keyify(), (1, (1, 2)))
+        apply_patch(old, diff(old, new))
+        self.assertEqual(old.keyify(), (1, (1, 3)))
+
+    def test_patch_entity_sets(self):
+        # Members are compared by their keys, not by identity.
+        for item_field, raw in ((ReferenceField(Account), [3]),
+                                (EntityField(Account),
+                                 {'id': 3, 'balance': 1.0})):
+            class Owner(Entity):
+                accounts = SetField(item_field)
+
+            def make_owner(*ids):
+                return Owner(set(Account(id, 1.0) for id in ids))
+
+            old, new = make_owner(1, 2), make_owner(1, 3)
+            patch = diff(old, new)
+            self.assertEqual(patch['accounts'][1], [raw])
+            self.assertEqual(diff(old, make_owner(2, 1)), {})
+
+            replica = make_owner(1, 2)
+            apply_patch(replica, patch)
+            self.assertEqual(sorted(account.id
+                                    for account in replica.accounts),
+                             [1, 3])
+
+    def test_apply_patch_subclasses(self):
+        class Savings(Account):
+            id = IntegerField(group=PRIMARY)
+            balance = FloatField()
+            rate = FloatField()
+
+        old, new = make_customer(), make_customer()
+        old.accounts[0] = Savings(0, 1.0, 0.5)
+        new.accounts[0] = Savings(0, 1.0, 0.7)
+        new.accounts[1] = Savings(1, 1.0, 0.5)
+        apply_patch(old, diff(old, new))
+
+        # Patched in place, so the class is kept.
+        self.assertIs(type(old.accounts[0]), Savings)
+        self.assertEqual(old.accounts[0].rate, 0.7)
+        # Replaced, so restored as the class of the field.
+        self.assertIs(type(old.accounts[1]), Account)
+        self.assertEqual(old.accounts[1].keyify(), (1,))
+
+
+if __name__ == '__main__':
+    unittest.main()
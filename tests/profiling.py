@@ -0,0 +1,75 @@
+from __future__ import absolute_import
+import StringIO
+import unittest
+from entities import *
+from entities import profiling
+import json
+
+
+class Account(Entity):
+    id = IntegerField(group=PRIMARY)
+    balance = FloatField(default=0.0)
+
+
+class Customer(Entity):
+    __compact__ = True
+    id = IntegerField(group=PRIMARY)
+    accounts = ListField(EntityField(Account), group=PRIMARY)
+
+
+class TestProfiling(unittest.TestCase):
+
+    def tearDown(self):
+        profiling.disable()
+        profiling.reset()
+
+    def test_snapshot(self):
+        customer = Customer(1, [Account(1), Account(2)])
+        profiling.enable()
+        profiling.enable()
+        self.assertTrue(profiling.is_enabled())
+        customer.validate()
+        customer.keyify()
+        customer.id = 2
+        self.assertEqual(customer.accounts[0].balance, 0.0)
+        profiling.disable()
+        self.assertFalse(profiling.is_enabled())
+        customer.validate()
+
+        stats = profiling.snapshot()
+        calls = dict((name, dict((operation, entry['calls'])
+                                 for operation, entry in operations.items()))
+                     for name, operations in stats.items())
+        self.assertEqual(calls['Customer.id'],
+                         {'validate': 1, 'keyify': 1, 'set': 1})
+        self.assertEqual(calls['Customer.accounts'],
+                         {'validate': 1, 'keyify': 1, 'get': 1})
+        self.assertEqual(calls['Customer.accounts.<item>'],
+                         {'validate': 2, 'keyify': 2})
+        self.assertEqual(calls['Account.balance'],
+                         {'validate': 2, 'get': 1, 'make_default': 2})
+        self.assertGreaterEqual(stats['Customer.id']['validate']['time'], 0)
+
+        fileobj = StringIO.StringIO()
+        profiling.export(fileobj)
+        self.assertEqual(json.loads(fileobj.getvalue()), stats)
+
+        profiling.reset()
+        self.assertEqual(profiling.snapshot(), {})
+
+    def test_disabled(self):
+        validate = vars(Customer)['_validate']
+        get = vars(Field)['__get__']
+        profiling.enable()
+        self.assertIsNot(vars(Customer)['_validate'], validate)
+        self.assertIsNot(vars(Field)['__get__'], get)
+        profiling.disable()
+        self.assertIs(vars(Customer)['_validate'], validate)
+        self.assertIs(vars(Field)['__get__'], get)
+
+        Customer(1, []).validate()
+        self.assertEqual(profiling.snapshot(), {})
+
+
+if __name__ == '__main__':
+    unittest.main()
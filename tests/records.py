@@ -0,0 +1,113 @@
+import datetime
+import os
+import pickle
+import shutil
+import tempfile
+import unittest
+import pytz
+from entities import *
+from entities.records import write_records, RecordFile
+
+
+class Account(Entity):
+    id = IntegerField(group=PRIMARY)
+    balance = FloatField()
+    active = BooleanField()
+    opened = DateField()
+    seen = TimeField()
+
+
+class Reading(Entity):
+    value = FloatField(group=PRIMARY)
+    sensor = IntegerField(group=PRIMARY)
+
+
+def make_accounts(count):
+    seen = datetime.datetime(2014, 1, 1, 12, tzinfo=pytz.utc)
+    return [Account(index * 7 % count - count // 2,
+                    None if index % 3 == 0 else index * 1.5,
+                    index % 2 == 0,
+                    datetime.date(2014, 1, 1) + datetime.timedelta(index),
+                    seen + datetime.timedelta(seconds=index))
+            for index in xrange(count)]
+
+
+class TestRecords(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'accounts.rec')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_read(self):
+        accounts = make_accounts(10000)
+        self.assertEqual(write_records(self.path, Account, accounts), 10000)
+        with RecordFile(self.path, Account) as records:
+            self.assertEqual(len(records), 10000)
+            for number in (0, 1, 4095, 4096, 9999, -1):
+                record, account = records[number], accounts[number]
+                for name in Account._fields:
+                    self.assertEqual(getattr(record, name),
+                                     getattr(account, name))
+            self.assertEqual(records[3].balance, None)
+            with self.assertRaises(IndexError):
+                records[10000]
+            with self.assertRaises(LookupError):
+                records.find((1,))
+
+            for name in Account._fields:
+                self.assertEqual(list(records.column(name)),
+                                 [getattr(account, name)
+                                  for account in accounts])
+
+            copied = pickle.loads(pickle.dumps(records[5], 2))
+        self.assertEqual(copied.seen, accounts[5].seen)
+
+    def test_find(self):
+        accounts = make_accounts(1000)
+        write_records(self.path, Account, accounts, index=True,
+                      buffer_size=64)
+        with RecordFile(self.path, Account) as records:
+            for account in accounts:
+                self.assertEqual(records.find(account.keyify()).opened,
+                                 account.opened)
+            self.assertIsNone(records.find((1000,)))
+            self.assertIsNone(records.find((None,)))
+
+        readings = [Reading(value, sensor)
+                    for value in (-2.5, -0.0, 1e-300, 3.0, None)
+                    for sensor in (2, -1)]
+        write_records(self.path, Reading, readings, index=True)
+        with RecordFile(self.path, Reading) as records:
+            for reading in readings:
+                self.assertEqual(records.find(reading.keyify()).keyify(),
+                                 reading.keyify())
+            self.assertIsNone(records.find((0.5, 2)))
+            self.assertEqual(records.find((0.0, 2)).value, 0.0)
+
+        write_records(self.path, Reading, [], index=True)
+        with RecordFile(self.path, Reading) as records:
+            self.assertEqual(len(records), 0)
+            self.assertIsNone(records.find((0.5, 2)))
+
+    def test_schema(self):
+        write_records(self.path, Reading, [Reading(1.0, 1)])
+        with self.assertRaises(ValueError):
+            RecordFile(self.path, Account)
+
+        with open(self.path, 'wb') as fileobj:
+            fileobj.write('not a record file' * 10)
+        with self.assertRaises(ValueError):
+            RecordFile(self.path, Reading)
+
+        class Customer(Entity):
+            name = StringField()
+
+        with self.assertRaises(TypeError):
+            write_records(self.path, Customer, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
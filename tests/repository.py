@@ -0,0 +1,174 @@
+import pickle
+import unittest
+from entities import *
+
+
+class Name(Entity):
+    first_name = StringField(group=SECONDARY)
+    last_name = StringField(group=SECONDARY)
+
+
+class Customer(Entity):
+    id = IntegerField(group=PRIMARY)
+    name = EntityField(Name, group=SECONDARY)
+    note = StringField()
+
+
+class Tag(Entity):
+    label = StringField()
+
+
+class Order(Entity):
+    __cache_keys__ = True
+    id = IntegerField(group=PRIMARY)
+    customer = EntityField(Customer, group=PRIMARY)
+
+
+class TestEntityRepository(unittest.TestCase):
+
+    def setUp(self):
+        self.customers = [Customer(1, Name('eser', 'aygun')),
+                          Customer(2, Name('eser', 'aygun')),
+                          Customer(3, Name('foo', 'bar'))]
+        self.repository = EntityRepository(Customer, self.customers)
+
+    def test_lookup(self):
+        first, second, third = self.customers
+        self.assertEqual(len(self.repository), 3)
+        self.assertIs(self.repository.get((1,)), first)
+        self.assertEqual(self.repository.get((4,)), None)
+        self.assertEqual(self.repository.find((3,)), [third])
+        self.assertEqual(
+            self.repository.find((('eser', 'aygun'),), SECONDARY),
+            [first, second]
+        )
+        self.assertEqual(self.repository.find(((None, None),), SECONDARY),
+                         [])
+        self.assertIn(first, self.repository)
+        self.assertEqual(set(self.repository), set(self.customers))
+
+    def test_insert(self):
+        self.assertRaises(DuplicateKeyError, self.repository.insert,
+                          Customer(1))
+        self.assertRaises(ValueError, self.repository.insert,
+                          self.customers[0])
+        self.assertRaises(TypeError, self.repository.insert, Name())
+
+        # Nothing is inserted when one of the entities is rejected.
+        self.assertRaises(DuplicateKeyError, self.repository.insert_many,
+                          [Customer(4), Customer(5), Customer(4)])
+        self.assertEqual(len(self.repository), 3)
+        self.assertEqual(self.repository.get((4,)), None)
+
+    def test_upsert(self):
+        replacement = Customer(1, Name('foo', 'bar'))
+        self.repository.upsert_many([replacement, Customer(4)])
+        self.assertEqual(len(self.repository), 4)
+        self.assertIs(self.repository.get((1,)), replacement)
+        self.assertNotIn(self.customers[0], self.repository)
+        self.assertEqual(
+            len(self.repository.find((('foo', 'bar'),), SECONDARY)), 2
+        )
+
+        # The replaced entity is no longer tracked.
+        self.customers[0].id = 5
+        self.assertEqual(self.repository.get((5,)), None)
+
+    def test_delete(self):
+        self.repository.delete_many(self.customers[:2])
+        self.assertEqual(len(self.repository), 1)
+        self.assertEqual(self.repository.get((1,)), None)
+        self.assertEqual(
+            self.repository.find((('eser', 'aygun'),), SECONDARY), []
+        )
+        self.assertRaises(KeyError, self.repository.delete,
+                          self.customers[0])
+
+        self.customers[0].id = 3
+        self.repository.insert(Customer(1))
+
+    def test_reindex(self):
+        first, second, third = self.customers
+        first.id = 10
+        self.assertEqual(self.repository.get((1,)), None)
+        self.assertIs(self.repository.get((10,)), first)
+
+        # Nested key fields are tracked too.
+        second.name.first_name = 'foo'
+        self.assertEqual(
+            self.repository.find((('foo', 'aygun'),), SECONDARY), [second]
+        )
+        self.assertEqual(
+            self.repository.find((('eser', 'aygun'),), SECONDARY), [first]
+        )
+
+        second.name = third.name
+        third.name.last_name = 'baz'
+        self.assertItemsEqual(
+            self.repository.find((('foo', 'baz'),), SECONDARY),
+            [second, third]
+        )
+
+        # Fields outside groups do not cause reindexing.
+        third.note = 'x'
+        self.assertIs(self.repository.get((3,)), third)
+
+    def test_reindex_duplicate(self):
+        first, second, third = self.customers
+        try:
+            first.id = 2
+        except DuplicateKeyError, ex:
+            self.assertEqual(ex.key, (2,))
+            self.assertIs(ex.entity, first)
+        else:
+            self.fail('DuplicateKeyError not raised')
+        self.assertEqual(first.id, 1)
+        self.assertIs(self.repository.get((1,)), first)
+        self.assertIs(self.repository.get((2,)), second)
+
+        # The refused write leaves the entity indexed as before.
+        first.name = Name('foo', 'baz')
+        self.assertEqual(
+            self.repository.find((('foo', 'baz'),), SECONDARY), [first]
+        )
+        self.assertEqual(
+            self.repository.find((('eser', 'aygun'),), SECONDARY), [second]
+        )
+
+        first.id = 4
+        self.assertIs(self.repository.get((4,)), first)
+
+    def test_pickle(self):
+        first = self.customers[0]
+        order = Order(1, first)
+        self.assertEqual(order.keyify(), (1, (1,)))
+        copy = pickle.loads(pickle.dumps(first, 2))
+        self.assertEqual(copy.keyify(SECONDARY), (('eser', 'aygun'),))
+        self.assertNotIn(copy, self.repository)
+        self.assertEqual(copy._containers, None)
+
+        copy = pickle.loads(pickle.dumps(order, 2))
+        self.assertEqual(copy.keyify(), (1, (1,)))
+        copy.customer.id = 5
+        self.assertEqual(copy.keyify(), (1, (5,)))
+        self.assertIs(self.repository.get((1,)), first)
+
+    def test_dead_containers(self):
+        first = self.customers[0]
+        orders = [Order(index, first) for index in xrange(10)]
+        for order in orders:
+            order.keyify()
+        count = len(first._containers)
+        del order, orders[:]
+        self.assertEqual(len(first._containers), count - 10)
+
+    def test_without_groups(self):
+        tags = [Tag('a'), Tag('a')]
+        repository = EntityRepository(Tag, tags)
+        self.assertEqual(len(repository), 2)
+        repository.delete(tags[0])
+        self.assertEqual(list(repository), [tags[1]])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,217 @@
+import itertools
+import pickle
+import unittest
+from contextlib import contextmanager
+from entities import *
+
+
+@contextmanager
+def interpreted(*classes):
+    compiled = [cls.__dict__['_validate'] for cls in classes]
+    for cls in classes:
+        cls._validate = Entity.__dict__['_validate']
+    try:
+        yield
+    finally:
+        for cls, function in zip(classes, compiled):
+            cls._validate = function
+
+
+def outcome(entity):
+    try:
+        entity.validate()
+    except ValidationError, ex:
+        return describe(ex)
+
+
+def describe(error):
+    if isinstance(error, MultipleErrors):
+        nested = [describe(ex) for ex in error.errors]
+    else:
+        nested = None
+    return (type(error), error.field, id(error.value), error.reason, nested)
+
+
+class PositiveField(IntegerField):
+
+    def validate(self, value):
+        super(PositiveField, self).validate(value)
+        if value is not None and value <= 0:
+            raise ValidationError(self, value, 'not positive')
+
+
+class TaggedListField(ListField):
+
+    def _item_field_of(self, item):
+        return self.item_field
+
+
+def make_classes(prefix, compact):
+    class Child(Entity):
+        __compact__ = compact
+        id = IntegerField(group=PRIMARY)
+        name = StringField(null=False)
+
+    class Parent(Entity):
+        __compact__ = compact
+        id = IntegerField(null=False)
+        anything = Field()
+        dynamic = DynamicField(Child)
+        positive = PositiveField()
+        child = EntityField(Child)
+        reference = ReferenceField(Child)
+        items = ListField(IntegerField(null=False))
+        nested = ListField(ListField(FloatField()))
+        tree = ListField(IntegerField(), recursive=True)
+        mapping = DictField(EntityField(Child))
+        tags = SetField(StringField(), null=False)
+        tagged = TaggedListField(PositiveField())
+        untyped = ListField()
+
+    Parent.__name__ = prefix + 'Parent'
+    Child.__name__ = prefix + 'Child'
+    return Parent, Child
+
+
+Parent, Child = make_classes('', False)
+CompactParent, CompactChild = make_classes('Compact', True)
+
+
+SAMPLES = dict(
+    id=[1, None, '1'],
+    anything=[None, object()],
+    dynamic=[None, Child(1, 'x'), 1],
+    positive=[1, -1, 1.0],
+    child=[None, Child(1, 'x'), Child('1', None), 1],
+    reference=[None, Child('1'), 'x'],
+    items=[None, [1, 2], [1, None, '3'], (1,)],
+    nested=[[[1.0], [2.0, '3']], [None, [1]], [[1.0], 2.0]],
+    tree=[[1, [2, [3]]], [1, ['2', [3.0]]], ['1']],
+    mapping=[{}, {'a': Child(1, 'a')}, {'a': Child(), 'b': None, 'c': 1}],
+    tags=[set(), None, {'a', 1}, {1, 2.0}],
+    tagged=[[1], [0, -1], [None, '1']],
+    untyped=[[None, 1, 'x'], 1],
+)
+
+
+class TestCompiledValidate(unittest.TestCase):
+    Parent = Parent
+    Child = Child
+
+    def assertEquivalent(self, entity):
+        compiled = outcome(entity)
+        with interpreted(self.Parent, self.Child):
+            expected = outcome(entity)
+        self.assertEqual(compiled, expected)
+
+    def samples(self):
+        samples = dict(SAMPLES)
+        for name, values in samples.iteritems():
+            samples[name] = [self.convert(value) for value in values]
+        return samples
+
+    def convert(self, value):
+        if isinstance(value, Child):
+            return self.Child(**value._values)
+        elif isinstance(value, list):
+            return [self.convert(item) for item in value]
+        elif isinstance(value, dict):
+            return dict((key, self.convert(item))
+                        for key, item in value.iteritems())
+        else:
+            return value
+
+    def test_compiled(self):
+        self.assertIsNot(self.Parent._validate, Entity.__dict__['_validate'])
+        self.assertIsNot(self.Child._validate, Entity.__dict__['_validate'])
+
+    def test_valid(self):
+        Parent, Child = self.Parent, self.Child
+        entity = Parent(1, None, Child(), 1, Child(1, 'x'), Child(), [1],
+                        [[1.0]], [1, [2]], {'a': Child(1, 'a')}, {'a'}, [1],
+                        [None])
+        self.assertEqual(outcome(entity), None)
+        self.assertEquivalent(entity)
+
+    def test_defaults(self):
+        self.assertEquivalent(self.Parent())
+        self.assertEquivalent(self.Child())
+
+    def test_single_fields(self):
+        for name, values in self.samples().iteritems():
+            for value in values:
+                entity = self.Parent(id=1)
+                setattr(entity, name, value)
+                self.assertEquivalent(entity)
+
+    def test_combinations(self):
+        samples = self.samples()
+        names = sorted(samples)
+        for offset in xrange(len(names)):
+            chosen = names[offset:offset + 3]
+            for values in itertools.product(*(samples[name]
+                                              for name in chosen)):
+                entity = self.Parent(**dict(zip(chosen, values)))
+                self.assertEquivalent(entity)
+
+
+class TestCompiledValidateCompact(TestCompiledValidate):
+    Parent = CompactParent
+    Child = CompactChild
+
+
+class TestCompact(unittest.TestCase):
+
+    def test_layout(self):
+        self.assertEqual(CompactChild.__slots__, ('id', 'name', '_dirty'))
+        self.assertIsInstance(CompactChild.id, IntegerField)
+
+        entity = CompactChild(1)
+        self.assertEqual(entity.id, 1)
+        self.assertNotIn('_values', dir(entity))
+
+    def test_get_set(self):
+        entity = CompactChild()
+        self.assertEqual(entity.id, None)
+        self.assertEqual(entity.name, u'')
+
+        entity.id = 2
+        self.assertEqual(entity.id, 2)
+        self.assertEqual(entity.keyify(), (2,))
+        self.assertEqual(repr(entity), 'CompactChild(id=2)')
+
+    def test_lazy_default(self):
+        class Foo(Entity):
+            __compact__ = True
+            items = ListField(default=list)
+
+        entity = Foo()
+        self.assertRaises(AttributeError, Foo.items.slot.__get__, entity)
+        entity.items.append(1)
+        self.assertEqual(entity.items, [1])
+
+    def test_from_trusted(self):
+        entity = CompactChild.from_trusted(name='foo')
+        self.assertEqual(entity.id, None)
+        self.assertEqual(entity.name, 'foo')
+
+    def test_pickle(self):
+        entity = CompactChild(1)
+        for protocol in xrange(pickle.HIGHEST_PROTOCOL + 1):
+            copy = pickle.loads(pickle.dumps(entity, protocol))
+            self.assertEqual(copy.id, 1)
+            self.assertEqual(copy.name, u'')
+
+    def test_custom_init(self):
+        class Foo(Entity):
+            __compact__ = True
+            id = IntegerField()
+
+            def __init__(self, id):
+                super(Foo, self).__init__(id=id * 2)
+
+        self.assertEqual(Foo(1).id, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+import unittest
+from entities import *
+
+
+class Tag(Entity):
+    name = StringField(group=PRIMARY)
+
+
+class Post(Entity):
+    id = IntegerField(group=PRIMARY)
+    tag = EntityField(Tag, group=PRIMARY)
+    labels = SetField(StringField(), group=SECONDARY)
+
+
+class TestSharding(unittest.TestCase):
+
+    def test_fingerprint(self):
+        # Fingerprints do not depend on the process or on set order.
+        self.assertEqual(key_fingerprint((1, (u'a', frozenset(['x', 'y'])))),
+                         12031454122894567871)
+        self.assertEqual(key_fingerprint((1,), 128),
+                         126876431931750589414614751896739096086)
+        with self.assertRaises(ValueError):
+            key_fingerprint((1,), 32)
+
+        post = Post(1, Tag(u'a'), set(['y', 'x']))
+        self.assertEqual(post.fingerprint(), key_fingerprint((1, (u'a',))))
+        self.assertEqual(post.fingerprint(SECONDARY),
+                         key_fingerprint((frozenset(['x', 'y']),)))
+        self.assertEqual(post.fingerprint(bits=128) >> 64, post.fingerprint())
+
+    def test_jump(self):
+        keys = [(index,) for index in xrange(5000)]
+        before = Partitioner(10)
+        after = Partitioner(11)
+        moved = [key for key in keys
+                 if before.shard_of_key(key) != after.shard_of_key(key)]
+        self.assertTrue(300 < len(moved) < 600)
+        self.assertTrue(all(after.shard_of_key(key) == 10 for key in moved))
+
+        partitioner = Partitioner(['a', 'b', 'c'])
+        posts = [Post(index, Tag(u't')) for index in xrange(300)]
+        shards = partitioner.partition(posts)
+        self.assertEqual(sorted(shards), ['a', 'b', 'c'])
+        self.assertEqual(sum(len(group) for group in shards.itervalues()),
+                         300)
+        for shard, group in shards.iteritems():
+            for post in group:
+                self.assertEqual(partitioner.shard(post), shard)
+
+    def test_ring(self):
+        keys = [(index,) for index in xrange(5000)]
+        before = Partitioner(['a', 'b', 'c', 'd'], method='ring')
+        after = Partitioner(['a', 'b', 'd'], method='ring')
+        for key in keys:
+            shard = before.shard_of_key(key)
+            if shard != 'c':
+                self.assertEqual(after.shard_of_key(key), shard)
+        counts = dict()
+        for key in keys:
+            shard = before.shard_of_key(key)
+            counts[shard] = counts.get(shard, 0) + 1
+        self.assertTrue(all(800 < count < 1700
+                            for count in counts.itervalues()))
+
+        with self.assertRaises(ValueError):
+            Partitioner(0)
+        with self.assertRaises(ValueError):
+            Partitioner(3, method='modulo')
+
+
+if __name__ == '__main__':
+    unittest.main()
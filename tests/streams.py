@@ -0,0 +1,127 @@
+import datetime
+import gc
+import os
+import unittest
+import pytz
+from entities import *
+from entities.streams import encode_key, dedup, group_by, MERGE_WIDTH
+
+
+class Item(Entity):
+    id = IntegerField(group=PRIMARY)
+    tags = SetField(StringField(), group=SECONDARY)
+    labels = DictField(IntegerField(), group=SECONDARY)
+
+
+def make_items():
+    return [Item(index % 7, set(['a', 'b%d' % (index % 3)]),
+                 dict(x=index % 2))
+            for index in xrange(50)]
+
+
+class TestStreams(unittest.TestCase):
+
+    def test_encode_key(self):
+        first = frozenset(['b%d' % index for index in xrange(20)])
+        second = frozenset(reversed(sorted(first)))
+        self.assertEqual(encode_key((first, 1)), encode_key((second, 1)))
+        self.assertEqual(encode_key(('a', 1)), encode_key((u'a', 1)))
+        self.assertNotEqual(encode_key(('a', 1)), encode_key(('a', '1')))
+        self.assertNotEqual(encode_key((('a',), 'b')),
+                            encode_key(('a', ('b',))))
+        self.assertNotEqual(encode_key((1, 2)), encode_key(((1, 2),)))
+        self.assertNotEqual(encode_key(None), encode_key(()))
+
+        moment = datetime.datetime(2014, 1, 1, 12, tzinfo=pytz.utc)
+        local = moment.astimezone(pytz.timezone('Europe/Istanbul'))
+        self.assertEqual(encode_key((moment,)), encode_key((local,)))
+
+        key = ()
+        for _ in xrange(10000):
+            key = (key,)
+        self.assertEqual(encode_key(key), '(1:' * 10000 + '(0:')
+
+        with self.assertRaises(TypeError):
+            encode_key((object(),))
+
+    def test_dedup(self):
+        items = make_items()
+        result = list(dedup(items))
+        self.assertEqual([item.id for item in result], range(7))
+        self.assertEqual([id(item) for item in result],
+                         [id(item) for item in items[:7]])
+
+        spilled = list(dedup(items, buffer_size=3))
+        self.assertEqual([item.id for item in spilled], range(7))
+        self.assertEqual([item.tags for item in spilled],
+                         [item.tags for item in items[:7]])
+
+        keys = [item.keyify(SECONDARY)
+                for item in dedup(items, SECONDARY, buffer_size=2)]
+        self.assertEqual(len(keys), 6)
+        self.assertEqual(len(set(keys)), 6)
+        self.assertEqual(list(dedup([])), [])
+
+    def test_group_by(self):
+        items = make_items()
+        groups = list(group_by(items))
+        self.assertEqual([key for key, group in groups],
+                         [(index,) for index in xrange(7)])
+        self.assertEqual([id(item) for item in groups[0][1]],
+                         [id(item) for item in items[::7]])
+
+        spilled = list(group_by(items, buffer_size=4))
+        self.assertEqual([(key, [item.keyify() for item in group])
+                          for key, group in spilled],
+                         [(key, [item.keyify() for item in group])
+                          for key, group in groups])
+
+        groups = dict(group_by(items, SECONDARY, buffer_size=5))
+        key = (frozenset(['a', 'b0']), (('x', 0),))
+        self.assertEqual(len(groups), 6)
+        self.assertEqual(len(groups[key]), 9)
+
+        with self.assertRaises(ValueError):
+            list(group_by(items, buffer_size=0))
+
+    def test_merge_budget(self):
+        # While runs are merged, only chunks of them are in memory, and few
+        # of them are open at a time.
+        def generate():
+            for index in xrange(2000):
+                yield Item(index)
+
+        def count_open():
+            return len(os.listdir('/proc/self/fd'))
+
+        if not os.path.isdir('/proc/self/fd'):
+            count_open = lambda: 0
+
+        for sort in (dedup, group_by):
+            before = count_open()
+            results = sort(generate(), buffer_size=20)
+            next(results)
+            gc.collect()
+            live = sum(1 for item in gc.get_objects() if type(item) is Item)
+            self.assertLessEqual(live, 20)
+            self.assertLessEqual(count_open() - before, MERGE_WIDTH)
+            self.assertEqual(sum(1 for result in results), 1999)
+
+    def test_held_entities(self):
+        # Entities that are in repositories are spilled without them.
+        items = make_items()
+        repository = EntityRepository(Item, items[:7])
+        spilled = list(dedup(items, buffer_size=3))
+        self.assertEqual([item.keyify() for item in spilled],
+                         [item.keyify() for item in items[:7]])
+        self.assertFalse(any(item in repository for item in spilled))
+
+        groups = list(group_by(items, buffer_size=4))
+        self.assertEqual(sum(len(group) for key, group in groups), 50)
+        self.assertEqual(len(repository), 7)
+        items[0].id = 100
+        self.assertIs(repository.get((100,)), items[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,119 @@
+import datetime
+import unittest
+from entities import *
+
+
+class Name(Entity):
+    first_name = StringField(group=SECONDARY)
+    last_name = StringField(group=SECONDARY)
+
+
+class Account(Entity):
+    id = IntegerField(group=PRIMARY, null=False)
+    balance = FloatField(group=SECONDARY)
+    active = BooleanField(null=False)
+    opened = DateField(group=SECONDARY)
+    owner = EntityField(Name, group=SECONDARY)
+    tags = ListField(StringField())
+
+
+def describe(error):
+    if isinstance(error, MultipleErrors):
+        nested = [describe(ex) for ex in error.errors]
+    else:
+        nested = None
+    return type(error), error.field, error.reason, nested
+
+
+def outcome(validatable):
+    try:
+        validatable.validate()
+    except ValidationError, ex:
+        return describe(ex)
+
+
+class TestEntityTable(unittest.TestCase):
+
+    def setUp(self):
+        self.entities = [
+            Account(1, 1.5, True, datetime.date(2015, 1, 2),
+                    Name('eser', 'aygun'), ['a']),
+            Account(2, None, False, None, None, None),
+            Account(3, -2.0, True, datetime.date(1, 1, 1)),
+        ]
+        self.table = EntityTable(Account, self.entities)
+
+    def test_columns(self):
+        columns = self.table._columns
+        self.assertEqual(columns['id'].values.typecode, 'l')
+        self.assertEqual(columns['balance'].values.typecode, 'd')
+        self.assertEqual(columns['active'].values.typecode, 'b')
+        self.assertEqual(columns['opened'].values.typecode, 'i')
+        self.assertEqual(columns['balance'].null_count, 1)
+
+        self.assertEqual(len(self.table), 3)
+        self.assertEqual(self.table.column('id'), [1, 2, 3])
+        self.assertEqual(self.table.column('balance'), [1.5, None, -2.0])
+        self.assertEqual(self.table.column('active'), [True, False, True])
+        self.assertEqual(self.table.column('opened'),
+                         [datetime.date(2015, 1, 2), None,
+                          datetime.date(1, 1, 1)])
+
+    def test_rows(self):
+        for entity, row in zip(self.entities, self.table):
+            self.assertIsInstance(row, Account)
+            self.assertEqual(row._values, entity._values)
+        self.assertEqual(self.table[-1].id, 3)
+        self.assertRaises(IndexError, self.table.__getitem__, 3)
+
+        row = self.table[1]
+        row.balance = 5.0
+        self.assertEqual(self.table[1].balance, None)
+        self.table[1] = row
+        self.assertEqual(self.table.column('balance'), [1.5, 5.0, -2.0])
+        self.assertEqual(self.table._columns['balance'].null_count, 0)
+
+        self.assertRaises(TypeError, self.table.append, Name())
+
+    def test_mixed_values(self):
+        self.table.append(Account(2 ** 70, 1, 'x'))
+        self.table[0] = Account(True, 1.0, False,
+                                datetime.datetime(2015, 1, 2, 3, 4))
+        self.assertEqual(self.table.column('id'), [True, 2, 3, 2 ** 70])
+        self.assertEqual(self.table.column('balance'), [1.0, None, -2.0, 1])
+        self.assertEqual(self.table.column('active'),
+                         [False, False, True, 'x'])
+        self.assertEqual(self.table[0].opened,
+                         datetime.datetime(2015, 1, 2, 3, 4))
+        self.assertIsInstance(self.table[0].id, bool)
+
+    def test_validate(self):
+        self.table.validate()
+
+        entities = [Account(None, 1.0, None), Account(1, 1, True),
+                    Account(1, owner=Name(1)), Account(1, tags=['a', 1])]
+        table = EntityTable(Account, entities)
+        expected = [outcome(entity) for entity in entities]
+        self.assertEqual(outcome(table),
+                         (MultipleErrors, None, 'multiple errors', expected))
+
+        # Longs are kept as they are, and are invalid like in entities.
+        table = EntityTable(Account, [Account(1), Account(5L)])
+        self.assertIs(type(table[1].id), long)
+        self.assertEqual(outcome(table),
+                         (ValidationError, Account.id, 'invalid type', None))
+
+        table = EntityTable(Account, [Account(1), Account(None)])
+        self.assertEqual(outcome(table),
+                         (ValidationError, Account.id, 'null value', None))
+
+    def test_keyify(self):
+        for group in (PRIMARY, SECONDARY):
+            self.assertEqual(self.table.keyify(group),
+                             [entity.keyify(group)
+                              for entity in self.entities])
+        self.assertEqual(EntityTable(Account).keyify(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()